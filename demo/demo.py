@@ -18,6 +18,7 @@ import torch.utils.data.distributed
 import torchvision
 import torchvision.transforms as transforms
 from config import cfg, update_config
+from core.execution import prepare_input, setup_model
 from core.function import get_final_preds
 from PIL import Image
 from pycocotools.coco import COCO
@@ -283,7 +284,7 @@ def get_pose_estimation_prediction(pose_model, image, center, scale):
     pose_model.eval()
     with torch.no_grad():
         # compute output heatmap
-        output = pose_model(model_input)
+        output = pose_model(prepare_input(cfg, model_input))
         preds, _ = get_final_preds(
             cfg, output.clone().cpu().numpy(), np.asarray([center]), np.asarray([scale])
         )
@@ -405,6 +406,7 @@ def main():
     else:
         print("expected model defined in config at TEST.MODEL_FILE")
 
+    pose_model = setup_model(cfg, pose_model)
     pose_model = torch.nn.DataParallel(pose_model, device_ids=cfg.GPUS)
     pose_model.to(CTX)
     pose_model.eval()
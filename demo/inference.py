@@ -27,6 +27,7 @@ import time
 import models
 from config import cfg
 from config import update_config
+from core.execution import prepare_input, setup_model
 from core.inference import get_final_preds
 from utils.transforms import get_affine_transform
 
@@ -112,7 +113,7 @@ def get_pose_estimation_prediction(pose_model, image, centers, scales, transform
     model_inputs = torch.stack(model_inputs)
 
     # compute output heatmap
-    output = pose_model(model_inputs.to(CTX))
+    output = pose_model(prepare_input(cfg, model_inputs.to(CTX)))
     coords, _ = get_final_preds(
         cfg,
         output.cpu().detach().numpy(),
@@ -227,6 +228,7 @@ def main():
     else:
         print('expected model defined in config at TEST.MODEL_FILE')
 
+    pose_model = setup_model(cfg, pose_model)
     pose_model.to(CTX)
     pose_model.eval()
 
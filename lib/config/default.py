@@ -18,17 +18,32 @@ _C.DATA_DIR = ""
 _C.GPUS = (0,)
 _C.WORKERS = 4
 _C.PRINT_FREQ = 20
+# PCK from the ground truth joints in meta instead of the decoded target
+# heatmaps, computed every PRINT_FREQ steps only during training
+_C.ACC_FROM_JOINTS = False
 _C.AUTO_RESUME = False
 _C.PIN_MEMORY = True
 _C.RANK = 0
 _C.LOG_WANDB = False
 
+# DistributedDataParallel with one process per device, started by torchrun.
+# RANK is then taken from the environment, gloo runs on the CPU
+_C.DIST = CN()
+_C.DIST.ENABLED = False
+_C.DIST.BACKEND = "nccl"
+
 # Cudnn related params
 _C.CUDNN = CN()
 _C.CUDNN.BENCHMARK = True
 _C.CUDNN.DETERMINISTIC = False
 _C.CUDNN.ENABLED = True
 
+# mixed precision (core.amp), weights and checkpoints stay in float32
+_C.AMP = CN()
+_C.AMP.ENABLED = False
+# float16 (with a gradient scaler) or bfloat16 on gpus, always bfloat16 on cpu
+_C.AMP.DTYPE = "float16"
+
 # common params for NETWORK
 _C.MODEL = CN()
 _C.MODEL.NAME = "pose_hrnet"
@@ -40,6 +55,15 @@ _C.MODEL.TARGET_TYPE = "gaussian"
 _C.MODEL.IMAGE_SIZE = [256, 256]  # width * height, ex: 192 * 256
 _C.MODEL.HEATMAP_SIZE = [64, 64]  # width * height, ex: 24 * 32
 _C.MODEL.SIGMA = 2
+# center target gaussians on the exact joint location, not the nearest pixel
+_C.MODEL.SUBPIXEL_TARGET = False
+# dataset workers only return the joints, target heatmaps are rendered
+# for the whole batch on the device (core.target)
+_C.MODEL.TARGET_ON_DEVICE = False
+# execution modes (core.execution), NHWC weights and inputs and a
+# torch.compile'd forward, both fall back to eager NCHW when unsupported
+_C.MODEL.CHANNELS_LAST = False
+_C.MODEL.COMPILE = False
 _C.MODEL.EXTRA = CN(new_allowed=True)
 
 _C.LOSS = CN()
@@ -47,6 +71,9 @@ _C.LOSS.USE_OHKM = False
 _C.LOSS.TOPK = 8
 _C.LOSS.USE_TARGET_WEIGHT = True
 _C.LOSS.USE_DIFFERENT_JOINTS_WEIGHT = False
+# loss against one gaussian patch per joint (core.target.gaussian_patches),
+# dense target heatmaps are only rendered for the debug images
+_C.LOSS.SPARSE_TARGET = False
 
 # DATASET related params
 _C.DATASET = CN()
@@ -60,6 +87,12 @@ _C.DATASET.DATA_FORMAT = "jpg"
 _C.DATASET.HYBRID_JOINTS_TYPE = ""
 _C.DATASET.SELECT_DATA = False
 _C.DATASET.COCO_INFINITY_RATIO = 1
+# map the annotation db read-only from disk, shared by all DataLoader workers
+_C.DATASET.DB_MMAP = False
+# keep the finished annotation db on disk and reuse it on later starts
+_C.DATASET.DB_CACHE = False
+# defaults to OUTPUT_DIR/db_cache
+_C.DATASET.DB_CACHE_DIR = ""
 
 # training data augmentation
 _C.DATASET.FLIP = True
@@ -107,12 +140,18 @@ _C.TEST.USE_GT_BBOX = False
 # nms
 _C.TEST.IMAGE_THRE = 0.1
 _C.TEST.NMS_THRE = 0.6
+# gaussian soft oks nms of all the images at once, instead of oks nms per image
 _C.TEST.SOFT_NMS = False
 _C.TEST.OKS_THRE = 0.5
 _C.TEST.IN_VIS_THRE = 0.0
 _C.TEST.COCO_BBOX_FILE = ""
 _C.TEST.BBOX_THRE = 1.0
 _C.TEST.MODEL_FILE = ""
+# write the keypoint results json of the val sets, which are otherwise
+# evaluated in memory; the results of test sets are always written
+_C.TEST.SAVE_RESULTS = True
+# processes of the coco keypoint evaluation, split by image, 0 to run it here
+_C.TEST.EVAL_WORKERS = 0
 
 # debug
 _C.DEBUG = CN()
@@ -137,6 +176,9 @@ def update_config(cfg, args):
     if args.dataDir:
         cfg.DATA_DIR = args.dataDir
 
+    if cfg.DIST.ENABLED:
+        cfg.RANK = int(os.environ.get("RANK", 0))
+
     cfg.DATASET.ROOT = os.path.join(cfg.DATA_DIR, cfg.DATASET.ROOT)
 
     cfg.MODEL.PRETRAINED = os.path.join(cfg.DATA_DIR, cfg.MODEL.PRETRAINED)
@@ -26,6 +26,9 @@ POSE_HIGH_RESOLUTION_NET = CN()
 POSE_HIGH_RESOLUTION_NET.PRETRAINED_LAYERS = ['*']
 POSE_HIGH_RESOLUTION_NET.STEM_INPLANES = 64
 POSE_HIGH_RESOLUTION_NET.FINAL_CONV_KERNEL = 1
+# layers recomputed in the backward pass instead of keeping their
+# activations: any of 'layer1', 'stage2', 'stage3', 'stage4'
+POSE_HIGH_RESOLUTION_NET.CHECKPOINT_LAYERS = []
 
 POSE_HIGH_RESOLUTION_NET.STAGE2 = CN()
 POSE_HIGH_RESOLUTION_NET.STAGE2.NUM_MODULES = 1
@@ -0,0 +1,42 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import, division, print_function
+
+import torch
+
+_DTYPES = {"float16": torch.float16, "bfloat16": torch.bfloat16}
+
+
+def get_device_type(model):
+    """device type ("cuda", "cpu") of the model parameters"""
+    return next(model.parameters()).device.type
+
+
+def get_amp_dtype(config, device_type):
+    """
+    :return: autocast dtype of AMP.DTYPE, always bfloat16 on the cpu,
+        None when mixed precision is disabled
+    """
+    if not config.AMP.ENABLED:
+        return None
+    if device_type == "cpu":
+        return torch.bfloat16
+    return _DTYPES[config.AMP.DTYPE]
+
+
+def autocast(config, device_type):
+    """forward pass context, a no-op with AMP.ENABLED off"""
+    dtype = get_amp_dtype(config, device_type)
+    return torch.autocast(device_type, dtype=dtype, enabled=dtype is not None)
+
+
+def get_grad_scaler(config, device_type):
+    """
+    loss scaler for float16 gradients, disabled (a pass-through) for float32
+    and bfloat16, which has the exponent range of float32
+    """
+    enabled = get_amp_dtype(config, device_type) == torch.float16
+    return torch.amp.GradScaler(device_type, enabled=enabled)
@@ -7,22 +7,45 @@
 from __future__ import absolute_import, division, print_function
 
 import numpy as np
+import torch
+from core import pck
 from core.inference import get_max_preds
 
 
+def _get_max_preds_host(batch_heatmaps):
+    """get_max_preds, on the device for tensors so only the joints are copied"""
+    preds, maxvals = get_max_preds(batch_heatmaps)
+    if isinstance(preds, torch.Tensor):
+        return preds.cpu().numpy(), maxvals.cpu().numpy()
+    return preds, maxvals
+
+
+def get_target_joints(joints, target_weight, image_size, heatmap_size):
+    """
+    ground truth joints in heatmap pixels, at the peak get_max_preds would
+    find on the target heatmaps, and 0 (unlabeled) where there is no target
+    :param joints: [batch_size, num_joints, 3] in input image coordinates,
+        as in meta["joints"]
+    :param target_weight: [batch_size, num_joints, 1]
+    :return: [batch_size, num_joints, 2]
+    """
+    joints = _to_numpy(joints)[:, :, 0:2]
+    target_weight = _to_numpy(target_weight)
+    feat_stride = np.array(image_size, dtype=np.float64) / np.array(heatmap_size)
+    coords = np.trunc(joints / feat_stride + 0.5)
+    # gaussians centered off the heatmap peak on its border
+    coords = np.clip(coords, 0, np.array(heatmap_size) - 1)
+    return np.where(target_weight > 0, coords, 0).astype(np.float32)
+
+
+def _to_numpy(array):
+    if isinstance(array, torch.Tensor):
+        return array.detach().cpu().numpy()
+    return np.asarray(array)
+
+
 def calc_dists(preds, target, normalize):
-    preds = preds.astype(np.float32)
-    target = target.astype(np.float32)
-    dists = np.zeros((preds.shape[1], preds.shape[0]))
-    for n in range(preds.shape[0]):
-        for c in range(preds.shape[1]):
-            if target[n, c, 0] > 1 and target[n, c, 1] > 1:
-                normed_preds = preds[n, c, :] / normalize[n]
-                normed_targets = target[n, c, :] / normalize[n]
-                dists[c, n] = np.linalg.norm(normed_preds - normed_targets)
-            else:
-                dists[c, n] = -1
-    return dists
+    return pck.calc_dists(preds, target, normalize)
 
 
 def dist_acc(dists, thr=0.5):
@@ -35,92 +58,78 @@ def dist_acc(dists, thr=0.5):
         return -1
 
 
-def accuracy(output, target, hm_type="gaussian", thr=0.5):
+def accuracy(output, target, hm_type="gaussian", thr=0.5, target_joints=None):
     """
     Calculate accuracy according to PCK,
     but uses ground truth heatmap rather than x,y locations
     First value to be returned is average accuracy across 'idxs',
     followed by individual accuracies
+    output and target may be torch tensors, they are decoded on their device
+    target_joints: ground truth from get_target_joints, target is not
+    decoded when given
     """
     idx = list(range(output.shape[1]))
     norm = 1.0
     if hm_type == "gaussian":
-        pred, _ = get_max_preds(output)
-        target, _ = get_max_preds(target)
+        pred, _ = _get_max_preds_host(output)
+        if target_joints is None:
+            target, _ = _get_max_preds_host(target)
+        else:
+            target = target_joints
         h = output.shape[2]
         w = output.shape[3]
         norm = np.ones((pred.shape[0], 2)) * np.array([h, w]) / 10
     dists = calc_dists(pred, target, norm)
 
-    acc = np.zeros((len(idx) + 1))
-    avg_acc = 0
-    cnt = 0
-
-    for i in range(len(idx)):
-        acc[i + 1] = dist_acc(dists[idx[i]])
-        if acc[i + 1] >= 0:
-            avg_acc = avg_acc + acc[i + 1]
-            cnt += 1
-
-    avg_acc = avg_acc / cnt if cnt != 0 else 0
-    if cnt != 0:
-        acc[0] = avg_acc
+    acc, avg_acc, cnt = pck.get_acc(dists[idx], thr)
     return acc, avg_acc, cnt, pred
 
 
 def get_acc(idx, dists):
-    acc = np.zeros((len(idx) + 1))
-    avg_acc = 0
-    cnt = 0
-
-    for i in range(len(idx)):
-        acc[i + 1] = dist_acc(dists[idx[i]])
-        if acc[i + 1] >= 0:
-            avg_acc = avg_acc + acc[i + 1]
-            cnt += 1
-
-    avg_acc = avg_acc / cnt if cnt != 0 else 0
-    if cnt != 0:
-        acc[0] = avg_acc
-    return acc, avg_acc, cnt
+    return pck.get_acc(dists[idx])
 
 
-def accuracy_infinity_coco(output, target, hm_type="gaussian", thr=0.5):
+def accuracy_infinity_coco(
+    output, target, hm_type="gaussian", thr=0.5, target_joints=None, target_weight=None
+):
     """
     Calculate accuracy according to PCK,
     but uses ground truth heatmap rather than x,y locations
     First value to be returned is average accuracy across 'idxs',
     followed by individual accuracies
+    output and target may be torch tensors, they are decoded on their device
+    target_joints: ground truth from get_target_joints, target is not
+    decoded when given
+    target_weight: [batch_size, num_joints, 1], needed with target_joints:
+    the samples with infinity joints are then the ones with a target for
+    any of them, otherwise they are found on the target heatmaps
     """
     idx = list(range(output.shape[1]))
-    infinity_idxs = np.any(np.sum(target, axis=(2, 3))[:, 17:] > 1, axis=1)
+    if target_joints is not None:
+        infinity_idxs = np.any(_to_numpy(target_weight)[:, 17:, 0] > 0, axis=1)
+    elif isinstance(target, torch.Tensor):
+        infinity_idxs = (target.sum(dim=(2, 3))[:, 17:] > 1).any(dim=1).cpu().numpy()
+    else:
+        infinity_idxs = np.any(np.sum(target, axis=(2, 3))[:, 17:] > 1, axis=1)
     norm = 1.0
     if hm_type == "gaussian":
-        pred, _ = get_max_preds(output)
-        target, _ = get_max_preds(target)
+        pred, _ = _get_max_preds_host(output)
+        if target_joints is None:
+            target, _ = _get_max_preds_host(target)
+        else:
+            target = target_joints
         h = output.shape[2]
         w = output.shape[3]
         norm = np.ones((pred.shape[0], 2)) * np.array([h, w]) / 10
-    pred_infinity = pred.copy()[infinity_idxs]
-    pred_anatomical = pred.copy()[infinity_idxs][:, 17:, :]
-    pred_coco = pred.copy()[~infinity_idxs][:, :17, :]
-
-    norm_infinity = norm.copy()[infinity_idxs]
-    norm_anatomical = norm.copy()[infinity_idxs]
-    norm_coco = norm.copy()[~infinity_idxs]
-
-    target_infinity = target.copy()[infinity_idxs]
-    target_anatomical = target.copy()[infinity_idxs][:, 17:, :]
-    target_coco = target.copy()[~infinity_idxs][:, :17, :]
-
-    dists_infinity = calc_dists(pred_infinity, target_infinity, norm_infinity)
-    dists_coco = calc_dists(pred_coco, target_coco, norm_coco)
-    dists_anatomical = calc_dists(pred_anatomical, target_anatomical, norm_anatomical)
-
-    acc_infinity, avg_acc_infinity, cnt_infinity = get_acc(idx, dists_infinity)
-    acc_coco, avg_acc_coco, cnt_coco = get_acc(list(range(17)), dists_coco)
-    acc_anatomical, avg_acc_anatomical, cnt_anatomical = get_acc(
-        list(range(output.shape[1] - 17)), dists_anatomical
+    # one distance matrix, the groups only select joints and samples of it
+    dists = calc_dists(pred, target, norm)
+
+    acc_infinity, avg_acc_infinity, cnt_infinity = pck.get_acc(
+        dists[idx], thr, mask=infinity_idxs
+    )
+    acc_coco, avg_acc_coco, cnt_coco = pck.get_acc(dists[:17], thr, mask=~infinity_idxs)
+    acc_anatomical, avg_acc_anatomical, cnt_anatomical = pck.get_acc(
+        dists[17:], thr, mask=infinity_idxs
     )
 
     return (
@@ -0,0 +1,70 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import, division, print_function
+
+import functools
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def compile_forward(forward):
+    """
+    torch.compile of a forward function, which runs eagerly from the first
+    call that fails to compile on (no compiler, unsupported op, ...)
+    """
+    if not hasattr(torch, "compile"):
+        logger.warning("=> torch.compile is not available, running eagerly")
+        return forward
+    try:
+        compiled = torch.compile(forward)
+    except Exception as e:  # e.g. a python version dynamo does not support
+        logger.warning("=> torch.compile unsupported ({}), running eagerly".format(e))
+        return forward
+
+    eager = False
+
+    @functools.wraps(forward)
+    def run(*args, **kwargs):
+        nonlocal eager
+        if eager:
+            return forward(*args, **kwargs)
+        try:
+            return compiled(*args, **kwargs)
+        except Exception as e:
+            # errors of the model itself are raised again by the eager call
+            output = forward(*args, **kwargs)
+            logger.warning("=> torch.compile failed ({}), running eagerly".format(e))
+            eager = True
+            return output
+
+    return run
+
+
+def setup_model(cfg, model):
+    """
+    apply the MODEL.CHANNELS_LAST and MODEL.COMPILE execution modes to the
+    unwrapped model, before DataParallel or DistributedDataParallel.
+    Parameter names are unchanged, so checkpoints stay interchangeable
+    """
+    if cfg.MODEL.CHANNELS_LAST:
+        model = model.to(memory_format=torch.channels_last)
+    if cfg.MODEL.COMPILE:
+        if not cfg.DIST.ENABLED and len(cfg.GPUS) > 1:
+            # DataParallel replicas would share the forward of the original
+            logger.warning("=> MODEL.COMPILE needs a single device per process")
+        else:
+            model.forward = compile_forward(model.forward)
+    return model
+
+
+def prepare_input(cfg, input):
+    """input batch in the memory format of the model"""
+    if cfg.MODEL.CHANNELS_LAST:
+        return input.contiguous(memory_format=torch.channels_last)
+    return input
@@ -13,9 +13,14 @@ import time
 import numpy as np
 import torch
 import wandb
-from core.evaluate import accuracy, accuracy_infinity_coco
-from core.inference import get_final_preds
-from utils.transforms import flip_back
+from core.amp import autocast
+from core.evaluate import accuracy, accuracy_infinity_coco, get_target_joints
+from core.execution import prepare_input
+from core.inference import decode_heatmaps, flip_test
+from core.target import gaussian_patches, render_gaussian_targets, render_patches
+from utils.distributed import broadcast_from_main, gather_to_main
+from utils.heatmap import log_gaussian_table_cache
+from utils.transforms import flip_permutation
 from utils.vis import save_debug_images
 
 logger = logging.getLogger(__name__)
@@ -31,7 +36,12 @@ def train(
     output_dir,
     tb_log_dir,
     writer_dict,
+    scaler=None,
 ):
+    """
+    :param scaler: torch.amp.GradScaler from core.amp.get_grad_scaler,
+        for float16 mixed precision
+    """
     batch_time = AverageMeter()
     data_time = AverageMeter()
     losses = AverageMeter()
@@ -42,25 +52,27 @@ def train(
     else:
         acc = AverageMeter()
 
-    # switch to train mode
+    # switch to train mode, the FREEZE_LAYERS are frozen by train.py
     model.train()
-    # freeze specified layers
-    extra = config.MODEL.EXTRA
-    if "FREEZE_LAYERS" in extra and extra["FREEZE_LAYERS"]:
-        frozen_layers = extra.FROZEN_LAYERS
-        for layer in frozen_layers:
-            eval("model.module." + layer + ".requires_grad_(False)")
 
+    device = next(model.parameters()).device
     end = time.time()
     for i, (input, target, target_weight, meta) in enumerate(train_loader):
         # measure data loading time
         data_time.update(time.time() - end)
+        input = prepare_input(config, input)
 
-        # compute output
-        outputs = model(input)
+        # compute output, the loss is taken in float32
+        with autocast(config, device.type):
+            outputs = model(input)
+        if isinstance(outputs, list):
+            outputs = [output.float() for output in outputs]
+        else:
+            outputs = outputs.float()
 
-        target = target.cuda(non_blocking=True)
-        target_weight = target_weight.cuda(non_blocking=True)
+        target, target_weight = _get_targets(
+            config, train_loader.dataset, target, target_weight, meta, device
+        )
 
         if isinstance(outputs, list):
             loss = criterion(outputs[0], target, target_weight)
@@ -74,35 +86,47 @@ def train(
 
         # compute gradient and do update step
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        if scaler is not None:
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            loss.backward()
+            optimizer.step()
 
         # measure accuracy and record loss
         losses.update(loss.item(), input.size(0))
 
-        if config.MODEL.NUM_JOINTS == 53:
-            (
-                (_, avg_acc_infinity, cnt_infinity),
-                (_, avg_acc_anatomical, cnt_anatomical),
-                (_, avg_acc_coco, cnt_coco),
-                pred,
-            ) = accuracy_infinity_coco(
-                output.detach().cpu().numpy(), target.detach().cpu().numpy()
-            )
-            acc_infinity.update(avg_acc_infinity, cnt_infinity)
-            acc_anatomical.update(avg_acc_anatomical, cnt_anatomical)
-            acc_coco.update(avg_acc_coco, cnt_coco)
-        else:
-            _, avg_acc, cnt, pred = accuracy(
-                output.detach().cpu().numpy(), target.detach().cpu().numpy()
-            )
-            acc.update(avg_acc, cnt)
+        # with ACC_FROM_JOINTS only the steps that are printed are measured
+        if not config.ACC_FROM_JOINTS or i % config.PRINT_FREQ == 0:
+            target_joints = _get_target_joints(config, meta, target_weight)
+            if config.MODEL.NUM_JOINTS == 53:
+                (
+                    (_, avg_acc_infinity, cnt_infinity),
+                    (_, avg_acc_anatomical, cnt_anatomical),
+                    (_, avg_acc_coco, cnt_coco),
+                    pred,
+                ) = accuracy_infinity_coco(
+                    output.detach(),
+                    target,
+                    target_joints=target_joints,
+                    target_weight=target_weight,
+                )
+                acc_infinity.update(avg_acc_infinity, cnt_infinity)
+                acc_anatomical.update(avg_acc_anatomical, cnt_anatomical)
+                acc_coco.update(avg_acc_coco, cnt_coco)
+            else:
+                _, avg_acc, cnt, pred = accuracy(
+                    output.detach(), target, target_joints=target_joints
+                )
+                acc.update(avg_acc, cnt)
 
         # measure elapsed time
         batch_time.update(time.time() - end)
         end = time.time()
 
-        if i % config.PRINT_FREQ == 0:
+        # with DIST.ENABLED only rank 0 logs
+        if i % config.PRINT_FREQ == 0 and config.RANK == 0:
             if config.MODEL.NUM_JOINTS == 53:
                 msg = (
                     "Epoch: [{0}][{1}/{2}]\t"
@@ -180,7 +204,20 @@ def train(
             writer_dict["train_global_steps"] = global_steps + 1
 
             prefix = "{}_{}".format(os.path.join(output_dir, "train"), i)
-            save_debug_images(config, input, meta, target, pred * 4, output, prefix)
+            save_debug_images(
+                config,
+                input,
+                meta,
+                _debug_target(config, target),
+                pred * 4,
+                output,
+                prefix,
+            )
+
+    # the data loader workers log their own cache, see
+    # log_gaussian_table_cache_at_exit in tools/train.py
+    if train_loader.num_workers == 0 and config.RANK == 0:
+        log_gaussian_table_cache("main process")
 
 
 def validate(
@@ -205,67 +242,64 @@ def validate(
     # switch to evaluate mode
     model.eval()
 
-    num_samples = len(val_dataset)
+    # the shard of this rank with DIST.ENABLED
+    num_samples = len(val_loader.sampler)
     all_preds = np.zeros((num_samples, 17, 3), dtype=np.float32)
     # all_preds = np.zeros((num_samples, config.MODEL.NUM_JOINTS, 3), dtype=np.float32)
     all_boxes = np.zeros((num_samples, 6))
+    image_ids = np.zeros(num_samples, dtype=np.int64)
     image_path = []
     filenames = []
     imgnums = []
     idx = 0
+    flip_perm = torch.as_tensor(
+        flip_permutation(config.MODEL.NUM_JOINTS, val_dataset.flip_pairs)
+    )
+    device = next(model.parameters()).device
     with torch.no_grad():
         end = time.time()
         for i, (input, target, target_weight, meta) in enumerate(val_loader):
-            # compute output
-            # outputs = model(input)
-            outputs = model(input)[:, :17, :, :]
-            if isinstance(outputs, list):
-                output = outputs[-1]
-            else:
-                output = outputs
-
-            if config.TEST.FLIP_TEST:
-                input_flipped = input.flip(3)
-                outputs_flipped = model(input_flipped)[:, :17, :, :]
-                # outputs_flipped = model(input_flipped)
-
-                if isinstance(outputs_flipped, list):
-                    output_flipped = outputs_flipped[-1]
+            input = prepare_input(config, input)
+            # compute output, decoded in float32
+            with autocast(config, device.type):
+                if config.TEST.FLIP_TEST:
+                    output = flip_test(
+                        model, input, flip_perm, config.TEST.SHIFT_HEATMAP
+                    )
                 else:
-                    output_flipped = outputs_flipped
-
-                output_flipped = flip_back(
-                    output_flipped.cpu().numpy(), val_dataset.flip_pairs
-                )
-                output_flipped = torch.from_numpy(output_flipped.copy()).cuda()
-
-                # feature is not aligned, shift flipped heatmap for higher accuracy
-                if config.TEST.SHIFT_HEATMAP:
-                    output_flipped[:, :, :, 1:] = output_flipped.clone()[:, :, :, 0:-1]
+                    output = model(input)
+                    if isinstance(output, list):
+                        output = output[-1]
+            output = output[:, :17, :, :].float()
 
-                output = (output + output_flipped) * 0.5
-
-            target = target.cuda(non_blocking=True)
-            target_weight = target_weight.cuda(non_blocking=True)
+            target, target_weight = _get_targets(
+                config, val_dataset, target, target_weight, meta, device
+            )
 
             loss = criterion(output, target, target_weight)
 
             num_images = input.size(0)
             # measure accuracy and record loss
             losses.update(loss.item(), num_images)
+            target_joints = _get_target_joints(config, meta, target_weight)
             if config.MODEL.NUM_JOINTS == 53:
                 (
                     (_, avg_acc_infinity, cnt_infinity),
                     (_, avg_acc_anatomical, cnt_anatomical),
                     (_, avg_acc_coco, cnt_coco),
                     pred,
-                ) = accuracy_infinity_coco(output.cpu().numpy(), target.cpu().numpy())
+                ) = accuracy_infinity_coco(
+                    output,
+                    target,
+                    target_joints=target_joints,
+                    target_weight=target_weight,
+                )
                 acc_infinity.update(avg_acc_infinity, cnt_infinity)
                 acc_anatomical.update(avg_acc_anatomical, cnt_anatomical)
                 acc_coco.update(avg_acc_coco, cnt_coco)
             else:
                 _, avg_acc, cnt, pred = accuracy(
-                    output.cpu().numpy(), target.cpu().numpy()
+                    output, target, target_joints=target_joints
                 )
                 acc.update(avg_acc, cnt)
 
@@ -277,20 +311,21 @@ def validate(
             s = meta["scale"].numpy()
             score = meta["score"].numpy()
 
-            preds, maxvals = get_final_preds(config, output.clone().cpu().numpy(), c, s)
-
-            all_preds[idx : idx + num_images, :, 0:2] = preds[:, :, 0:2]
-            all_preds[idx : idx + num_images, :, 2:3] = maxvals
+            # decoded on the gpu, only the joints come back to the host
+            all_preds[idx : idx + num_images] = decode_heatmaps(
+                config, output, meta["center"], meta["scale"]
+            )
             # double check this all_boxes parts
             all_boxes[idx : idx + num_images, 0:2] = c[:, 0:2]
             all_boxes[idx : idx + num_images, 2:4] = s[:, 0:2]
             all_boxes[idx : idx + num_images, 4] = np.prod(s * 200, 1)
             all_boxes[idx : idx + num_images, 5] = score
+            image_ids[idx : idx + num_images] = meta["image_id"].numpy()
             image_path.extend(meta["image"])
 
             idx += num_images
 
-            if i % config.PRINT_FREQ == 0:
+            if i % config.PRINT_FREQ == 0 and config.RANK == 0:
                 if config.MODEL.NUM_JOINTS == 53:
                     msg = (
                         "Test: [{0}/{1}]\t"
@@ -324,10 +359,52 @@ def validate(
                 logger.info(msg)
 
                 prefix = "{}_{}".format(os.path.join(output_dir, "val"), i)
-                save_debug_images(config, input, meta, target, pred * 4, output, prefix)
+                save_debug_images(
+                    config,
+                    input,
+                    meta,
+                    _debug_target(config, target),
+                    pred * 4,
+                    output,
+                    prefix,
+                )
 
+        if config.DIST.ENABLED:
+            if config.MODEL.NUM_JOINTS == 53:
+                meters = [losses, acc_infinity, acc_anatomical, acc_coco]
+            else:
+                meters = [losses, acc]
+            # the shards are contiguous, in rank order they are the val set
+            shards = gather_to_main(
+                (
+                    all_preds,
+                    all_boxes,
+                    image_ids,
+                    image_path,
+                    [(m.sum, m.count) for m in meters],
+                )
+            )
+            if config.RANK != 0:
+                return broadcast_from_main(None)
+
+            all_preds = np.concatenate([shard[0] for shard in shards])
+            all_boxes = np.concatenate([shard[1] for shard in shards])
+            image_ids = np.concatenate([shard[2] for shard in shards])
+            image_path = [path for shard in shards for path in shard[3]]
+            for shard in shards[1:]:
+                for meter, (total, count) in zip(meters, shard[4]):
+                    meter.merge(total, count)
+
+        # keypoint nms and the coco evaluation run once, on rank 0
         name_values, perf_indicator = val_dataset.evaluate(
-            config, all_preds, output_dir, all_boxes, image_path, filenames, imgnums
+            config,
+            all_preds,
+            output_dir,
+            all_boxes,
+            image_path,
+            filenames,
+            imgnums,
+            image_ids=image_ids,
         )
 
         model_name = config.MODEL.NAME
@@ -374,9 +451,65 @@ def validate(
                     }
                 )
 
+    if config.DIST.ENABLED:
+        broadcast_from_main(perf_indicator)
     return perf_indicator
 
 
+def _get_targets(config, dataset, target, target_weight, meta, device):
+    """move the batch targets to the device of the model, rendering them
+    there when the dataset workers only returned the joints, as gaussian
+    patches with LOSS.SPARSE_TARGET"""
+    if config.LOSS.SPARSE_TARGET:
+        render = gaussian_patches
+    elif config.MODEL.TARGET_ON_DEVICE:
+        render = render_gaussian_targets
+    else:
+        return (
+            target.to(device, non_blocking=True),
+            target_weight.to(device, non_blocking=True),
+        )
+
+    target, target_weight = render(
+        meta["joints"].to(device, non_blocking=True),
+        meta["joints_vis"].to(device, non_blocking=True),
+        config.MODEL.IMAGE_SIZE,
+        config.MODEL.HEATMAP_SIZE,
+        config.MODEL.SIGMA,
+        subpixel=config.MODEL.SUBPIXEL_TARGET,
+    )
+    if config.LOSS.USE_DIFFERENT_JOINTS_WEIGHT:
+        joints_weight = torch.as_tensor(
+            dataset.joints_weight, dtype=torch.float32, device=target_weight.device
+        )
+        target_weight = target_weight * joints_weight
+    return target, target_weight
+
+
+def _get_target_joints(config, meta, target_weight):
+    """ground truth joints for the accuracy, None to decode the target heatmaps"""
+    if not config.ACC_FROM_JOINTS and not config.LOSS.SPARSE_TARGET:
+        return None
+    return get_target_joints(
+        meta["joints"],
+        target_weight,
+        config.MODEL.IMAGE_SIZE,
+        config.MODEL.HEATMAP_SIZE,
+    )
+
+
+def _debug_target(config, target):
+    """
+    dense target heatmaps for save_debug_images, the sparse target is only
+    rendered when save_debug_images saves it
+    """
+    if not config.LOSS.SPARSE_TARGET:
+        return target
+    if config.DEBUG.DEBUG and config.DEBUG.SAVE_HEATMAPS_GT:
+        return render_patches(target, config.MODEL.HEATMAP_SIZE)
+    return None
+
+
 # markdown format output
 def _print_name_value(name_value, full_arch_name):
     names = name_value.keys()
@@ -413,3 +546,9 @@ class AverageMeter(object):
         self.sum += val * n
         self.count += n
         self.avg = self.sum / self.count if self.count != 0 else 0
+
+    def merge(self, sum, count):
+        """add the sum and count of another meter, e.g. from another rank"""
+        self.sum += sum
+        self.count += count
+        self.avg = self.sum / self.count if self.count != 0 else 0
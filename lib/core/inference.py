@@ -8,26 +8,36 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import math
-
 import numpy as np
+import torch
 
-from utils.transforms import transform_preds
+from utils.transforms import flip_back_tensor, transform_preds_batch
 
 
 def get_max_preds(batch_heatmaps):
     '''
     get predictions from score maps
     heatmaps: numpy.ndarray([batch_size, num_joints, height, width])
+    or a torch.Tensor of the same shape, decoded on its device
     '''
-    assert isinstance(batch_heatmaps, np.ndarray), \
-        'batch_heatmaps should be numpy.ndarray'
+    assert isinstance(batch_heatmaps, (np.ndarray, torch.Tensor)), \
+        'batch_heatmaps should be numpy.ndarray or torch.Tensor'
     assert batch_heatmaps.ndim == 4, 'batch_images should be 4-ndim'
 
     batch_size = batch_heatmaps.shape[0]
     num_joints = batch_heatmaps.shape[1]
     width = batch_heatmaps.shape[3]
     heatmaps_reshaped = batch_heatmaps.reshape((batch_size, num_joints, -1))
+
+    if isinstance(batch_heatmaps, torch.Tensor):
+        idx = torch.argmax(heatmaps_reshaped, 2, keepdim=True)
+        maxvals = torch.gather(heatmaps_reshaped, 2, idx)
+        preds = torch.cat(
+            (idx % width, torch.div(idx, width, rounding_mode='floor')), 2
+        ).float()
+        preds *= (maxvals > 0.0).float()
+        return preds, maxvals
+
     idx = np.argmax(heatmaps_reshaped, 2)
     maxvals = np.amax(heatmaps_reshaped, 2)
 
@@ -46,7 +56,53 @@ def get_max_preds(batch_heatmaps):
     return preds, maxvals
 
 
+def refine_preds(batch_heatmaps, coords):
+    '''
+    quarter pixel shift of every peak towards its higher neighbour, skipped
+    for peaks on or next to the heatmap border
+    batch_heatmaps: [batch_size, num_joints, height, width]
+    coords: [batch_size, num_joints, 2] from get_max_preds, refined in place
+    '''
+    batch_size, num_joints, heatmap_height, heatmap_width = batch_heatmaps.shape
+    flat = batch_heatmaps.reshape((batch_size, num_joints, -1))
+
+    if isinstance(coords, torch.Tensor):
+        xp = torch
+        px = torch.floor(coords[:, :, 0] + 0.5).long()
+        py = torch.floor(coords[:, :, 1] + 0.5).long()
+
+        def at(y, x):
+            idx = (y.clamp(0, heatmap_height - 1) * heatmap_width
+                   + x.clamp(0, heatmap_width - 1))
+            return torch.gather(flat, 2, idx[:, :, None])[:, :, 0]
+    else:
+        xp = np
+        px = np.floor(coords[:, :, 0] + 0.5).astype(np.int64)
+        py = np.floor(coords[:, :, 1] + 0.5).astype(np.int64)
+
+        def at(y, x):
+            idx = (np.clip(y, 0, heatmap_height - 1) * heatmap_width
+                   + np.clip(x, 0, heatmap_width - 1))
+            return np.take_along_axis(flat, idx[:, :, None], 2)[:, :, 0]
+
+    inside = (1 < px) & (px < heatmap_width - 1) \
+        & (1 < py) & (py < heatmap_height - 1)
+    diff = xp.stack(
+        [at(py, px + 1) - at(py, px - 1), at(py + 1, px) - at(py - 1, px)],
+        axis=-1
+    )
+    coords += xp.where(inside[:, :, None], xp.sign(diff) * .25, 0.)
+    return coords
+
+
 def get_final_preds(config, batch_heatmaps, center, scale):
+    '''
+    batch_heatmaps: numpy.ndarray([batch_size, num_joints, height, width])
+    or a torch.Tensor of the same shape, decoded on its device
+    center, scale: [batch_size, 2], of the same type as batch_heatmaps
+    return: preds [batch_size, num_joints, 2] in image coordinates,
+        maxvals [batch_size, num_joints, 1]
+    '''
     coords, maxvals = get_max_preds(batch_heatmaps)
 
     heatmap_height = batch_heatmaps.shape[2]
@@ -54,26 +110,51 @@ def get_final_preds(config, batch_heatmaps, center, scale):
 
     # post-processing
     if config.TEST.POST_PROCESS:
-        for n in range(coords.shape[0]):
-            for p in range(coords.shape[1]):
-                hm = batch_heatmaps[n][p]
-                px = int(math.floor(coords[n][p][0] + 0.5))
-                py = int(math.floor(coords[n][p][1] + 0.5))
-                if 1 < px < heatmap_width-1 and 1 < py < heatmap_height-1:
-                    diff = np.array(
-                        [
-                            hm[py][px+1] - hm[py][px-1],
-                            hm[py+1][px]-hm[py-1][px]
-                        ]
-                    )
-                    coords[n][p] += np.sign(diff) * .25
-
-    preds = coords.copy()
+        coords = refine_preds(batch_heatmaps, coords)
 
     # Transform back
-    for i in range(coords.shape[0]):
-        preds[i] = transform_preds(
-            coords[i], center[i], scale[i], [heatmap_width, heatmap_height]
+    preds = transform_preds_batch(
+        coords, center, scale, [heatmap_width, heatmap_height]
+    )
+    if isinstance(preds, torch.Tensor):
+        return preds.float(), maxvals
+    return preds.astype(np.float32), maxvals
+
+
+def decode_heatmaps(config, batch_heatmaps, center, scale):
+    '''
+    get_final_preds on the device of batch_heatmaps, only the decoded
+    joints are copied back to host memory
+    batch_heatmaps: torch.Tensor([batch_size, num_joints, height, width])
+    center, scale: [batch_size, 2] torch.Tensor or numpy.ndarray
+    return: numpy.ndarray([batch_size, num_joints, 3]), x, y in image
+        coordinates and the heatmap maximum
+    '''
+    device = batch_heatmaps.device
+    with torch.no_grad():
+        preds, maxvals = get_final_preds(
+            config,
+            batch_heatmaps.detach(),
+            torch.as_tensor(center).to(device, non_blocking=True),
+            torch.as_tensor(scale).to(device, non_blocking=True),
         )
+        return torch.cat((preds, maxvals.float()), 2).cpu().numpy()
 
-    return preds, maxvals
+
+def flip_test(model, input, flip_perm, shift_heatmap=False):
+    '''
+    heatmaps averaged over input and its horizontal flip, computed by a
+    single forward pass over both crops
+    input: torch.Tensor([batch_size, 3, height, width])
+    flip_perm: torch.LongTensor, see utils.transforms.flip_permutation
+    '''
+    batch_size = input.size(0)
+    outputs = model(torch.cat((input, input.flip(3))))
+    if isinstance(outputs, list):
+        outputs = outputs[-1]
+
+    output = outputs[:batch_size]
+    output_flipped = flip_back_tensor(
+        outputs[batch_size:], flip_perm, shift_heatmap
+    )
+    return output.add_(output_flipped).mul_(0.5)
@@ -11,6 +11,34 @@ from __future__ import print_function
 import torch
 import torch.nn as nn
 
+from core.target import GaussianPatches, patch_index
+
+
+def sparse_joints_mse(output, target):
+    '''
+    per joint mean squared error against the gaussian_patches targets,
+    without the dense heatmaps: sum((p - g)^2) = sum(p^2) - 2 * sum(p * g)
+    + sum(g^2), with the last two taken over the patches only
+    output: [batch_size, num_joints, height, width]
+    target: GaussianPatches from core.target.gaussian_patches
+    return: [batch_size, num_joints]
+    '''
+    batch_size, num_joints, height, width = output.shape
+    heatmaps_pred = output.reshape((batch_size, num_joints, -1))
+    g_y = target.g_y.to(output.dtype)
+    g_x = target.g_x.to(output.dtype)
+    size = g_y.size(-1)
+
+    patches_pred = heatmaps_pred.gather(2, patch_index(target, width)).reshape(
+        (batch_size, num_joints, size, size)
+    )
+    pred_sq = heatmaps_pred.pow(2).sum(dim=2)
+    pred_gt = torch.einsum('bjyx,bjy,bjx->bj', patches_pred, g_y, g_x)
+    # the gaussian is separable, so is the sum of its squares
+    gt_sq = g_y.pow(2).sum(dim=2) * g_x.pow(2).sum(dim=2)
+
+    return (pred_sq - 2 * pred_gt + gt_sq) / (height * width)
+
 
 class JointsMSELoss(nn.Module):
     def __init__(self, use_target_weight):
@@ -19,24 +47,25 @@ class JointsMSELoss(nn.Module):
         self.use_target_weight = use_target_weight
 
     def forward(self, output, target, target_weight):
+        if isinstance(target, GaussianPatches):
+            loss = 0.5 * sparse_joints_mse(output, target)
+            if self.use_target_weight:
+                loss = loss * target_weight[:, :, 0].pow(2)
+            return loss.mean()
+
         batch_size = output.size(0)
         num_joints = output.size(1)
-        heatmaps_pred = output.reshape((batch_size, num_joints, -1)).split(1, 1)
-        heatmaps_gt = target.reshape((batch_size, num_joints, -1)).split(1, 1)
-        loss = 0
-
-        for idx in range(num_joints):
-            heatmap_pred = heatmaps_pred[idx].squeeze()
-            heatmap_gt = heatmaps_gt[idx].squeeze()
-            if self.use_target_weight:
-                loss += 0.5 * self.criterion(
-                    heatmap_pred.mul(target_weight[:, idx]),
-                    heatmap_gt.mul(target_weight[:, idx])
-                )
-            else:
-                loss += 0.5 * self.criterion(heatmap_pred, heatmap_gt)
+        heatmaps_pred = output.reshape((batch_size, num_joints, -1))
+        heatmaps_gt = target.reshape((batch_size, num_joints, -1))
 
-        return loss / num_joints
+        # the mean over all joints equals the average of the per joint
+        # means, as every joint has the same number of pixels
+        if self.use_target_weight:
+            return 0.5 * self.criterion(
+                heatmaps_pred.mul(target_weight),
+                heatmaps_gt.mul(target_weight)
+            )
+        return 0.5 * self.criterion(heatmaps_pred, heatmaps_gt)
 
 
 class JointsOHKMMSELoss(nn.Module):
@@ -47,38 +76,31 @@ class JointsOHKMMSELoss(nn.Module):
         self.topk = topk
 
     def ohkm(self, loss):
-        ohkm_loss = 0.
-        for i in range(loss.size()[0]):
-            sub_loss = loss[i]
-            topk_val, topk_idx = torch.topk(
-                sub_loss, k=self.topk, dim=0, sorted=False
-            )
-            tmp_loss = torch.gather(sub_loss, 0, topk_idx)
-            ohkm_loss += torch.sum(tmp_loss) / self.topk
-        ohkm_loss /= loss.size()[0]
-        return ohkm_loss
+        '''
+        loss: [batch_size, num_joints], mean of the topk hardest joints of
+        every sample, averaged over the batch
+        '''
+        topk_val, _ = torch.topk(loss, k=self.topk, dim=1, sorted=False)
+        return topk_val.mean()
 
     def forward(self, output, target, target_weight):
+        if isinstance(target, GaussianPatches):
+            loss = 0.5 * sparse_joints_mse(output, target)
+            if self.use_target_weight:
+                loss = loss * target_weight[:, :, 0].pow(2)
+            return self.ohkm(loss)
+
         batch_size = output.size(0)
         num_joints = output.size(1)
-        heatmaps_pred = output.reshape((batch_size, num_joints, -1)).split(1, 1)
-        heatmaps_gt = target.reshape((batch_size, num_joints, -1)).split(1, 1)
+        heatmaps_pred = output.reshape((batch_size, num_joints, -1))
+        heatmaps_gt = target.reshape((batch_size, num_joints, -1))
 
-        loss = []
-        for idx in range(num_joints):
-            heatmap_pred = heatmaps_pred[idx].squeeze()
-            heatmap_gt = heatmaps_gt[idx].squeeze()
-            if self.use_target_weight:
-                loss.append(0.5 * self.criterion(
-                    heatmap_pred.mul(target_weight[:, idx]),
-                    heatmap_gt.mul(target_weight[:, idx])
-                ))
-            else:
-                loss.append(
-                    0.5 * self.criterion(heatmap_pred, heatmap_gt)
-                )
-
-        loss = [l.mean(dim=1).unsqueeze(dim=1) for l in loss]
-        loss = torch.cat(loss, dim=1)
-
-        return self.ohkm(loss)
+        if self.use_target_weight:
+            loss = 0.5 * self.criterion(
+                heatmaps_pred.mul(target_weight),
+                heatmaps_gt.mul(target_weight)
+            )
+        else:
+            loss = 0.5 * self.criterion(heatmaps_pred, heatmaps_gt)
+
+        return self.ohkm(loss.mean(dim=2))
@@ -0,0 +1,76 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+
+def calc_dists(preds, target, normalize):
+    """
+    normalized distances between predicted and target joints
+    :param preds: [batch_size, num_joints, 2]
+    :param target: [batch_size, num_joints, 2]
+    :param normalize: [batch_size, 2]
+    :return: [num_joints, batch_size], -1 where the target is not labeled
+        (x or y <= 1)
+    """
+    preds = preds.astype(np.float32)
+    target = target.astype(np.float32)
+    normalize = np.asarray(normalize)[:, None, :]
+
+    labeled = (target[:, :, 0] > 1) & (target[:, :, 1] > 1)
+    diff = preds / normalize - target / normalize
+    # dot product per joint, rounds like np.linalg.norm of a single vector
+    dists = np.sqrt(np.matmul(diff[:, :, None, :], diff[:, :, :, None])[:, :, 0, 0])
+    return np.where(labeled, dists, -1).T
+
+
+def joint_accuracy(dists, thr=0.5, mask=None):
+    """
+    fraction of distances below thr for every joint, ignoring values with a -1
+    :param dists: [num_joints, batch_size] from calc_dists
+    :param mask: [batch_size] bool, samples to count, all of them by default
+    :return: [num_joints], -1 for joints without any labeled sample
+    """
+    valid = np.not_equal(dists, -1)
+    if mask is not None:
+        valid &= mask[None, :]
+    num_valid = valid.sum(axis=1)
+    num_below = (np.less(dists, thr) & valid).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(num_valid > 0, num_below * 1.0 / num_valid, -1)
+
+
+def get_acc(dists, thr=0.5, mask=None):
+    """
+    :return: acc [num_joints + 1] with the average first, followed by the
+        accuracy of every joint, the average and the number of joints in it
+    """
+    joints_acc = joint_accuracy(dists, thr, mask)
+    counted = joints_acc[joints_acc >= 0]
+    cnt = len(counted)
+
+    # running sum in joint order, rounds like adding them up one by one
+    avg_acc = np.cumsum(counted)[-1] / cnt if cnt != 0 else 0
+
+    acc = np.zeros((len(joints_acc) + 1))
+    acc[1:] = joints_acc
+    if cnt != 0:
+        acc[0] = avg_acc
+    return acc, avg_acc, cnt
+
+
+def pck_curve(scaled_err, visible, thresholds):
+    """
+    PCK of every joint at every threshold in one pass
+    :param scaled_err: [num_joints, num_samples] normalized errors
+    :param visible: [num_joints, num_samples] 1 where the joint is labeled
+    :param thresholds: [num_thresholds]
+    :return: [num_thresholds, num_joints] in percent
+    """
+    thresholds = np.asarray(thresholds)[:, None, None]
+    below = np.multiply(scaled_err[None] <= thresholds, visible[None])
+    return np.divide(100.0 * np.sum(below, axis=2), np.sum(visible, axis=1))
@@ -0,0 +1,154 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import, division, print_function
+
+from collections import namedtuple
+
+import torch
+
+GaussianPatches = namedtuple("GaussianPatches", ["rows", "cols", "g_y", "g_x"])
+
+
+def _axis_gaussian(grid, center, lo, hi, sigma):
+    """1d gaussian along one heatmap axis, zero outside of [lo, hi)"""
+    d = (grid - center[..., None]).float()
+    g = torch.exp(-(d**2) / (2 * sigma**2))
+    inside = (grid >= lo[..., None]) & (grid < hi[..., None])
+    return g * inside
+
+
+def _gaussian_frame(joints, joints_vis, image_size, heatmap_size, sigma):
+    """
+    joint locations in heatmap pixels, the [ul, br) box of their gaussians
+    and the target weight, zero for gaussians entirely off the heatmap
+    """
+    device = joints.device
+    width, height = int(heatmap_size[0]), int(heatmap_size[1])
+    tmp_size = sigma * 3
+
+    feat_stride = torch.tensor(
+        [image_size[0] / width, image_size[1] / height],
+        dtype=torch.float64,
+        device=device,
+    )
+    coords = joints[..., 0:2].double() / feat_stride
+    mu = torch.trunc(coords + 0.5)
+    ul = torch.trunc(mu - tmp_size)
+    br = torch.trunc(mu + tmp_size + 1)
+
+    # Check that any part of the gaussian is in-bounds
+    size = torch.tensor([width, height], dtype=torch.float64, device=device)
+    out = ((ul >= size) | (br < 0)).any(dim=-1)
+
+    target_weight = joints_vis[..., 0:1].float().clone()
+    target_weight[out] = 0
+
+    return coords, mu, ul, br, target_weight
+
+
+def render_gaussian_targets(
+    joints, joints_vis, image_size, heatmap_size, sigma, subpixel=False
+):
+    """
+    batched counterpart of utils.heatmap.generate_gaussian_targets, runs on
+    the device of joints. The 2d gaussian is rendered as the outer product of
+    two 1d gaussians, so values match the dataset targets up to float rounding.
+    :param joints: [batch_size, num_joints, 3], in input image coordinates
+    :param joints_vis: [batch_size, num_joints, 3]
+    :param image_size: [width, height] of the network input
+    :param heatmap_size: [width, height] of the heatmaps
+    :param sigma: gaussian std in heatmap pixels
+    :param subpixel: center the gaussian on the exact (non-integer) joint location
+    :return: target [batch_size, num_joints, height, width],
+        target_weight [batch_size, num_joints, 1] (1: visible, 0: invisible)
+    """
+    width, height = int(heatmap_size[0]), int(heatmap_size[1])
+    coords, mu, ul, br, target_weight = _gaussian_frame(
+        joints, joints_vis, image_size, heatmap_size, sigma
+    )
+
+    center = coords if subpixel else mu
+    xs = torch.arange(width, dtype=torch.float64, device=joints.device)
+    ys = torch.arange(height, dtype=torch.float64, device=joints.device)
+    g_x = _axis_gaussian(xs, center[..., 0], ul[..., 0], br[..., 0], sigma)
+    g_y = _axis_gaussian(ys, center[..., 1], ul[..., 1], br[..., 1], sigma)
+
+    paste = (target_weight > 0.5).float()[..., None]
+    target = g_y[..., :, None] * g_x[..., None, :] * paste
+
+    return target, target_weight
+
+
+def gaussian_patches(
+    joints, joints_vis, image_size, heatmap_size, sigma, subpixel=False
+):
+    """
+    the targets of render_gaussian_targets as one (6 * sigma + 1) ** 2 patch
+    per joint, without the dense heatmaps
+    :return: GaussianPatches with the heatmap rows / cols [batch_size,
+        num_joints, size] the patch covers, clamped to the heatmap, and the
+        1d gaussians g_y / g_x along them, zero off the heatmap and for
+        joints without a target, target_weight [batch_size, num_joints, 1]
+    """
+    width, height = int(heatmap_size[0]), int(heatmap_size[1])
+    coords, mu, ul, br, target_weight = _gaussian_frame(
+        joints, joints_vis, image_size, heatmap_size, sigma
+    )
+
+    # [ul, br) spans 6 * sigma + 1 pixels, one more for a non integer sigma
+    size = int(2 * sigma * 3) + 2
+    steps = torch.arange(size, dtype=torch.float64, device=joints.device)
+    index = ul[..., None] + steps
+    center = coords if subpixel else mu
+    g_x = _axis_gaussian(
+        index[..., 0, :], center[..., 0], ul[..., 0], br[..., 0], sigma
+    )
+    g_y = _axis_gaussian(
+        index[..., 1, :], center[..., 1], ul[..., 1], br[..., 1], sigma
+    )
+
+    cols = index[..., 0, :]
+    rows = index[..., 1, :]
+    g_x = g_x * ((cols >= 0) & (cols < width))
+    g_y = g_y * ((rows >= 0) & (rows < height))
+    g_y = g_y * (target_weight > 0.5).float()
+
+    return (
+        GaussianPatches(
+            rows=rows.clamp(0, height - 1).long(),
+            cols=cols.clamp(0, width - 1).long(),
+            g_y=g_y,
+            g_x=g_x,
+        ),
+        target_weight,
+    )
+
+
+def patch_index(patches, width):
+    """
+    :return: [batch_size, num_joints, size * size] flat heatmap index of
+        every patch pixel
+    """
+    index = patches.rows[..., :, None] * width + patches.cols[..., None, :]
+    return index.flatten(start_dim=-2)
+
+
+def render_patches(patches, heatmap_size):
+    """
+    dense target heatmaps from gaussian_patches, for the debug images
+    :return: [batch_size, num_joints, height, width]
+    """
+    width, height = int(heatmap_size[0]), int(heatmap_size[1])
+    batch_size, num_joints = patches.rows.shape[:2]
+    values = patches.g_y[..., :, None] * patches.g_x[..., None, :]
+    target = torch.zeros(
+        batch_size, num_joints, height * width, device=patches.rows.device
+    )
+    # clamped pixels off the heatmap only add zeros
+    target.scatter_add_(
+        2, patch_index(patches, width), values.flatten(start_dim=-2).float()
+    )
+    return target.reshape(batch_size, num_joints, height, width)
@@ -0,0 +1,190 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import, division, print_function
+
+import os
+
+import numpy as np
+
+COLUMNS = ("joints_3d", "joints_3d_vis", "center", "scale", "paths", "image")
+OPTIONAL_COLUMNS = ("filename", "score", "imgnum", "image_id")
+
+
+class JointsDB(object):
+    """
+    array-backed annotation db, one row per person instance
+    joints_3d: [num_samples, num_joints, 3]
+    joints_3d_vis: [num_samples, num_joints, 3]
+    center: [num_samples, 2]
+    scale: [num_samples, 2]
+    score: [num_samples] or None (ground truth boxes)
+    imgnum: [num_samples] or None (detection boxes)
+    image_id: [num_samples] int64 dataset image id or None (mpii)
+    image / filename: [num_samples] indices into the interned path table
+    paths: [num_paths] utf-8 encoded bytes
+    """
+
+    def __init__(
+        self,
+        joints_3d,
+        joints_3d_vis,
+        center,
+        scale,
+        paths,
+        image,
+        filename=None,
+        score=None,
+        imgnum=None,
+        image_id=None,
+    ):
+        self.joints_3d = joints_3d
+        self.joints_3d_vis = joints_3d_vis
+        self.center = center
+        self.scale = scale
+        self.paths = paths
+        self.image = image
+        self.filename = filename
+        self.score = score
+        self.imgnum = imgnum
+        self.image_id = image_id
+
+    @classmethod
+    def from_records(cls, records):
+        """build from the list of dicts returned by JointsDataset._get_db"""
+        records = list(records)
+        if len(records) == 0:
+            empty = np.zeros((0, 0, 3), dtype=np.float32)
+            return cls(
+                empty,
+                empty.copy(),
+                np.zeros((0, 2), dtype=np.float32),
+                np.zeros((0, 2), dtype=np.float32),
+                np.zeros(0, dtype="S1"),
+                np.zeros(0, dtype=np.int32),
+            )
+
+        paths = []
+        path_ids = {}
+
+        def intern(path):
+            if path not in path_ids:
+                path_ids[path] = len(paths)
+                paths.append(path)
+            return path_ids[path]
+
+        image = np.array([intern(rec["image"]) for rec in records], dtype=np.int32)
+
+        filename = None
+        if any("filename" in rec for rec in records):
+            filename = np.array(
+                [intern(rec.get("filename", "")) for rec in records], dtype=np.int32
+            )
+
+        score = None
+        if any("score" in rec for rec in records):
+            score = np.array([rec.get("score", 1) for rec in records])
+
+        imgnum = None
+        if any("imgnum" in rec for rec in records):
+            imgnum = np.array([rec.get("imgnum", 0) for rec in records])
+
+        image_id = None
+        if any("image_id" in rec for rec in records):
+            image_id = np.array(
+                [rec.get("image_id", -1) for rec in records], dtype=np.int64
+            )
+
+        return cls(
+            np.stack([rec["joints_3d"] for rec in records]),
+            np.stack([rec["joints_3d_vis"] for rec in records]),
+            np.stack([np.asarray(rec["center"]) for rec in records]),
+            np.stack([np.asarray(rec["scale"]) for rec in records]),
+            np.array([path.encode("utf-8") for path in paths]),
+            image,
+            filename=filename,
+            score=score,
+            imgnum=imgnum,
+            image_id=image_id,
+        )
+
+    def save(self, db_dir):
+        """write every column as <db_dir>/<column>.npy"""
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        for column in COLUMNS + OPTIONAL_COLUMNS:
+            array = getattr(self, column)
+            if array is not None:
+                np.save(os.path.join(db_dir, column + ".npy"), array)
+
+    @classmethod
+    def load(cls, db_dir, mmap_mode=None):
+        """
+        read a db written by save, mmap_mode="r" maps the columns read-only
+        so that forked DataLoader workers share the same pages
+        """
+        columns = {}
+        for column in COLUMNS + OPTIONAL_COLUMNS:
+            file_name = os.path.join(db_dir, column + ".npy")
+            if os.path.exists(file_name):
+                columns[column] = np.load(file_name, mmap_mode=mmap_mode)
+        return cls(**columns)
+
+    def _path(self, idx):
+        return self.paths[idx].decode("utf-8")
+
+    def __len__(self):
+        return len(self.image)
+
+    def __getitem__(self, idx):
+        """record dict of views into the db, do not modify in place"""
+        rec = {
+            "image": self._path(self.image[idx]),
+            "center": self.center[idx],
+            "scale": self.scale[idx],
+            "joints_3d": self.joints_3d[idx],
+            "joints_3d_vis": self.joints_3d_vis[idx],
+        }
+        if self.filename is not None:
+            rec["filename"] = self._path(self.filename[idx])
+        if self.score is not None:
+            rec["score"] = self.score[idx]
+        if self.imgnum is not None:
+            rec["imgnum"] = self.imgnum[idx]
+        if self.image_id is not None:
+            rec["image_id"] = self.image_id[idx]
+        return rec
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def take(self, indices):
+        """new db with the rows at indices, sharing the path table"""
+        return JointsDB(
+            self.joints_3d[indices],
+            self.joints_3d_vis[indices],
+            self.center[indices],
+            self.scale[indices],
+            self.paths,
+            self.image[indices],
+            filename=None if self.filename is None else self.filename[indices],
+            score=None if self.score is None else self.score[indices],
+            imgnum=None if self.imgnum is None else self.imgnum[indices],
+            image_id=None if self.image_id is None else self.image_id[indices],
+        )
+
+    def sample(self, idx):
+        """
+        record for JointsDataset.__getitem__, with private copies of the
+        arrays it modifies in place (joints, visibility and center) or hands
+        to the DataLoader (scale), which may be read-only memory maps
+        """
+        rec = self[idx]
+        rec["joints_3d"] = rec["joints_3d"].copy()
+        rec["joints_3d_vis"] = rec["joints_3d_vis"].copy()
+        rec["center"] = rec["center"].copy()
+        rec["scale"] = rec["scale"].copy()
+        return rec
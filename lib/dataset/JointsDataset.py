@@ -6,18 +6,35 @@
 
 from __future__ import absolute_import, division, print_function
 
-import copy
+import hashlib
+import json
 import logging
+import os
 import random
+import shutil
+import tempfile
 
 import cv2
 import numpy as np
 import torch
+from dataset.JointsDB import JointsDB
 from torch.utils.data import Dataset
+from utils.heatmap import generate_gaussian_targets
 from utils.transforms import affine_transform, fliplr_joints, get_affine_transform
 
 logger = logging.getLogger(__name__)
 
+# bump when the records built by _get_db change, to invalidate old caches
+DB_CACHE_VERSION = 2
+
+
+def _file_hash(file_name):
+    sha1 = hashlib.sha1()
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
 
 class JointsDataset(Dataset):
     def __init__(self, cfg, root, image_set, is_train, transform=None):
@@ -44,15 +61,105 @@ class JointsDataset(Dataset):
         self.image_size = np.array(cfg.MODEL.IMAGE_SIZE)
         self.heatmap_size = np.array(cfg.MODEL.HEATMAP_SIZE)
         self.sigma = cfg.MODEL.SIGMA
+        self.subpixel_target = cfg.MODEL.SUBPIXEL_TARGET
+        self.target_on_device = cfg.MODEL.TARGET_ON_DEVICE or cfg.LOSS.SPARSE_TARGET
         self.use_different_joints_weight = cfg.LOSS.USE_DIFFERENT_JOINTS_WEIGHT
         self.joints_weight = 1
 
+        self.db_mmap = cfg.DATASET.DB_MMAP
+        self.db_cache_dir = cfg.DATASET.DB_CACHE_DIR
+
         self.transform = transform
         self.db = []
 
+    @property
+    def db(self):
+        return self._db
+
+    @db.setter
+    def db(self, db):
+        self._db = db if isinstance(db, JointsDB) else JointsDB.from_records(db)
+
     def _get_db(self):
         raise NotImplementedError
 
+    def get_db_cache_dir(self, cfg, ann_files, **fields):
+        """
+        cache entry of the finished db (after select_data), keyed by the
+        annotation file contents, the dataset and the cfg fields it depends on
+        """
+        key = {
+            "version": DB_CACHE_VERSION,
+            "dataset": type(self).__name__,
+            "root": self.root,
+            "image_set": self.image_set,
+            "is_train": self.is_train,
+            "data_format": self.data_format,
+            "image_size": list(cfg.MODEL.IMAGE_SIZE),
+            "select_data": cfg.DATASET.SELECT_DATA,
+            "ann_files": [_file_hash(file_name) for file_name in ann_files],
+        }
+        key.update(fields)
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8"))
+
+        cache_root = self.db_cache_dir or os.path.join(self.output_path, "db_cache")
+        return os.path.join(
+            cache_root,
+            "{}_{}_{}".format(
+                type(self).__name__, self.image_set, digest.hexdigest()[:16]
+            ),
+        )
+
+    def load_db_cache(self, cache_dir):
+        """
+        :return: (db, extras) written by save_db_cache, None on a cache miss
+        """
+        extras_file = os.path.join(cache_dir, "extras.json")
+        if not os.path.exists(extras_file):
+            return None
+
+        logger.info("=> loading db cache from {}".format(cache_dir))
+        db = JointsDB.load(cache_dir, mmap_mode="r" if self.db_mmap else None)
+        with open(extras_file, "r") as f:
+            extras = json.load(f)
+        return db, extras
+
+    def save_db_cache(self, cache_dir, extras):
+        """
+        :param extras: json serializable dataset state that __init__ needs
+            besides the db, e.g. categories and image ids
+        """
+        parent_dir = os.path.dirname(cache_dir)
+        if not os.path.exists(parent_dir):
+            os.makedirs(parent_dir, exist_ok=True)
+
+        tmp_dir = tempfile.mkdtemp(prefix="tmp_", dir=parent_dir)
+        self.db.save(tmp_dir)
+        with open(os.path.join(tmp_dir, "extras.json"), "w") as f:
+            json.dump(extras, f)
+        try:
+            os.rename(tmp_dir, cache_dir)
+            logger.info("=> saved db cache to {}".format(cache_dir))
+        except OSError:
+            # another process wrote the same entry first
+            shutil.rmtree(tmp_dir)
+
+    def memmap_db(self):
+        """
+        move the db columns to disk and map them back read-only, so that
+        forked DataLoader workers share the pages instead of copying them
+        """
+        if isinstance(self.db.joints_3d, np.memmap):
+            return
+
+        db_dir = tempfile.mkdtemp(prefix="db_", dir=self.db_cache_dir or None)
+        try:
+            self.db.save(db_dir)
+            self.db = JointsDB.load(db_dir, mmap_mode="r")
+        finally:
+            # the mappings stay valid once the files are unlinked
+            shutil.rmtree(db_dir)
+
     def evaluate(self, cfg, preds, output_dir, *args, **kwargs):
         raise NotImplementedError
 
@@ -102,11 +209,12 @@ class JointsDataset(Dataset):
         return len(self.db)
 
     def __getitem__(self, idx):
-        db_rec = copy.deepcopy(self.db[idx])
+        db_rec = self.db.sample(idx)
 
         image_file = db_rec["image"]
         filename = db_rec["filename"] if "filename" in db_rec else ""
         imgnum = db_rec["imgnum"] if "imgnum" in db_rec else ""
+        image_id = db_rec["image_id"] if "image_id" in db_rec else -1
 
         if self.data_format == "zip":
             from utils import zipreader
@@ -175,15 +283,21 @@ class JointsDataset(Dataset):
             if joints_vis[i, 0] > 0.0:
                 joints[i, 0:2] = affine_transform(joints[i, 0:2], trans)
 
-        target, target_weight = self.generate_target(joints, joints_vis)
+        if self.target_on_device:
+            # rendered batch-wise from meta["joints"], see core.target
+            target = torch.zeros(0)
+            target_weight = torch.zeros(0)
+        else:
+            target, target_weight = self.generate_target(joints, joints_vis)
 
-        target = torch.from_numpy(target)
-        target_weight = torch.from_numpy(target_weight)
+            target = torch.from_numpy(target)
+            target_weight = torch.from_numpy(target_weight)
 
         meta = {
             "image": image_file,
             "filename": filename,
             "imgnum": imgnum,
+            "image_id": image_id,
             "joints": joints,
             "joints_vis": joints_vis,
             "center": c,
@@ -195,36 +309,37 @@ class JointsDataset(Dataset):
         return input, target, target_weight, meta
 
     def select_data(self, db):
-        db_selected = []
-        for rec in db:
-            num_vis = 0
-            joints_x = 0.0
-            joints_y = 0.0
-            for joint, joint_vis in zip(rec["joints_3d"], rec["joints_3d_vis"]):
-                if joint_vis[0] <= 0:
-                    continue
-                num_vis += 1
-
-                joints_x += joint[0]
-                joints_y += joint[1]
-            if num_vis == 0:
-                continue
-
-            joints_x, joints_y = joints_x / num_vis, joints_y / num_vis
-
-            area = rec["scale"][0] * rec["scale"][1] * (self.pixel_std**2)
-            joints_center = np.array([joints_x, joints_y])
-            bbox_center = np.array(rec["center"])
-            diff_norm2 = np.linalg.norm((joints_center - bbox_center), 2)
+        """
+        keep the instances whose box center lies close enough to the mean of
+        their visible joints, relative to the box area and number of joints
+        """
+        if not isinstance(db, JointsDB):
+            db = JointsDB.from_records(db)
+        if len(db) == 0:
+            return db
+
+        vis = db.joints_3d_vis[:, :, 0] > 0
+        num_vis = vis.sum(axis=1)
+
+        # cumsum adds the joints one after the other, in the db dtype, so the
+        # centroids round exactly like a running sum over the joints would
+        joints_xy = np.where(vis[:, :, None], db.joints_3d[:, :, 0:2], 0)
+        joints_sum = np.cumsum(joints_xy, axis=1)[:, -1]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            joints_center = joints_sum / num_vis.astype(joints_sum.dtype)[:, None]
+
+        area = db.scale[:, 0] * db.scale[:, 1] * (self.pixel_std**2)
+        diff = joints_center - db.center
+        diff_norm2 = np.sqrt(diff[:, 0] * diff[:, 0] + diff[:, 1] * diff[:, 1])
+        with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
             ks = np.exp(-1.0 * (diff_norm2**2) / ((0.2) ** 2 * 2.0 * area))
 
-            metric = (0.2 / 16) * num_vis + 0.45 - 0.2 / 16
-            if ks > metric:
-                db_selected.append(rec)
+        metric = (0.2 / 16) * num_vis + 0.45 - 0.2 / 16
+        selected = np.nonzero((num_vis > 0) & (ks > metric))[0]
 
         logger.info("=> num db: {}".format(len(db)))
-        logger.info("=> num selected db: {}".format(len(db_selected)))
-        return db_selected
+        logger.info("=> num selected db: {}".format(len(selected)))
+        return db.take(selected)
 
     def generate_target(self, joints, joints_vis):
         """
@@ -232,55 +347,16 @@ class JointsDataset(Dataset):
         :param joints_vis: [num_joints, 3]
         :return: target, target_weight(1: visible, 0: invisible)
         """
-        target_weight = np.ones((self.num_joints, 1), dtype=np.float32)
-        target_weight[:, 0] = joints_vis[:, 0]
-
         assert self.target_type == "gaussian", "Only support gaussian map now!"
 
-        if self.target_type == "gaussian":
-            target = np.zeros(
-                (self.num_joints, self.heatmap_size[1], self.heatmap_size[0]),
-                dtype=np.float32,
-            )
-
-            tmp_size = self.sigma * 3
-            for joint_id in range(self.num_joints):
-                feat_stride = self.image_size / self.heatmap_size
-                mu_x = int(joints[joint_id][0] / feat_stride[0] + 0.5)
-                mu_y = int(joints[joint_id][1] / feat_stride[1] + 0.5)
-                # Check that any part of the gaussian is in-bounds
-                ul = [int(mu_x - tmp_size), int(mu_y - tmp_size)]
-                br = [int(mu_x + tmp_size + 1), int(mu_y + tmp_size + 1)]
-                if (
-                    ul[0] >= self.heatmap_size[0]
-                    or ul[1] >= self.heatmap_size[1]
-                    or br[0] < 0
-                    or br[1] < 0
-                ):
-                    # If not, just return the image as is
-                    target_weight[joint_id] = 0
-                    continue
-
-                # # Generate gaussian
-                size = 2 * tmp_size + 1
-                x = np.arange(0, size, 1, np.float32)
-                y = x[:, np.newaxis]
-                x0 = y0 = size // 2
-                # The gaussian is not normalized, we want the center value to equal 1
-                g = np.exp(-((x - x0) ** 2 + (y - y0) ** 2) / (2 * self.sigma**2))
-
-                # Usable gaussian range
-                g_x = max(0, -ul[0]), min(br[0], self.heatmap_size[0]) - ul[0]
-                g_y = max(0, -ul[1]), min(br[1], self.heatmap_size[1]) - ul[1]
-                # Image range
-                img_x = max(0, ul[0]), min(br[0], self.heatmap_size[0])
-                img_y = max(0, ul[1]), min(br[1], self.heatmap_size[1])
-
-                v = target_weight[joint_id]
-                if v > 0.5:
-                    target[joint_id][img_y[0] : img_y[1], img_x[0] : img_x[1]] = g[
-                        g_y[0] : g_y[1], g_x[0] : g_x[1]
-                    ]
+        target, target_weight = generate_gaussian_targets(
+            joints,
+            joints_vis,
+            self.image_size,
+            self.heatmap_size,
+            self.sigma,
+            subpixel=self.subpixel_target,
+        )
 
         if self.use_different_joints_weight:
             target_weight = np.multiply(target_weight, self.joints_weight)
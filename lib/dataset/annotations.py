@@ -0,0 +1,123 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+
+def load_coco_objs(coco, image_ids):
+    """
+    non-crowd annotations of all image_ids, in the order the per image
+    _load_coco_keypoint_annotation_kernal visits them
+    :param coco: pycocotools COCO index
+    :param image_ids: coco image ids
+    :return: objs, obj_image_ids [num_objs], widths [num_objs], heights [num_objs]
+    """
+    if len(image_ids) == 0:
+        # getAnnIds returns every annotation for an empty id list
+        objs = []
+    else:
+        objs = coco.loadAnns(coco.getAnnIds(imgIds=list(image_ids), iscrowd=False))
+
+    obj_image_ids = np.array([obj["image_id"] for obj in objs], dtype=np.int64)
+    widths = np.array([coco.imgs[obj["image_id"]]["width"] for obj in objs])
+    heights = np.array([coco.imgs[obj["image_id"]]["height"] for obj in objs])
+    return objs, obj_image_ids, widths, heights
+
+
+def objs_array(objs, key, num_columns):
+    """
+    :return: [num_objs, num_columns] float64 array of obj[key] (a flat list)
+    """
+    return np.array([obj[key] for obj in objs], dtype=np.float64).reshape(
+        len(objs), num_columns
+    )
+
+
+def named_keypoints_array(objs, names):
+    """
+    flatten the name-keyed {"x", "y", "v"} keypoint dicts of infinity
+    annotations into coco-style triplets
+    :return: [num_objs, len(names) * 3] float64
+    """
+    return np.array(
+        [
+            [obj["keypoints"][name][c] for name in names for c in ("x", "y", "v")]
+            for obj in objs
+        ],
+        dtype=np.float64,
+    ).reshape(len(objs), len(names) * 3)
+
+
+def sanitize_bboxes(bboxes, widths, heights):
+    """
+    clip boxes to their image, as done per object in the annotation kernels
+    :param bboxes: [num_objs, 4] x, y, w, h
+    :param widths: [num_objs] width of the image of each box
+    :param heights: [num_objs] height of the image of each box
+    :return: clean_bboxes [num_objs, 4], valid [num_objs] bool
+    """
+    x, y, w, h = bboxes.T
+    x1 = np.maximum(0, x)
+    y1 = np.maximum(0, y)
+    x2 = np.minimum(widths - 1, x1 + np.maximum(0, w - 1))
+    y2 = np.minimum(heights - 1, y1 + np.maximum(0, h - 1))
+    clean_bboxes = np.stack([x1, y1, x2 - x1, y2 - y1], axis=1)
+    return clean_bboxes, (x2 >= x1) & (y2 >= y1)
+
+
+def xywh2cs(bboxes, aspect_ratio, pixel_std):
+    """
+    batched JointsDataset._xywh2cs
+    :param bboxes: [num_objs, 4] x, y, w, h
+    :return: center [num_objs, 2], scale [num_objs, 2]
+    """
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    x, y, w, h = bboxes.T
+    center = np.stack([x + w * 0.5, y + h * 0.5], axis=1).astype(np.float32)
+
+    wide = w > aspect_ratio * h
+    tall = w < aspect_ratio * h
+    h = np.where(wide, w * 1.0 / aspect_ratio, h)
+    w = np.where(tall, h * aspect_ratio, w)
+    scale = (np.stack([w, h], axis=1) * 1.0 / pixel_std).astype(np.float32)
+    scale = np.where(center[:, 0:1] != -1, scale * np.float32(1.25), scale)
+
+    return center, scale
+
+
+def keypoints_to_joints(keypoints, num_joints):
+    """
+    :param keypoints: [num_objs, >= num_joints * 3] coco-style x, y, v triplets
+    :return: joints_3d, joints_3d_vis [num_objs, num_joints, 3], with the
+        visibility flags clamped to 1
+    """
+    keypoints = keypoints[:, : num_joints * 3].reshape(-1, num_joints, 3)
+
+    joints_3d = np.zeros((len(keypoints), num_joints, 3), dtype=np.float32)
+    joints_3d[:, :, 0:2] = keypoints[:, :, 0:2]
+
+    joints_3d_vis = np.zeros((len(keypoints), num_joints, 3), dtype=np.float32)
+    joints_3d_vis[:, :, 0:2] = np.minimum(keypoints[:, :, 2:3], 1)
+
+    return joints_3d, joints_3d_vis
+
+
+def build_records(images, image_ids, center, scale, joints_3d, joints_3d_vis):
+    """ground truth db entries, as returned by the annotation kernels"""
+    return [
+        {
+            "image": images[i],
+            "image_id": image_ids[i],
+            "center": center[i],
+            "scale": scale[i],
+            "joints_3d": joints_3d[i],
+            "joints_3d_vis": joints_3d_vis[i],
+            "filename": "",
+            "imgnum": 0,
+        }
+        for i in range(len(images))
+    ]
@@ -8,14 +8,28 @@ from __future__ import absolute_import, division, print_function
 
 import logging
 import os
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict
 
 import json_tricks as json
 import numpy as np
+from dataset.annotations import (
+    build_records,
+    keypoints_to_joints,
+    load_coco_objs,
+    objs_array,
+    sanitize_bboxes,
+    xywh2cs,
+)
+from dataset.coco_eval import ParallelCOCOeval
 from dataset.JointsDataset import JointsDataset
-from nms.nms import oks_nms, soft_oks_nms
+from dataset.keypoint_results import (
+    keypoint_annotations,
+    keypoint_nms,
+    select_results,
+    write_keypoint_results,
+)
+from nms.nms import COCO_SIGMAS
 from pycocotools.coco import COCO
-from pycocotools.cocoeval import COCOeval
 
 logger = logging.getLogger(__name__)
 
@@ -57,6 +71,8 @@ class COCODataset(JointsDataset):
         self.soft_nms = cfg.TEST.SOFT_NMS
         self.oks_thre = cfg.TEST.OKS_THRE
         self.in_vis_thre = cfg.TEST.IN_VIS_THRE
+        self.save_results = cfg.TEST.SAVE_RESULTS
+        self.eval_workers = cfg.TEST.EVAL_WORKERS
         self.bbox_file = cfg.TEST.COCO_BBOX_FILE
         self.use_gt_bbox = cfg.TEST.USE_GT_BBOX
         self.image_width = cfg.MODEL.IMAGE_SIZE[0]
@@ -64,15 +80,33 @@ class COCODataset(JointsDataset):
         self.aspect_ratio = self.image_width * 1.0 / self.image_height
         self.pixel_std = 200
 
-        self.coco = COCO(self._get_ann_file_keypoint())
+        self._coco = None
+
+        cache_dir = None
+        cached = None
+        if cfg.DATASET.DB_CACHE:
+            ann_files = [self._get_ann_file_keypoint()]
+            if not (is_train or self.use_gt_bbox):
+                ann_files.append(self.bbox_file)
+            cache_dir = self.get_db_cache_dir(
+                cfg, ann_files, use_gt_bbox=self.use_gt_bbox, image_thre=self.image_thre
+            )
+            cached = self.load_db_cache(cache_dir)
+
+        if cached is None:
+            coco_cats = self.coco.loadCats(self.coco.getCatIds())
+            self.image_set_index = self._load_image_set_index()
+        else:
+            coco_cats = cached[1]["cats"]
+            self.image_set_index = cached[1]["image_set_index"]
 
         # deal with class names
-        cats = [cat["name"] for cat in self.coco.loadCats(self.coco.getCatIds())]
+        cats = [cat["name"] for cat in coco_cats]
         self.classes = ["__background__"] + cats
         logger.info("=> classes: {}".format(self.classes))
         self.num_classes = len(self.classes)
         self._class_to_ind = dict(zip(self.classes, range(self.num_classes)))
-        self._class_to_coco_ind = dict(zip(cats, self.coco.getCatIds()))
+        self._class_to_coco_ind = dict(zip(cats, [cat["id"] for cat in coco_cats]))
         self._coco_ind_to_class_ind = dict(
             [
                 (self._class_to_coco_ind[cls], self._class_to_ind[cls])
@@ -81,11 +115,11 @@ class COCODataset(JointsDataset):
         )
 
         # load image file names
-        self.image_set_index = self._load_image_set_index()
         self.num_images = len(self.image_set_index)
         logger.info("=> num_images: {}".format(self.num_images))
 
         self.num_joints = 17
+        self.oks_sigmas = COCO_SIGMAS
         self.flip_pairs = [
             [1, 2],
             [3, 4],
@@ -123,13 +157,32 @@ class COCODataset(JointsDataset):
             dtype=np.float32,
         ).reshape((self.num_joints, 1))
 
-        self.db = self._get_db()
+        if cached is None:
+            self.db = self._get_db()
 
-        if is_train and cfg.DATASET.SELECT_DATA:
-            self.db = self.select_data(self.db)
+            if is_train and cfg.DATASET.SELECT_DATA:
+                self.db = self.select_data(self.db)
+
+            if cache_dir:
+                self.save_db_cache(
+                    cache_dir,
+                    {"cats": coco_cats, "image_set_index": self.image_set_index},
+                )
+        else:
+            self.db = cached[0]
+
+        if cfg.DATASET.DB_MMAP:
+            self.memmap_db()
 
         logger.info("=> load {} samples".format(len(self.db)))
 
+    @property
+    def coco(self):
+        """pycocotools index of the annotation file, parsed on first use"""
+        if self._coco is None:
+            self._coco = COCO(self._get_ann_file_keypoint())
+        return self._coco
+
     def _get_ann_file_keypoint(self):
         """self.root / annotations / person_keypoints_train2017.json"""
         prefix = "person_keypoints" if "test" not in self.image_set else "image_info"
@@ -153,13 +206,53 @@ class COCODataset(JointsDataset):
 
     def _load_coco_keypoint_annotations(self):
         """ground truth bbox and keypoints"""
-        gt_db = []
-        for index in self.image_set_index:
-            gt_db.extend(self._load_coco_keypoint_annotation_kernal(index))
+        gt_db, _ = self._load_coco_keypoint_annotations_bulk(self.image_set_index)
         return gt_db
 
+    def _load_coco_keypoint_annotations_bulk(self, image_ids):
+        """
+        _load_coco_keypoint_annotation_kernal over all image_ids at once,
+        with the per object loops replaced by array operations
+        :param image_ids: coco image ids
+        :return: db entries, coco image id of each entry
+        """
+        objs, obj_image_ids, widths, heights = load_coco_objs(self.coco, image_ids)
+        if len(objs) == 0:
+            return [], obj_image_ids
+
+        clean_bboxes, valid = sanitize_bboxes(
+            objs_array(objs, "bbox", 4), widths, heights
+        )
+        areas = np.array([obj["area"] for obj in objs])
+        classes = np.array(
+            [self._coco_ind_to_class_ind[obj["category_id"]] for obj in objs]
+        )
+        keypoints = objs_array(objs, "keypoints", len(objs[0]["keypoints"]))
+
+        # ignore objs without keypoints annotation
+        keep = valid & (areas > 0) & (classes == 1) & (keypoints.max(axis=1) != 0)
+
+        center, scale = xywh2cs(clean_bboxes[keep], self.aspect_ratio, self.pixel_std)
+        joints_3d, joints_3d_vis = keypoints_to_joints(keypoints[keep], self.num_joints)
+
+        image_paths = {}
+        images = []
+        for index in obj_image_ids[keep].tolist():
+            if index not in image_paths:
+                image_paths[index] = self.image_path_from_index(index)
+            images.append(image_paths[index])
+
+        rec = build_records(
+            images, obj_image_ids[keep], center, scale, joints_3d, joints_3d_vis
+        )
+        return rec, obj_image_ids[keep]
+
     def _load_coco_keypoint_annotation_kernal(self, index):
         """
+        per image reference of _load_coco_keypoint_annotations_bulk, the
+        dataset no longer calls it. Only kept for the annotations parity check
+        in tools/benchmark.py, which also reaches it through the per image
+        reference of InfinityCocoDataset
         coco ann: [u'segmentation', u'area', u'iscrowd', u'image_id', u'bbox', u'category_id', u'id']
         iscrowd:
             crowd instances are handled by marking their overlaps with all categories to -1
@@ -216,6 +309,7 @@ class COCODataset(JointsDataset):
             rec.append(
                 {
                     "image": self.image_path_from_index(index),
+                    "image_id": index,
                     "center": center,
                     "scale": scale,
                     "joints_3d": joints_3d,
@@ -294,6 +388,7 @@ class COCODataset(JointsDataset):
             kpt_db.append(
                 {
                     "image": img_name,
+                    "image_id": det_res["image_id"],
                     "center": center,
                     "scale": scale,
                     "score": score,
@@ -309,8 +404,24 @@ class COCODataset(JointsDataset):
         )
         return kpt_db
 
-    def evaluate(self, cfg, preds, output_dir, all_boxes, img_path, *args, **kwargs):
+    def evaluate(
+        self,
+        cfg,
+        preds,
+        output_dir,
+        all_boxes,
+        img_path,
+        *args,
+        image_ids=None,
+        **kwargs
+    ):
+        """
+        :param image_ids: [N] int image id of each detection, from meta. When
+            None, parsed from the file names in img_path as before
+        """
         rank = cfg.RANK
+        if image_ids is None:
+            image_ids = [int(path[-16:-4]) for path in img_path]
 
         res_folder = os.path.join(output_dir, "results")
         if not os.path.exists(res_folder):
@@ -323,133 +434,44 @@ class COCODataset(JointsDataset):
             res_folder, "keypoints_{}_results_{}.json".format(self.image_set, rank)
         )
 
-        # person x (keypoints)
-        _kpts = []
-        for idx, kpt in enumerate(preds):
-            _kpts.append(
-                {
-                    "keypoints": kpt,
-                    "center": all_boxes[idx][0:2],
-                    "scale": all_boxes[idx][2:4],
-                    "area": all_boxes[idx][4],
-                    "score": all_boxes[idx][5],
-                    "image": int(img_path[idx][-16:-4]),
-                }
-            )
-        # image x person x (keypoints)
-        kpts = defaultdict(list)
-        for kpt in _kpts:
-            kpts[kpt["image"]].append(kpt)
-
-        # rescoring and oks nms
-        num_joints = self.num_joints
-        in_vis_thre = self.in_vis_thre
-        oks_thre = self.oks_thre
-        oks_nmsed_kpts = []
-        for img in kpts.keys():
-            img_kpts = kpts[img]
-            for n_p in img_kpts:
-                box_score = n_p["score"]
-                kpt_score = 0
-                valid_num = 0
-                for n_jt in range(0, num_joints):
-                    t_s = n_p["keypoints"][n_jt][2]
-                    if t_s > in_vis_thre:
-                        kpt_score = kpt_score + t_s
-                        valid_num = valid_num + 1
-                if valid_num != 0:
-                    kpt_score = kpt_score / valid_num
-                # rescoring
-                n_p["score"] = kpt_score * box_score
-
-            if self.soft_nms:
-                keep = soft_oks_nms(
-                    [img_kpts[i] for i in range(len(img_kpts))], oks_thre
-                )
-            else:
-                keep = oks_nms([img_kpts[i] for i in range(len(img_kpts))], oks_thre)
+        # rescoring and oks nms, on arrays of all the detections
+        kpts = preds[:, : self.num_joints]
+        keep, scores = keypoint_nms(
+            kpts,
+            all_boxes,
+            image_ids,
+            self.in_vis_thre,
+            self.oks_thre,
+            self.soft_nms,
+            self.oks_sigmas,
+        )
+        results = select_results(kpts, all_boxes, image_ids, scores, keep)
+        cat_id = self._class_to_coco_ind[self.classes[1]]
 
-            if len(keep) == 0:
-                oks_nmsed_kpts.append(img_kpts)
-            else:
-                oks_nmsed_kpts.append([img_kpts[_keep] for _keep in keep])
+        if self.save_results or "test" in self.image_set:
+            self._write_coco_keypoint_results(results, cat_id, res_file)
+            coco_results = res_file
+        else:
+            # handed to COCO.loadRes in memory, without a json round trip
+            coco_results = keypoint_annotations(results, cat_id)
 
-        self._write_coco_keypoint_results(oks_nmsed_kpts, res_file)
         if "test" not in self.image_set:
-            info_str = self._do_python_keypoint_eval(res_file, res_folder)
+            info_str = self._do_python_keypoint_eval(coco_results, res_folder)
             name_value = OrderedDict(info_str)
             return name_value, name_value["AP"]
         else:
             return {"Null": 0}, 0
 
-    def _write_coco_keypoint_results(self, keypoints, res_file):
-        data_pack = [
-            {
-                "cat_id": self._class_to_coco_ind[cls],
-                "cls_ind": cls_ind,
-                "cls": cls,
-                "ann_type": "keypoints",
-                "keypoints": keypoints,
-            }
-            for cls_ind, cls in enumerate(self.classes)
-            if not cls == "__background__"
-        ]
-
-        results = self._coco_keypoint_results_one_category_kernel(data_pack[0])
+    def _write_coco_keypoint_results(self, results, cat_id, res_file):
         logger.info("=> writing results json to %s" % res_file)
-        with open(res_file, "w") as f:
-            json.dump(results, f, sort_keys=True, indent=4)
-        try:
-            json.load(open(res_file))
-        except Exception:
-            content = []
-            with open(res_file, "r") as f:
-                for line in f:
-                    content.append(line)
-            content[-1] = "]"
-            with open(res_file, "w") as f:
-                for c in content:
-                    f.write(c)
-
-    def _coco_keypoint_results_one_category_kernel(self, data_pack):
-        cat_id = data_pack["cat_id"]
-        keypoints = data_pack["keypoints"]
-        cat_results = []
-
-        for img_kpts in keypoints:
-            if len(img_kpts) == 0:
-                continue
-
-            _key_points = np.array(
-                [img_kpts[k]["keypoints"] for k in range(len(img_kpts))]
-            )
-            key_points = np.zeros(
-                (_key_points.shape[0], self.num_joints * 3), dtype=np.float
-            )
-
-            for ipt in range(self.num_joints):
-                key_points[:, ipt * 3 + 0] = _key_points[:, ipt, 0]
-                key_points[:, ipt * 3 + 1] = _key_points[:, ipt, 1]
-                key_points[:, ipt * 3 + 2] = _key_points[:, ipt, 2]  # keypoints score.
-
-            result = [
-                {
-                    "image_id": img_kpts[k]["image"],
-                    "category_id": cat_id,
-                    "keypoints": list(key_points[k]),
-                    "score": img_kpts[k]["score"],
-                    "center": list(img_kpts[k]["center"]),
-                    "scale": list(img_kpts[k]["scale"]),
-                }
-                for k in range(len(img_kpts))
-            ]
-            cat_results.extend(result)
-
-        return cat_results
+        write_keypoint_results(results, cat_id, res_file)
 
     def _do_python_keypoint_eval(self, res_file, res_folder):
+        """
+        :param res_file: results json file, or the list of result dicts
+        """
         coco_dt = self.coco.loadRes(res_file)
-        coco_eval = COCOeval(self.coco, coco_dt, "keypoints")
+        coco_eval = ParallelCOCOeval(self.coco, coco_dt, "keypoints", self.eval_workers)
         coco_eval.params.useSegm = None
         coco_eval.evaluate()
         coco_eval.accumulate()
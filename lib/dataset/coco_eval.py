@@ -0,0 +1,121 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import, division, print_function
+
+import copy
+import multiprocessing
+import time
+
+import numpy as np
+from pycocotools.cocoeval import COCOeval
+
+# the evaluator of the pool workers, set by their initializer
+_worker_eval = None
+
+
+def _init_worker(coco_eval):
+    global _worker_eval
+    _worker_eval = coco_eval
+
+
+def _evaluate_images(img_ids):
+    """
+    COCOeval.evaluate() of a part of the images
+    :return: the ious of the images, and their evalImgs as
+        [num_cats * num_area_rngs] lists of len(img_ids)
+    """
+    p = _worker_eval.params
+    compute_iou = (
+        _worker_eval.computeOks if p.iouType == "keypoints" else _worker_eval.computeIoU
+    )
+    cat_ids = p.catIds if p.useCats else [-1]
+    ious = {
+        (img_id, cat_id): compute_iou(img_id, cat_id)
+        for img_id in img_ids
+        for cat_id in cat_ids
+    }
+    # evaluateImg reads the ious of its image from the evaluator
+    _worker_eval.ious = ious
+    max_det = p.maxDets[-1]
+    eval_imgs = [
+        [
+            _worker_eval.evaluateImg(img_id, cat_id, area_rng, max_det)
+            for img_id in img_ids
+        ]
+        for cat_id in cat_ids
+        for area_rng in p.areaRng
+    ]
+    return ious, eval_imgs
+
+
+class ParallelCOCOeval(COCOeval):
+    """
+    COCOeval whose evaluate() computes the per image ious and matching of
+    parts of the images in a process pool. The parts are merged back in the
+    order of COCOeval, so accumulate() and summarize() give the same numbers
+    """
+
+    def __init__(self, cocoGt=None, cocoDt=None, iouType="keypoints", num_workers=0):
+        """
+        :param num_workers: processes of the pool, evaluate() of COCOeval in
+            this process for 0 or 1
+        """
+        super(ParallelCOCOeval, self).__init__(cocoGt, cocoDt, iouType)
+        self.num_workers = num_workers
+
+    def evaluate(self):
+        if self.num_workers <= 1:
+            return super(ParallelCOCOeval, self).evaluate()
+
+        tic = time.time()
+        print("Running per image evaluation...")
+        p = self.params
+        # add backward compatibility if useSegm is specified in params
+        if p.useSegm is not None:
+            p.iouType = "segm" if p.useSegm == 1 else "bbox"
+            print(
+                "useSegm (deprecated) is not None. Running {} evaluation".format(
+                    p.iouType
+                )
+            )
+        print("Evaluate annotation type *{}*".format(p.iouType))
+        p.imgIds = list(np.unique(p.imgIds))
+        if p.useCats:
+            p.catIds = list(np.unique(p.catIds))
+        p.maxDets = sorted(p.maxDets)
+        self.params = p
+
+        self._prepare()
+
+        # a few parts per worker, for the images with many detections
+        parts = [
+            list(part)
+            for part in np.array_split(p.imgIds, 4 * self.num_workers)
+            if len(part)
+        ]
+        # forked workers share the prepared gts and dts instead of pickling
+        ctx = multiprocessing.get_context(
+            "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+        )
+        with ctx.Pool(
+            self.num_workers, initializer=_init_worker, initargs=(self,)
+        ) as pool:
+            outputs = pool.map(_evaluate_images, parts)
+
+        self.ious = {}
+        for ious, _ in outputs:
+            self.ious.update(ious)
+        # [cat][area_rng][img], as COCOeval lists them
+        num_groups = len(outputs[0][1]) if outputs else 0
+        self.evalImgs = [
+            eval_img
+            for group in range(num_groups)
+            for _, eval_imgs in outputs
+            for eval_img in eval_imgs[group]
+        ]
+        self._paramsEval = copy.deepcopy(self.params)
+        toc = time.time()
+        print("DONE (t={:0.2f}s).".format(toc - tic))
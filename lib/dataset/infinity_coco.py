@@ -8,15 +8,30 @@ from __future__ import absolute_import, division, print_function
 
 import logging
 import os
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict
 
 import json_tricks as json
 import numpy as np
+from dataset.annotations import (
+    build_records,
+    keypoints_to_joints,
+    load_coco_objs,
+    named_keypoints_array,
+    objs_array,
+    sanitize_bboxes,
+    xywh2cs,
+)
 from dataset.coco import COCODataset
+from dataset.coco_eval import ParallelCOCOeval
 from dataset.JointsDataset import JointsDataset
-from nms.nms import oks_nms, soft_oks_nms
+from dataset.keypoint_results import (
+    keypoint_annotations,
+    keypoint_nms,
+    select_results,
+    write_keypoint_results,
+)
+from nms.nms import COCO_SIGMAS
 from pycocotools.coco import COCO
-from pycocotools.cocoeval import COCOeval
 
 logger = logging.getLogger(__name__)
 
@@ -54,6 +69,8 @@ class InfinityCocoDataset(JointsDataset):
         self.soft_nms = cfg.TEST.SOFT_NMS
         self.oks_thre = cfg.TEST.OKS_THRE
         self.in_vis_thre = cfg.TEST.IN_VIS_THRE
+        self.save_results = cfg.TEST.SAVE_RESULTS
+        self.eval_workers = cfg.TEST.EVAL_WORKERS
         self.bbox_file = cfg.TEST.COCO_BBOX_FILE
         self.use_gt_bbox = cfg.TEST.USE_GT_BBOX
         self.image_width = cfg.MODEL.IMAGE_SIZE[0]
@@ -62,19 +79,51 @@ class InfinityCocoDataset(JointsDataset):
         self.aspect_ratio = self.image_width * 1.0 / self.image_height
         self.pixel_std = 200
 
-        self.coco = COCO(self._get_ann_file_keypoint())
-        self.coco_dataset = COCODataset(
-            cfg, root, image_set, is_train, transform, infinity=True
-        )
+        self._coco = None
+
+        cache_dir = None
+        cached = None
+        if cfg.DATASET.DB_CACHE:
+            ann_files = [self._get_ann_file_keypoint()]
+            if not (is_train or self.use_gt_bbox):
+                ann_files.append(self.bbox_file)
+            else:
+                # the coco annotations are read along with the ground truth
+                ann_files.append(
+                    os.path.join(
+                        cfg.DATASET.ROOT_COCO,
+                        "annotations",
+                        "person_keypoints_" + cfg.DATASET.TRAIN_SET_COCO + ".json",
+                    )
+                )
+            cache_dir = self.get_db_cache_dir(
+                cfg,
+                ann_files,
+                use_gt_bbox=self.use_gt_bbox,
+                image_thre=self.image_thre,
+                coco_infinity_ratio=self.coco_infinity_ratio,
+                # the cached coco image paths are under ROOT_COCO
+                root_coco=cfg.DATASET.ROOT_COCO,
+                train_set_coco=cfg.DATASET.TRAIN_SET_COCO,
+            )
+            cached = self.load_db_cache(cache_dir)
+
+        if cached is None:
+            coco_cats = self.coco.loadCats(self.coco.getCatIds())
+            self.keypoints_name = self.coco.loadCats(0)[0]["augmented_keypoints"]
+            self.image_set_index = self._load_image_set_index()
+        else:
+            coco_cats = cached[1]["cats"]
+            self.keypoints_name = cached[1]["keypoints_name"]
+            self.image_set_index = cached[1]["image_set_index"]
 
         # deal with class names
-        cats = [cat["id"] for cat in self.coco.loadCats(self.coco.getCatIds())]
-        self.keypoints_name = self.coco.loadCats(0)[0]["augmented_keypoints"]
+        cats = [cat["id"] for cat in coco_cats]
         self.classes = ["__background__"] + cats
         logger.info("=> classes: {}".format(self.classes))
         self.num_classes = len(self.classes)
         self._class_to_ind = dict(zip(self.classes, range(self.num_classes)))
-        self._class_to_coco_ind = dict(zip(cats, self.coco.getCatIds()))
+        self._class_to_coco_ind = dict(zip(cats, [cat["id"] for cat in coco_cats]))
         self._coco_ind_to_class_ind = dict(
             [
                 (self._class_to_coco_ind[cls], self._class_to_ind[cls])
@@ -83,13 +132,17 @@ class InfinityCocoDataset(JointsDataset):
         )
 
         # load image file names
-        self.image_set_index = self._load_image_set_index()
         self.num_images = len(self.image_set_index)
         logger.info("=> num_images: {}".format(self.num_images))
 
         self.num_joints_infinity = 36
         self.num_joints_coco = 17
         self.num_joints = self.num_joints_infinity + self.num_joints_coco
+        # coco sigmas, and their mean for the infinity markers as in
+        # InfinityDataset
+        self.oks_sigmas = np.concatenate(
+            [COCO_SIGMAS, np.full(self.num_joints_infinity, COCO_SIGMAS.mean())]
+        )
 
         self.flip_pairs_infinity = [
             [1, 2],
@@ -208,13 +261,40 @@ class InfinityCocoDataset(JointsDataset):
         self.joints_weight = np.vstack(
             (self.joints_weight_coco, self.joints_weight_infinity)
         )
-        self.db = self._get_db()
+        if cached is None:
+            if is_train or self.use_gt_bbox:
+                self.coco_dataset = COCODataset(
+                    cfg, root, image_set, is_train, transform, infinity=True
+                )
+            self.db = self._get_db()
+
+            if is_train and cfg.DATASET.SELECT_DATA:
+                self.db = self.select_data(self.db)
+
+            if cache_dir:
+                self.save_db_cache(
+                    cache_dir,
+                    {
+                        "cats": coco_cats,
+                        "keypoints_name": self.keypoints_name,
+                        "image_set_index": self.image_set_index,
+                    },
+                )
+        else:
+            self.db = cached[0]
 
-        if is_train and cfg.DATASET.SELECT_DATA:
-            self.db = self.select_data(self.db)
+        if cfg.DATASET.DB_MMAP:
+            self.memmap_db()
 
         logger.info("=> load {} samples".format(len(self.db)))
 
+    @property
+    def coco(self):
+        """pycocotools index of the annotation file, parsed on first use"""
+        if self._coco is None:
+            self._coco = COCO(self._get_ann_file_keypoint())
+        return self._coco
+
     def _get_ann_file_keypoint(self):
         """self.root / annotations / person_keypoints_train2017.json"""
         return os.path.join(self.root, self.image_set, "annotations.json")
@@ -235,26 +315,87 @@ class InfinityCocoDataset(JointsDataset):
 
     def _load_coco_keypoint_annotations(self):
         """ground truth bbox and keypoints"""
-        gt_db = []
-        indices_coco = []
         iter_coco = iter(self.coco_dataset.image_set_index)
         batch_indices_coco = [
             [next(iter_coco) for _ in range(self.coco_infinity_ratio)]
             for _ in range(len(self.image_set_index))
         ]
-        for index, indices_coco in zip(
-            self.image_set_index,
-            batch_indices_coco,
-        ):
-            gt_db.extend(
-                self._load_coco_keypoint_annotation_kernal(index, indices_coco)
-            )
+        indices_coco = [index for batch in batch_indices_coco for index in batch]
+
+        rec, rec_image_ids = self._load_coco_keypoint_annotations_bulk(
+            self.image_set_index
+        )
+        rec_coco, rec_image_ids_coco = (
+            self.coco_dataset._load_coco_keypoint_annotations_bulk(indices_coco)
+        )
+
+        # pad the coco entries with invisible infinity joints
+        padding = np.zeros((self.num_joints_infinity, 3), dtype=np.float32)
+        for r in rec_coco:
+            r["joints_3d"] = np.vstack((r["joints_3d"], padding))
+            r["joints_3d_vis"] = np.vstack((r["joints_3d_vis"], padding))
+
+        # entries of each infinity image, followed by those of its coco images
+        image_pos = {index: i for i, index in enumerate(self.image_set_index)}
+        image_pos_coco = {
+            index: i // self.coco_infinity_ratio for i, index in enumerate(indices_coco)
+        }
+        groups = np.array(
+            [image_pos[index] * 2 for index in rec_image_ids.tolist()]
+            + [image_pos_coco[index] * 2 + 1 for index in rec_image_ids_coco.tolist()],
+            dtype=np.int64,
+        )
+        all_rec = rec + rec_coco
+        gt_db = [all_rec[i] for i in np.argsort(groups, kind="stable")]
         return gt_db
 
+    def _load_coco_keypoint_annotations_bulk(self, image_ids):
+        """
+        infinity part of _load_coco_keypoint_annotation_kernal over all
+        image_ids at once, with the per object loops replaced by array operations
+        :param image_ids: infinity image ids
+        :return: db entries, image id of each entry
+        """
+        objs, obj_image_ids, widths, heights = load_coco_objs(self.coco, image_ids)
+        if len(objs) == 0:
+            return [], obj_image_ids
+
+        clean_bboxes, valid = sanitize_bboxes(
+            objs_array(objs, "bbox", 4), widths, heights
+        )
+        classes = np.array(
+            [self._coco_ind_to_class_ind[obj["category_id"]] for obj in objs]
+        )
+        # keypoints are keyed by name, so the kernel's max(keypoints) == 0
+        # check compares a name to 0 and never drops an object
+        keep = valid & (classes == 1)
+        objs = [obj for obj, k in zip(objs, keep) if k]
+
+        center, scale = xywh2cs(clean_bboxes[keep], self.aspect_ratio, self.pixel_std)
+        joints_3d, joints_3d_vis = keypoints_to_joints(
+            np.hstack(
+                (
+                    objs_array(objs, "coco_keypoints", self.num_joints_coco * 3),
+                    named_keypoints_array(objs, self.keypoints_name),
+                )
+            ),
+            self.num_joints,
+        )
+
+        images = [self.image_path_from_index(i) for i in obj_image_ids[keep].tolist()]
+
+        rec = build_records(
+            images, obj_image_ids[keep], center, scale, joints_3d, joints_3d_vis
+        )
+        return rec, obj_image_ids[keep]
+
     def _load_coco_keypoint_annotation_kernal(
         self, index: int, indices_coco: list[int]
     ):
         """
+        per image reference of _load_coco_keypoint_annotations_bulk, the
+        dataset no longer calls it. Only kept for the parity check of the
+        annotations subcommand in tools/benchmark.py
         coco ann: [u'segmentation', u'area', u'iscrowd', u'image_id', u'bbox', u'category_id', u'id']
         iscrowd:
             crowd instances are handled by marking their overlaps with all categories to -1
@@ -322,6 +463,7 @@ class InfinityCocoDataset(JointsDataset):
             rec.append(
                 {
                     "image": self.image_path_from_index(index),
+                    "image_id": index,
                     "center": center,
                     "scale": scale,
                     "joints_3d": joints_3d,
@@ -413,6 +555,7 @@ class InfinityCocoDataset(JointsDataset):
             kpt_db.append(
                 {
                     "image": img_name,
+                    "image_id": det_res["image_id"],
                     "center": center,
                     "scale": scale,
                     "score": score,
@@ -428,8 +571,24 @@ class InfinityCocoDataset(JointsDataset):
         )
         return kpt_db
 
-    def evaluate(self, cfg, preds, output_dir, all_boxes, img_path, *args, **kwargs):
+    def evaluate(
+        self,
+        cfg,
+        preds,
+        output_dir,
+        all_boxes,
+        img_path,
+        *args,
+        image_ids=None,
+        **kwargs,
+    ):
+        """
+        :param image_ids: [N] int image id of each detection, from meta. When
+            None, parsed from the file names in img_path as before
+        """
         rank = cfg.RANK
+        if image_ids is None:
+            image_ids = [int(path.split("/")[-1].split(".")[0]) for path in img_path]
 
         res_folder = os.path.join(output_dir, "results")
         if not os.path.exists(res_folder):
@@ -442,133 +601,44 @@ class InfinityCocoDataset(JointsDataset):
             res_folder, "keypoints_{}_results_{}.json".format(self.image_set, rank)
         )
 
-        # person x (keypoints)
-        _kpts = []
-        for idx, kpt in enumerate(preds):
-            _kpts.append(
-                {
-                    "keypoints": kpt,
-                    "center": all_boxes[idx][0:2],
-                    "scale": all_boxes[idx][2:4],
-                    "area": all_boxes[idx][4],
-                    "score": all_boxes[idx][5],
-                    "image": int(img_path[idx].split("/")[-1].split(".")[0]),
-                }
-            )
-        # image x person x (keypoints)
-        kpts = defaultdict(list)
-        for kpt in _kpts:
-            kpts[kpt["image"]].append(kpt)
-
-        # rescoring and oks nms
-        num_joints = self.num_joints
-        in_vis_thre = self.in_vis_thre
-        oks_thre = self.oks_thre
-        oks_nmsed_kpts = []
-        for img in kpts.keys():
-            img_kpts = kpts[img]
-            for n_p in img_kpts:
-                box_score = n_p["score"]
-                kpt_score = 0
-                valid_num = 0
-                for n_jt in range(0, num_joints):
-                    t_s = n_p["keypoints"][n_jt][2]
-                    if t_s > in_vis_thre:
-                        kpt_score = kpt_score + t_s
-                        valid_num = valid_num + 1
-                if valid_num != 0:
-                    kpt_score = kpt_score / valid_num
-                # rescoring
-                n_p["score"] = kpt_score * box_score
-
-            if self.soft_nms:
-                keep = soft_oks_nms(
-                    [img_kpts[i] for i in range(len(img_kpts))], oks_thre
-                )
-            else:
-                keep = oks_nms([img_kpts[i] for i in range(len(img_kpts))], oks_thre)
+        # rescoring and oks nms, on arrays of all the detections
+        kpts = preds[:, : self.num_joints]
+        keep, scores = keypoint_nms(
+            kpts,
+            all_boxes,
+            image_ids,
+            self.in_vis_thre,
+            self.oks_thre,
+            self.soft_nms,
+            self.oks_sigmas,
+        )
+        results = select_results(kpts, all_boxes, image_ids, scores, keep)
+        cat_id = self._class_to_coco_ind[self.classes[1]]
 
-            if len(keep) == 0:
-                oks_nmsed_kpts.append(img_kpts)
-            else:
-                oks_nmsed_kpts.append([img_kpts[_keep] for _keep in keep])
+        if self.save_results or "test" in self.image_set:
+            self._write_coco_keypoint_results(results, cat_id, res_file)
+            coco_results = res_file
+        else:
+            # handed to COCO.loadRes in memory, without a json round trip
+            coco_results = keypoint_annotations(results, cat_id)
 
-        self._write_coco_keypoint_results(oks_nmsed_kpts, res_file)
         if "test" not in self.image_set:
-            info_str = self._do_python_keypoint_eval(res_file, res_folder)
+            info_str = self._do_python_keypoint_eval(coco_results, res_folder)
             name_value = OrderedDict(info_str)
             return name_value, name_value["AP"]
         else:
             return {"Null": 0}, 0
 
-    def _write_coco_keypoint_results(self, keypoints, res_file):
-        data_pack = [
-            {
-                "cat_id": self._class_to_coco_ind[cls],
-                "cls_ind": cls_ind,
-                "cls": cls,
-                "ann_type": "keypoints",
-                "keypoints": keypoints,
-            }
-            for cls_ind, cls in enumerate(self.classes)
-            if not cls == "__background__"
-        ]
-
-        results = self._coco_keypoint_results_one_category_kernel(data_pack[0])
+    def _write_coco_keypoint_results(self, results, cat_id, res_file):
         logger.info("=> writing results json to %s" % res_file)
-        with open(res_file, "w") as f:
-            json.dump(results, f, sort_keys=True, indent=4)
-        try:
-            json.load(open(res_file))
-        except Exception:
-            content = []
-            with open(res_file, "r") as f:
-                for line in f:
-                    content.append(line)
-            content[-1] = "]"
-            with open(res_file, "w") as f:
-                for c in content:
-                    f.write(c)
-
-    def _coco_keypoint_results_one_category_kernel(self, data_pack):
-        cat_id = data_pack["cat_id"]
-        keypoints = data_pack["keypoints"]
-        cat_results = []
-
-        for img_kpts in keypoints:
-            if len(img_kpts) == 0:
-                continue
-
-            _key_points = np.array(
-                [img_kpts[k]["keypoints"] for k in range(len(img_kpts))]
-            )
-            key_points = np.zeros(
-                (_key_points.shape[0], self.num_joints * 3), dtype=np.float
-            )
-
-            for ipt in range(self.num_joints):
-                key_points[:, ipt * 3 + 0] = _key_points[:, ipt, 0]
-                key_points[:, ipt * 3 + 1] = _key_points[:, ipt, 1]
-                key_points[:, ipt * 3 + 2] = _key_points[:, ipt, 2]  # keypoints score.
-
-            result = [
-                {
-                    "image_id": img_kpts[k]["image"],
-                    "category_id": cat_id,
-                    "keypoints": list(key_points[k]),
-                    "score": img_kpts[k]["score"],
-                    "center": list(img_kpts[k]["center"]),
-                    "scale": list(img_kpts[k]["scale"]),
-                }
-                for k in range(len(img_kpts))
-            ]
-            cat_results.extend(result)
-
-        return cat_results
+        write_keypoint_results(results, cat_id, res_file)
 
     def _do_python_keypoint_eval(self, res_file, res_folder):
+        """
+        :param res_file: results json file, or the list of result dicts
+        """
         coco_dt = self.coco.loadRes(res_file)
-        coco_eval = COCOeval(self.coco, coco_dt, "keypoints")
+        coco_eval = ParallelCOCOeval(self.coco, coco_dt, "keypoints", self.eval_workers)
         coco_eval.params.useSegm = None
         coco_eval.evaluate()
         coco_eval.accumulate()
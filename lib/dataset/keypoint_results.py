@@ -0,0 +1,173 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import, division, print_function
+
+import json
+from collections import namedtuple
+
+import numpy as np
+from nms.nms import batched_soft_oks_nms, oks_nms_arrays
+
+# the kept detections of a run, as columns
+KeypointResults = namedtuple(
+    "KeypointResults", ["image_ids", "keypoints", "scores", "centers", "scales"]
+)
+
+_encode = json.JSONEncoder(separators=(",", ":")).encode
+# keys in the sorted order of the json_tricks files written before
+_RESULT_LINE = (
+    '\n{{"category_id":{},"center":[{}],"image_id":{},'
+    '"keypoints":[{}],"scale":[{}],"score":{}}}'
+)
+
+
+def rescore_keypoints(preds, box_scores, in_vis_thre):
+    """
+    box score times the mean score of the joints above in_vis_thre (0 when
+    there is none), for every detection at once
+    :param preds: [N, num_joints, 3] x, y and score of the joints
+    :param box_scores: [N]
+    :return: [N] float64 scores
+    """
+    joint_scores = preds[:, :, 2].astype(np.float64)
+    valid = joint_scores > in_vis_thre
+    num_valid = valid.sum(axis=1)
+    # cumsum adds the joints one after the other, as a running sum would
+    kpt_score = np.cumsum(np.where(valid, joint_scores, 0.0), axis=1)[:, -1]
+    kpt_score = np.divide(
+        kpt_score, num_valid, out=np.zeros_like(kpt_score), where=num_valid != 0
+    )
+    return kpt_score * box_scores
+
+
+def group_by_image(image_ids):
+    """
+    :param image_ids: [N] image id of each detection
+    :return: order [N] sorting the detections by image id, detections of an
+        image keep their order, and the start [num_images] and count
+        [num_images] of each image in it
+    """
+    order = np.argsort(image_ids, kind="stable")
+    _, starts, counts = np.unique(
+        image_ids[order], return_index=True, return_counts=True
+    )
+    return order, starts, counts
+
+
+def keypoint_nms(
+    preds,
+    all_boxes,
+    image_ids,
+    in_vis_thre,
+    oks_thre,
+    soft_nms=False,
+    sigmas=None,
+):
+    """
+    rescoring and oks nms of the detections of all the images, as the
+    evaluate() of the coco style datasets do it
+    :param preds: [N, num_joints, 3] joints in image coordinates and scores
+    :param all_boxes: [N, 6] center, scale, area and score of the boxes
+    :param image_ids: [N] int image id of each detection
+    :param soft_nms: batched soft oks nms instead of oks_nms per image
+    :param sigmas: oks sigmas of soft nms, of the dataset joints; the ones
+        of the first preds.shape[1] joints are used
+    :return: keep, indexes of the kept detections grouped by increasing image
+        id, in nms order within an image, and the [N] rescored scores
+    """
+    image_ids = np.asarray(image_ids, dtype=np.int64)
+    scores = rescore_keypoints(preds, all_boxes[:, 5], in_vis_thre)
+    areas = all_boxes[:, 4]
+
+    if soft_nms:
+        if sigmas is not None:
+            # validate() keeps 17 joints of the datasets with 36 or 53
+            sigmas = sigmas[: preds.shape[1]]
+        keep = batched_soft_oks_nms(preds, areas, scores, image_ids, oks_thre, sigmas)
+        return keep, scores
+
+    # oks_nms compares the first 17 joints with the coco sigmas
+    kpts = preds[:, :17].reshape(len(preds), -1)
+    order, starts, counts = group_by_image(image_ids)
+    keep = []
+    for start, count in zip(starts.tolist(), counts.tolist()):
+        image = order[start : start + count]
+        image_keep = oks_nms_arrays(kpts[image], scores[image], areas[image], oks_thre)
+        keep.append(image[image_keep])
+    return np.concatenate(keep) if keep else np.zeros(0, dtype=np.intp), scores
+
+
+def select_results(preds, all_boxes, image_ids, scores, keep):
+    """
+    :param keep: indexes of the detections to report, from keypoint_nms
+    :return: KeypointResults of the kept detections, in the order of keep
+    """
+    return KeypointResults(
+        image_ids=np.asarray(image_ids, dtype=np.int64)[keep],
+        keypoints=preds[keep].reshape(len(keep), -1),
+        scores=scores[keep],
+        centers=all_boxes[keep, 0:2],
+        scales=all_boxes[keep, 2:4],
+    )
+
+
+def keypoint_annotations(results, cat_id):
+    """
+    :return: the results as the list of dicts COCO.loadRes takes in place of
+        a results json file
+    """
+    return [
+        {
+            "category_id": cat_id,
+            "center": center,
+            "image_id": image_id,
+            "keypoints": keypoints,
+            "scale": scale,
+            "score": score,
+        }
+        for image_id, keypoints, score, center, scale in zip(
+            results.image_ids.tolist(),
+            results.keypoints.tolist(),
+            results.scores.tolist(),
+            results.centers.tolist(),
+            results.scales.tolist(),
+        )
+    ]
+
+
+def _encode_rows(array):
+    """json of each element (1d) or row (2d) of an array, rows unbracketed"""
+    if array.ndim == 1:
+        return _encode(array.tolist())[1:-1].split(",")
+    return _encode(array.tolist())[2:-2].split("],[")
+
+
+def write_keypoint_results(results, cat_id, res_file, chunk_size=4096):
+    """
+    write the results as a compact json list, one detection per line.
+    Columns are encoded chunk by chunk by the C encoder of json, floats
+    with their shortest repr, so the file loads back to the same values
+    :param results: KeypointResults
+    :param cat_id: coco category id of the detections
+    """
+    with open(res_file, "w") as f:
+        f.write("[")
+        for start in range(0, len(results.scores), chunk_size):
+            chunk = KeypointResults(
+                *[column[start : start + chunk_size] for column in results]
+            )
+            lines = [
+                _RESULT_LINE.format(cat_id, center, image_id, keypoints, scale, score)
+                for image_id, keypoints, score, center, scale in zip(
+                    _encode_rows(chunk.image_ids),
+                    _encode_rows(chunk.keypoints),
+                    _encode_rows(chunk.scores),
+                    _encode_rows(chunk.centers),
+                    _encode_rows(chunk.scales),
+                )
+            ]
+            f.write(("," if start else "") + ",".join(lines))
+        f.write("\n]\n")
@@ -16,6 +16,7 @@ from collections import OrderedDict
 import numpy as np
 from scipy.io import loadmat, savemat
 
+from core.pck import pck_curve
 from dataset.JointsDataset import JointsDataset
 
 
@@ -38,6 +39,9 @@ class MPIIDataset(JointsDataset):
         if is_train and cfg.DATASET.SELECT_DATA:
             self.db = self.select_data(self.db)
 
+        if cfg.DATASET.DB_MMAP:
+            self.memmap_db()
+
         logger.info('=> load {} samples'.format(len(self.db)))
 
     def _get_db(self):
@@ -143,20 +147,11 @@ class MPIIDataset(JointsDataset):
         scaled_uv_err = np.divide(uv_err, scale)
         scaled_uv_err = np.multiply(scaled_uv_err, jnt_visible)
         jnt_count = np.sum(jnt_visible, axis=1)
-        less_than_threshold = np.multiply((scaled_uv_err <= threshold),
-                                          jnt_visible)
-        PCKh = np.divide(100.*np.sum(less_than_threshold, axis=1), jnt_count)
+        PCKh = pck_curve(scaled_uv_err, jnt_visible, [threshold])[0]
 
         # save
         rng = np.arange(0, 0.5+0.01, 0.01)
-        pckAll = np.zeros((len(rng), 16))
-
-        for r in range(len(rng)):
-            threshold = rng[r]
-            less_than_threshold = np.multiply(scaled_uv_err <= threshold,
-                                              jnt_visible)
-            pckAll[r, :] = np.divide(100.*np.sum(less_than_threshold, axis=1),
-                                     jnt_count)
+        pckAll = pck_curve(scaled_uv_err, jnt_visible, rng)
 
         PCKh = np.ma.array(PCKh, mask=False)
         PCKh.mask[6:8] = True
@@ -11,6 +11,7 @@ import os
 
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 BN_MOMENTUM = 0.1
 logger = logging.getLogger(__name__)
@@ -287,6 +288,36 @@ class HighResolutionModule(nn.Module):
 blocks_dict = {"BASIC": BasicBlock, "BOTTLENECK": Bottleneck}
 
 
+def _call_with_list(module, *x):
+    # HighResolutionModule writes into its input list, which the
+    # recomputation during backward must find unchanged
+    return module(list(x))
+
+
+def _checkpoint(function, module, *args):
+    """
+    checkpoint(function, module, *args), whose recomputation in the backward
+    pass restores the buffers of module: the batch norm running stats are
+    updated once per step, as without checkpointing
+    """
+    recompute = [False]
+
+    def run(*args):
+        if not recompute[0]:
+            recompute[0] = True
+            return function(module, *args)
+        buffers = [(buffer, buffer.clone()) for buffer in module.buffers()]
+        try:
+            return function(module, *args)
+        finally:
+            # also when the recomputation stops early
+            with torch.no_grad():
+                for buffer, saved in buffers:
+                    buffer.copy_(saved)
+
+    return checkpoint(run, *args, use_reentrant=False)
+
+
 class PoseHighResolutionNet(nn.Module):
     def __init__(self, cfg, **kwargs):
         self.inplanes = 64
@@ -343,6 +374,7 @@ class PoseHighResolutionNet(nn.Module):
         )
 
         self.pretrained_layers = extra["PRETRAINED_LAYERS"]
+        self.checkpoint_layers = extra.get("CHECKPOINT_LAYERS", [])
         if "PRETRAIN_FINAL_LAYER" in extra:
             self.pretrain_final_layer = extra["PRETRAIN_FINAL_LAYER"]
         else:
@@ -452,7 +484,7 @@ class PoseHighResolutionNet(nn.Module):
         x = self.conv2(x)
         x = self.bn2(x)
         x = self.relu(x)
-        x = self.layer1(x)
+        x = self._run("layer1", self.layer1, x)
 
         x_list = []
         for i in range(self.stage2_cfg["NUM_BRANCHES"]):
@@ -460,7 +492,7 @@ class PoseHighResolutionNet(nn.Module):
                 x_list.append(self.transition1[i](x))
             else:
                 x_list.append(x)
-        y_list = self.stage2(x_list)
+        y_list = self._run("stage2", self.stage2, x_list)
 
         x_list = []
         for i in range(self.stage3_cfg["NUM_BRANCHES"]):
@@ -468,7 +500,7 @@ class PoseHighResolutionNet(nn.Module):
                 x_list.append(self.transition2[i](y_list[-1]))
             else:
                 x_list.append(y_list[i])
-        y_list = self.stage3(x_list)
+        y_list = self._run("stage3", self.stage3, x_list)
 
         x_list = []
         for i in range(self.stage4_cfg["NUM_BRANCHES"]):
@@ -476,12 +508,26 @@ class PoseHighResolutionNet(nn.Module):
                 x_list.append(self.transition3[i](y_list[-1]))
             else:
                 x_list.append(y_list[i])
-        y_list = self.stage4(x_list)
+        y_list = self._run("stage4", self.stage4, x_list)
 
         x = self.final_layer(y_list[0])
 
         return x
 
+    def _run(self, name, layer, x):
+        """
+        layer(x), with activation checkpointing when name is in
+        MODEL.EXTRA.CHECKPOINT_LAYERS: layer1 as a whole and every
+        HighResolutionModule of a stage on its own
+        """
+        if name not in self.checkpoint_layers or not torch.is_grad_enabled():
+            return layer(x)
+        if name == "layer1":
+            return _checkpoint(nn.Module.__call__, layer, x)
+        for module in layer:
+            x = _checkpoint(_call_with_list, module, *x)
+        return x
+
     def init_weights(self, pretrained=""):
         logger.info("=> init weights from normal distribution")
         for m in self.modules():
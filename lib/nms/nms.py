@@ -73,32 +73,35 @@ def nms(dets, thresh):
     return keep
 
 
+COCO_SIGMAS = (
+    np.array(
+        [
+            0.26,
+            0.25,
+            0.25,
+            0.35,
+            0.35,
+            0.79,
+            0.79,
+            0.72,
+            0.72,
+            0.62,
+            0.62,
+            1.07,
+            1.07,
+            0.87,
+            0.87,
+            0.89,
+            0.89,
+        ]
+    )
+    / 10.0
+)
+
+
 def oks_iou(g, d, a_g, a_d, sigmas=None, in_vis_thre=None):
     if not isinstance(sigmas, np.ndarray):
-        sigmas = (
-            np.array(
-                [
-                    0.26,
-                    0.25,
-                    0.25,
-                    0.35,
-                    0.35,
-                    0.79,
-                    0.79,
-                    0.72,
-                    0.72,
-                    0.62,
-                    0.62,
-                    1.07,
-                    1.07,
-                    0.87,
-                    0.87,
-                    0.89,
-                    0.89,
-                ]
-            )
-            / 10.0
-        )
+        sigmas = COCO_SIGMAS
     vars = (sigmas * 2) ** 2
     xg = g[0::3]
     yg = g[1::3]
@@ -118,6 +121,47 @@ def oks_iou(g, d, a_g, a_d, sigmas=None, in_vis_thre=None):
     return ious
 
 
+def oks_matrix(kpts, areas, sigmas=None, in_vis_thre=None):
+    """
+    oks of every pair of detections, as oks_iou computes it
+    :param kpts: [N, K * 3] flattened keypoints
+    :param areas: [N]
+    :return: [N, N] oks, oks_iou(kpts[i], kpts, areas[i], areas)[j] at [i, j]
+    """
+    if not isinstance(sigmas, np.ndarray):
+        sigmas = COCO_SIGMAS
+    vars = (sigmas * 2) ** 2
+    x = kpts[:, 0::3]
+    y = kpts[:, 1::3]
+    v = kpts[:, 2::3]
+    # the same operations as oks_iou, in place on the [N, N, K] arrays
+    d2 = x[None, :, :] - x[:, None, :]
+    np.square(d2, out=d2)
+    dy = y[None, :, :] - y[:, None, :]
+    np.square(dy, out=dy)
+    d2 += dy
+    area = (areas[:, None] + areas[None, :]) / 2 + np.spacing(1)
+    # joints contiguous, so np.sum adds them up in the order oks_iou does
+    e = np.ascontiguousarray(d2 / vars)
+    e /= area[:, :, None]
+    e /= 2
+    np.negative(e, out=e)
+    np.exp(e, out=e)
+    if in_vis_thre is None:
+        return np.sum(e, axis=2) / e.shape[2]
+
+    # the visible joints of the compared detection (column) are kept, the
+    # columns are summed per visibility pattern over exactly those joints
+    ious = np.zeros(e.shape[:2])
+    patterns, columns = np.unique(v > in_vis_thre, axis=0, return_inverse=True)
+    for p, visible in enumerate(patterns):
+        if visible.any():
+            cols = np.flatnonzero(columns.reshape(-1) == p)
+            e_p = np.ascontiguousarray(e[:, cols][:, :, visible])
+            ious[:, cols] = np.sum(e_p, axis=2) / e_p.shape[2]
+    return ious
+
+
 def oks_nms(kpts_db, thresh, sigmas=None, in_vis_thre=None):
     """
     greedily select boxes with high confidence and overlap with current maximum <= thresh
@@ -135,19 +179,31 @@ def oks_nms(kpts_db, thresh, sigmas=None, in_vis_thre=None):
     )
     areas = np.array([kpts_db[i]["area"] for i in range(len(kpts_db))])
 
-    order = scores.argsort()[::-1]
+    return oks_nms_arrays(kpts, scores, areas, thresh, sigmas, in_vis_thre)
 
-    keep = []
-    while order.size > 0:
-        i = order[0]
-        keep.append(i)
 
-        oks_ovr = oks_iou(
-            kpts[i], kpts[order[1:]], areas[i], areas[order[1:]], sigmas, in_vis_thre
-        )
+def oks_nms_arrays(kpts, scores, areas, thresh, sigmas=None, in_vis_thre=None):
+    """
+    oks_nms of the detections of one image, given as arrays
+    :param kpts: [N, K * 3] flattened keypoints
+    :param scores: [N]
+    :param areas: [N]
+    :param thresh: retain overlap < thresh
+    :return: indexes to keep
+    """
+    order = scores.argsort()[::-1]
+    # pairwise oks in score order, the greedy pass only reads it
+    oks_ovr = oks_matrix(kpts[order], areas[order], sigmas, in_vis_thre)
+    # nan overlaps suppress, as they fail the <= thresh test
+    suppress = ~(oks_ovr <= thresh)
 
-        inds = np.where(oks_ovr <= thresh)[0]
-        order = order[inds + 1]
+    keep = []
+    removed = np.zeros(order.size, dtype=bool)
+    for n in range(order.size):
+        if removed[n]:
+            continue
+        keep.append(order[n])
+        removed[n + 1 :] |= suppress[n, n + 1 :]
 
     return keep
 
@@ -208,3 +264,126 @@ def soft_oks_nms(kpts_db, thresh, sigmas=None, in_vis_thre=None):
     # kpts_db = kpts_db[:keep_cnt]
 
     # return kpts_db
+
+
+def batched_soft_oks_nms(
+    kpts, areas, scores, images, thresh, sigmas=None, in_vis_thre=None, max_dets=20
+):
+    """
+    soft_oks_nms of the detections of many images at once: every step picks
+    the best detection of each image and rescores the rest of its image, on
+    [images, detections] arrays of the images with as many detections
+    :param kpts: [N, K, 3] keypoints of all the detections
+    :param areas: [N]
+    :param scores: [N]
+    :param images: [N] image id of each detection
+    :param thresh: gaussian rescoring parameter, as in rescore
+    :param sigmas: oks sigmas of at least the K joints, the coco ones by
+        default. Only the first K are used: validate() keeps the first 17
+        joints of the datasets with 36 or 53
+    :return: indexes of the kept detections, grouped by increasing image id,
+        in pick order within an image
+    """
+    if len(scores) == 0:
+        return np.zeros(0, dtype=np.intp)
+    if not isinstance(sigmas, np.ndarray):
+        sigmas = COCO_SIGMAS
+    num_joints = kpts.shape[1]
+    vars = (sigmas[:num_joints] * 2) ** 2
+
+    order = np.argsort(images, kind="stable")
+    _, starts, counts = np.unique(images[order], return_index=True, return_counts=True)
+    picks = np.full((counts.size, min(max_dets, counts.max())), -1, dtype=np.intp)
+
+    by_count = np.argsort(counts, kind="stable")
+    bounds = np.flatnonzero(np.diff(counts[by_count])) + 1
+    for same_count in np.split(by_count, bounds):
+        num_dets = counts[same_count[0]]
+        num_picks = min(max_dets, num_dets)
+        # at most about 2**22 keypoints at once
+        chunk_size = max(1, 2**22 // (num_dets * num_joints))
+        for chunk in range(0, same_count.size, chunk_size):
+            chunk_images = same_count[chunk : chunk + chunk_size]
+            rows = np.arange(chunk_images.size)
+            index = order[starts[chunk_images, None] + np.arange(num_dets)]
+            s = scores[index]
+            x = kpts[index, :, 0]
+            y = kpts[index, :, 1]
+            v = kpts[index, :, 2]
+            a = areas[index]
+
+            for n in range(num_picks):
+                best = np.argmax(s, axis=1)
+                picks[chunk_images, n] = index[rows, best]
+                if n + 1 == num_picks:
+                    break
+                x_best = x[rows, best][:, None]
+                y_best = y[rows, best][:, None]
+                a_best = a[rows, best][:, None]
+
+                # the rest of each image, in the same order
+                rest = np.ones(s.shape, dtype=bool)
+                rest[rows, best] = False
+                index = index[rest].reshape(rows.size, -1)
+                s = s[rest].reshape(rows.size, -1)
+                x = x[rest].reshape(rows.size, -1, num_joints)
+                y = y[rest].reshape(rows.size, -1, num_joints)
+                v = v[rest].reshape(rows.size, -1, num_joints)
+                a = a[rest].reshape(rows.size, -1)
+
+                # oks_iou of the picked detections against the rest, in place
+                d2 = x - x_best
+                np.square(d2, out=d2)
+                dy = y - y_best
+                np.square(dy, out=dy)
+                d2 += dy
+                area = (a_best + a) / 2 + np.spacing(1)
+                # joints contiguous, so np.sum adds them up as oks_iou does
+                e = np.ascontiguousarray(d2 / vars)
+                e /= area[:, :, None]
+                e /= 2
+                np.negative(e, out=e)
+                np.exp(e, out=e)
+                if in_vis_thre is None:
+                    oks_ovr = np.sum(e, axis=2) / num_joints
+                else:
+                    # the visible joints of the rescored detections
+                    visible = v > in_vis_thre
+                    num_visible = visible.sum(axis=2)
+                    oks_ovr = np.divide(
+                        np.sum(e, axis=2, where=visible),
+                        num_visible,
+                        out=np.zeros(s.shape),
+                        where=num_visible > 0,
+                    )
+                s = rescore(oks_ovr.reshape(-1), s.reshape(-1), thresh).reshape(s.shape)
+
+    return picks[picks >= 0]
+
+
+def soft_oks_nms_images(kpts_dbs, thresh, sigmas=None, in_vis_thre=None):
+    """
+    batched_soft_oks_nms of the kpts_db of every image
+    :param kpts_dbs: kpts_db of each image, as soft_oks_nms takes it
+    :return: indexes to keep of each image
+    """
+    if len(kpts_dbs) == 0:
+        return []
+    counts = np.array([len(kpts_db) for kpts_db in kpts_dbs], dtype=np.intp)
+    kpts_db = [kpt for kpts_db in kpts_dbs for kpt in kpts_db]
+    images = np.repeat(np.arange(len(kpts_dbs)), counts)
+    keep = batched_soft_oks_nms(
+        np.array([kpt["keypoints"] for kpt in kpts_db]),
+        np.array([kpt["area"] for kpt in kpts_db]),
+        np.array([kpt["score"] for kpt in kpts_db]),
+        images,
+        thresh,
+        sigmas,
+        in_vis_thre,
+    )
+    kept_images = images[keep]
+    offsets = np.cumsum(counts) - counts
+    return np.split(
+        keep - offsets[kept_images],
+        np.cumsum(np.bincount(kept_images, minlength=len(kpts_dbs)))[:-1],
+    )
@@ -0,0 +1,98 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import, division, print_function
+
+import os
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+
+
+def init_distributed(cfg):
+    """
+    join the process group of the processes started by torchrun, which sets
+    RANK, WORLD_SIZE and LOCAL_RANK for each of them
+    :return: device of this process, its gpu with nccl, the cpu with gloo
+    """
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    dist.init_process_group(
+        cfg.DIST.BACKEND,
+        rank=int(os.environ["RANK"]),
+        world_size=int(os.environ["WORLD_SIZE"]),
+    )
+    if cfg.DIST.BACKEND == "nccl":
+        torch.cuda.set_device(local_rank)
+        return torch.device("cuda", local_rank)
+    return torch.device("cpu")
+
+
+def get_world_size():
+    """number of processes, 1 outside of a process group"""
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_world_size()
+    return 1
+
+
+def get_rank():
+    """rank of this process, 0 outside of a process group"""
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank()
+    return 0
+
+
+def wrap_model(model, device):
+    """DistributedDataParallel around the model moved to device"""
+    model = model.to(device)
+    device_ids = [device.index] if device.type == "cuda" else None
+    return DistributedDataParallel(model, device_ids=device_ids)
+
+
+def get_train_sampler(cfg, dataset):
+    """
+    DistributedSampler giving each rank its share of the dataset,
+    None without DIST.ENABLED
+    """
+    if not cfg.DIST.ENABLED:
+        return None
+    return DistributedSampler(dataset, shuffle=cfg.TRAIN.SHUFFLE)
+
+
+def get_val_sampler(cfg, dataset):
+    """
+    contiguous shard of the dataset for this rank, without the padding of
+    DistributedSampler, so each sample is evaluated exactly once.
+    None without DIST.ENABLED
+    """
+    if not cfg.DIST.ENABLED:
+        return None
+    world_size = get_world_size()
+    rank = get_rank()
+    return range(
+        len(dataset) * rank // world_size, len(dataset) * (rank + 1) // world_size
+    )
+
+
+def gather_to_main(obj):
+    """
+    :return: the obj of every rank in rank order on rank 0, None on the
+        other ranks, [obj] outside of a process group
+    """
+    if get_world_size() == 1:
+        return [obj]
+    objs = [None] * get_world_size() if get_rank() == 0 else None
+    dist.gather_object(obj, objs, dst=0)
+    return objs
+
+
+def broadcast_from_main(obj):
+    """:return: the obj of rank 0, on every rank"""
+    if get_world_size() == 1:
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src=0)
+    return objs[0]
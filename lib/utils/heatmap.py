@@ -0,0 +1,165 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import, division, print_function
+
+import functools
+import logging
+import math
+import multiprocessing.util
+from collections import namedtuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+GaussianTable = namedtuple(
+    "GaussianTable",
+    ["kernel", "mu_min", "out_x", "cols", "in_x", "out_y", "rows", "in_y", "offsets"],
+)
+
+
+def gaussian_kernel(sigma):
+    """
+    unnormalized gaussian patch of (6 * sigma + 1) ** 2, center value is 1
+    """
+    tmp_size = sigma * 3
+    size = 2 * tmp_size + 1
+    x = np.arange(0, size, 1, np.float32)
+    y = x[:, np.newaxis]
+    x0 = y0 = size // 2
+    return np.exp(-((x - x0) ** 2 + (y - y0) ** 2) / (2 * sigma**2))
+
+
+def _clipping_table(sigma, length):
+    """
+    for every integer gaussian center along an axis of the heatmap: whether
+    the gaussian misses the heatmap, the heatmap index of every kernel
+    row / column, and whether that index lands inside the heatmap.
+    The first and last centers are sentinels standing for anything further out.
+    """
+    tmp_size = sigma * 3
+    size = int(2 * tmp_size + 1)
+    mu = np.arange(
+        int(math.floor(-tmp_size)) - 2, length + int(math.ceil(tmp_size)) + 1
+    )
+    ul = np.trunc(mu - tmp_size).astype(np.int64)
+    br = np.trunc(mu + tmp_size + 1).astype(np.int64)
+    out = (ul >= length) | (br < 0)
+    index = ul[:, None] + np.arange(size)
+    inside = (index >= 0) & (index < np.minimum(br, length)[:, None])
+    return int(mu[0]), out, index, inside
+
+
+@functools.lru_cache(maxsize=32)
+def get_gaussian_table(sigma, heatmap_size, num_joints):
+    """
+    ready-to-paste gaussian kernel and clipping tables, cached per process
+    :param sigma: gaussian std in heatmap pixels
+    :param heatmap_size: (width, height) tuple
+    :param num_joints: number of heatmaps rendered per sample
+    """
+    width, height = heatmap_size
+    mu_min_x, out_x, cols, in_x = _clipping_table(sigma, width)
+    mu_min_y, out_y, rows, in_y = _clipping_table(sigma, height)
+    assert mu_min_x == mu_min_y
+    # flat offset of every joint's heatmap in the target array
+    offsets = np.arange(num_joints, dtype=np.int64) * width * height
+
+    table = GaussianTable(
+        gaussian_kernel(sigma), mu_min_x, out_x, cols, in_x, out_y, rows, in_y, offsets
+    )
+    for array in table:
+        if isinstance(array, np.ndarray):
+            array.setflags(write=False)
+    return table
+
+
+def gaussian_table_cache_info():
+    """hits / misses of the gaussian table cache in the calling process"""
+    info = get_gaussian_table.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize}
+
+
+def log_gaussian_table_cache(process):
+    """log the hit rate of the gaussian table cache of the calling process"""
+    info = gaussian_table_cache_info()
+    lookups = info["hits"] + info["misses"]
+    logger.info(
+        "=> gaussian table cache of the {}: {} hits, {} misses, hit rate {:.1%}".format(
+            process,
+            info["hits"],
+            info["misses"],
+            info["hits"] / lookups if lookups else 0.0,
+        )
+    )
+
+
+def log_gaussian_table_cache_at_exit(worker_id):
+    """
+    DataLoader worker_init_fn, the first worker logs its gaussian table cache
+    when it shuts down at the end of the epoch. Forked workers skip atexit,
+    the multiprocessing finalizers still run
+    """
+    if worker_id == 0:
+        multiprocessing.util.Finalize(
+            None,
+            log_gaussian_table_cache,
+            args=("data loader worker {}".format(worker_id),),
+            exitpriority=0,
+        )
+
+
+def generate_gaussian_targets(
+    joints, joints_vis, image_size, heatmap_size, sigma, subpixel=False
+):
+    """
+    render the gaussian heatmaps of all joints in one pass
+    :param joints: [num_joints, 3], in input image coordinates
+    :param joints_vis: [num_joints, 3]
+    :param image_size: [width, height] of the network input
+    :param heatmap_size: [width, height] of the heatmaps
+    :param sigma: gaussian std in heatmap pixels
+    :param subpixel: center the gaussian on the exact (non-integer) joint
+        location instead of the nearest heatmap pixel
+    :return: target [num_joints, height, width],
+        target_weight [num_joints, 1] (1: visible, 0: invisible)
+    """
+    num_joints = joints.shape[0]
+    width, height = int(heatmap_size[0]), int(heatmap_size[1])
+    table = get_gaussian_table(sigma, (width, height), num_joints)
+
+    target = np.zeros((num_joints, height, width), dtype=np.float32)
+    target_weight = np.ones((num_joints, 1), dtype=np.float32)
+    target_weight[:, 0] = joints_vis[:, 0]
+
+    feat_stride = np.asarray(image_size) / np.asarray(heatmap_size)
+    # int() truncates towards zero, keep that for joints left of / above the crop
+    mu = np.trunc(joints[:, 0:2] / feat_stride + 0.5)
+    ix = np.clip(mu[:, 0] - table.mu_min, 0, len(table.out_x) - 1).astype(np.int64)
+    iy = np.clip(mu[:, 1] - table.mu_min, 0, len(table.out_y) - 1).astype(np.int64)
+
+    # Check that any part of the gaussian is in-bounds
+    target_weight[table.out_x[ix] | table.out_y[iy]] = 0
+
+    paste = target_weight[:, 0] > 0.5
+    mask = (
+        paste[:, None, None] & table.in_y[iy][:, :, None] & table.in_x[ix][:, None, :]
+    )
+    j, ky, kx = np.nonzero(mask)
+    rows = table.rows[iy[j], ky]
+    cols = table.cols[ix[j], kx]
+
+    if subpixel:
+        center = joints[:, 0:2] / feat_stride
+        dx = cols - center[j, 0]
+        dy = rows - center[j, 1]
+        values = np.exp(-(dx**2 + dy**2) / (2 * sigma**2)).astype(np.float32)
+    else:
+        values = table.kernel[ky, kx]
+
+    target.reshape(-1)[table.offsets[j] + rows * width + cols] = values
+
+    return target, target_weight
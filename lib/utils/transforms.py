@@ -10,6 +10,7 @@ from __future__ import print_function
 
 import numpy as np
 import cv2
+import torch
 
 
 def flip_back(output_flipped, matched_parts):
@@ -29,6 +30,34 @@ def flip_back(output_flipped, matched_parts):
     return output_flipped
 
 
+def flip_permutation(num_joints, matched_parts):
+    '''
+    joint order after the left/right swaps of flip_back, as an index array
+    '''
+    perm = np.arange(num_joints)
+    for pair in matched_parts:
+        perm[[pair[0], pair[1]]] = perm[[pair[1], pair[0]]]
+    return perm
+
+
+def flip_back_tensor(output_flipped, flip_perm, shift_heatmap=False):
+    '''
+    flip_back on a torch.Tensor(batch_size, num_joints, height, width),
+    on its device. The joint swap and horizontal flip (and the one pixel
+    shift of SHIFT_HEATMAP) are two index_select gathers.
+    flip_perm: torch.LongTensor from flip_permutation
+    '''
+    width = output_flipped.size(3)
+    cols = torch.arange(width - 1, -1, -1, device=output_flipped.device)
+    if shift_heatmap:
+        # feature is not aligned, column x takes flipped column x - 1
+        cols[1:] = cols[:-1].clone()
+
+    return output_flipped.index_select(
+        1, flip_perm.to(output_flipped.device)
+    ).index_select(3, cols)
+
+
 def fliplr_joints(joints, joints_vis, width, matched_parts):
     """
     flip coords
@@ -54,6 +83,79 @@ def transform_preds(coords, center, scale, output_size):
     return target_coords
 
 
+def transform_preds_batch(coords, center, scale, output_size):
+    '''
+    batched transform_preds
+    coords: [batch_size, num_joints, 2] numpy.ndarray or torch.Tensor
+    center, scale: [batch_size, 2], of the same type as coords
+    '''
+    trans = get_affine_transforms(center, scale, 0, output_size, inv=1)
+    return affine_transform_batch(coords[:, :, 0:2], trans)
+
+
+def get_affine_transforms(center, scale, rot, output_size, inv=0):
+    '''
+    batched get_affine_transform (without shift), in float64.
+    The three point pairs of get_affine_transform only ever describe a
+    rotation, a uniform scale and a translation, so the matrices are built
+    in closed form instead of one cv2.getAffineTransform per sample.
+    center, scale: [batch_size, 2] numpy.ndarray or torch.Tensor
+    rot: [batch_size] or scalar, in degrees
+    return: [batch_size, 2, 3], of the same type as center
+    '''
+    if isinstance(center, torch.Tensor):
+        xp = torch
+        center = center.double()
+        scale = scale.to(center)
+        rot = torch.as_tensor(rot, dtype=torch.float64, device=center.device)
+    else:
+        xp = np
+        center = np.asarray(center, dtype=np.float64)
+        scale = np.asarray(scale, dtype=np.float64)
+        rot = np.asarray(rot, dtype=np.float64)
+
+    src_w = scale[:, 0] * 200.0
+    dst_w = output_size[0]
+    dst_h = output_size[1]
+
+    rot_rad = np.pi * rot / 180
+    sn = xp.sin(rot_rad) + xp.zeros_like(src_w)
+    cs = xp.cos(rot_rad) + xp.zeros_like(src_w)
+    dst_center = [dst_w * 0.5, dst_h * 0.5]
+
+    if inv:
+        # output -> input: scale by src_w / dst_w, rotate by rot
+        k = src_w / dst_w
+        m = [[k * cs, -k * sn], [k * sn, k * cs]]
+        t = [
+            center[:, i] - m[i][0] * dst_center[0] - m[i][1] * dst_center[1]
+            for i in range(2)
+        ]
+    else:
+        # input -> output: scale by dst_w / src_w, rotate by -rot
+        k = dst_w / src_w
+        m = [[k * cs, k * sn], [-k * sn, k * cs]]
+        t = [
+            dst_center[i] - m[i][0] * center[:, 0] - m[i][1] * center[:, 1]
+            for i in range(2)
+        ]
+
+    return xp.stack(
+        [xp.stack([m[i][0], m[i][1], t[i]], axis=-1) for i in range(2)], axis=1
+    )
+
+
+def affine_transform_batch(pts, t):
+    '''
+    pts: [batch_size, num_points, 2]
+    t: [batch_size, 2, 3] as returned by get_affine_transforms
+    return: [batch_size, num_points, 2], in the dtype of t
+    '''
+    if isinstance(t, torch.Tensor):
+        pts = pts.to(t)
+    return pts @ t[:, :, 0:2].swapaxes(1, 2) + t[:, None, :, 2]
+
+
 def get_affine_transform(
         center, scale, rot, output_size,
         shift=np.array([0, 0], dtype=np.float32), inv=0
@@ -24,7 +24,7 @@ def create_logger(cfg, cfg_name, phase='train'):
     # set up logger
     if not root_output_dir.exists():
         print('=> creating {}'.format(root_output_dir))
-        root_output_dir.mkdir()
+        root_output_dir.mkdir(exist_ok=True)
 
     dataset = cfg.DATASET.DATASET + '_' + cfg.DATASET.HYBRID_JOINTS_TYPE \
         if cfg.DATASET.HYBRID_JOINTS_TYPE else cfg.DATASET.DATASET
@@ -41,10 +41,14 @@ def create_logger(cfg, cfg_name, phase='train'):
     log_file = '{}_{}_{}.log'.format(cfg_name, time_str, phase)
     final_log_file = final_output_dir / log_file
     head = '%(asctime)-15s %(message)s'
-    logging.basicConfig(filename=str(final_log_file),
-                        format=head)
     logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
+    if cfg.RANK == 0:
+        logging.basicConfig(filename=str(final_log_file),
+                            format=head)
+        logger.setLevel(logging.INFO)
+    else:
+        # distributed training, only rank 0 writes the log
+        logger.setLevel(logging.WARNING)
     console = logging.StreamHandler()
     logging.getLogger('').addHandler(console)
 
@@ -76,6 +80,19 @@ def get_optimizer(cfg, model):
     return optimizer
 
 
+def freeze_layers(cfg, model):
+    """
+    requires_grad off for the MODEL.EXTRA.FROZEN_LAYERS of the unwrapped
+    model with MODEL.EXTRA.FREEZE_LAYERS, before DistributedDataParallel
+    builds its reducer from the parameters that require grad
+    """
+    extra = cfg.MODEL.EXTRA
+    if 'FREEZE_LAYERS' in extra and extra['FREEZE_LAYERS']:
+        for layer in extra.FROZEN_LAYERS:
+            eval('model.' + layer + '.requires_grad_(False)')
+    return model
+
+
 def save_checkpoint(states, is_best, output_dir,
                     filename='checkpoint.pth'):
     torch.save(states, os.path.join(output_dir, filename))
@@ -0,0 +1,2352 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import collections
+import copy
+import glob
+import json
+import math
+import multiprocessing
+import os
+import resource
+import shutil
+import socket
+import tempfile
+import timeit
+
+import _init_paths
+import cv2
+import json_tricks
+import numpy as np
+import torch
+from config import cfg
+import models
+from core import pck
+from core.amp import autocast
+from core.loss import JointsMSELoss, JointsOHKMMSELoss
+from core.target import gaussian_patches, render_gaussian_targets, render_patches
+from core.execution import prepare_input, setup_model
+from core.evaluate import accuracy, get_target_joints
+from core.inference import decode_heatmaps, flip_test, get_final_preds, get_max_preds
+from dataset.coco import COCODataset
+from dataset.infinity import InfinityDataset
+from dataset.coco_eval import ParallelCOCOeval
+from dataset.infinity_coco import InfinityCocoDataset
+from dataset.JointsDataset import JointsDataset
+from dataset.JointsDB import JointsDB
+from dataset.keypoint_results import (
+    keypoint_annotations,
+    keypoint_nms,
+    rescore_keypoints,
+    select_results,
+    write_keypoint_results,
+)
+from nms.nms import (
+    COCO_SIGMAS,
+    oks_iou,
+    oks_matrix,
+    oks_nms,
+    soft_oks_nms,
+    soft_oks_nms_images,
+)
+from utils.heatmap import generate_gaussian_targets, gaussian_table_cache_info
+from utils.distributed import (
+    get_train_sampler,
+    get_val_sampler,
+    init_distributed,
+    wrap_model,
+)
+from utils.transforms import flip_back, flip_permutation, transform_preds
+from pycocotools.coco import COCO
+from pycocotools.cocoeval import COCOeval
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks on CPU")
+    subparsers = parser.add_subparsers(dest="name", required=True)
+
+    targets = subparsers.add_parser("targets", help="gaussian target generation")
+    targets.add_argument("--joints", type=int, nargs="+", default=[17, 36, 53])
+    targets.add_argument("--heatmap_size", type=int, nargs=2, default=[72, 96])
+    targets.add_argument("--image_size", type=int, nargs=2, default=[288, 384])
+    targets.add_argument("--sigma", type=int, default=3)
+    targets.add_argument("--number", type=int, default=200)
+    targets.add_argument("--workers", type=int, default=2)
+
+    db = subparsers.add_parser("db", help="per-sample annotation db access")
+    db.add_argument("--samples", type=int, default=150000)
+    db.add_argument("--joints", type=int, default=53)
+    db.add_argument("--number", type=int, default=20000)
+
+    memory = subparsers.add_parser(
+        "db_memory", help="memory of forked workers iterating over the db"
+    )
+    memory.add_argument("--samples", type=int, default=150000)
+    memory.add_argument("--joints", type=int, default=53)
+    memory.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8, 24])
+
+    select = subparsers.add_parser("select_data", help="JointsDataset.select_data")
+    select.add_argument("--samples", type=int, default=150000)
+    select.add_argument("--joints", type=int, default=17)
+    select.add_argument("--number", type=int, default=1)
+
+    final_preds = subparsers.add_parser(
+        "final_preds", help="heatmap decoding and back-projection"
+    )
+    final_preds.add_argument("--batch_size", type=int, nargs="+", default=[32, 128])
+    final_preds.add_argument("--joints", type=int, default=17)
+    final_preds.add_argument("--heatmap_size", type=int, nargs=2, default=[48, 64])
+    final_preds.add_argument("--number", type=int, default=20)
+
+    flip = subparsers.add_parser("flip_test", help="flip test inference on CPU")
+    flip.add_argument(
+        "--cfg", type=str, default="experiments/coco/hrnet/w32_256x192_adam_lr1e-3.yaml"
+    )
+    flip.add_argument("--batch_size", type=int, nargs="+", default=[1, 8])
+    flip.add_argument("--threads", type=int, default=0)
+    flip.add_argument("--number", type=int, default=3)
+
+    pck_parser = subparsers.add_parser("pck", help="PCK accuracy, checks parity")
+    pck_parser.add_argument("--batch_size", type=int, default=32)
+    pck_parser.add_argument("--heatmap_size", type=int, nargs=2, default=[48, 64])
+    pck_parser.add_argument("--number", type=int, default=20)
+
+    target_joints = subparsers.add_parser(
+        "target_joints",
+        help="get_target_joints vs the argmax of dataset targets, checks parity",
+    )
+    target_joints.add_argument("--images", type=int, default=100)
+    target_joints.add_argument("--objs", type=int, default=3)
+    target_joints.add_argument("--batch_size", type=int, default=32)
+
+    annotations = subparsers.add_parser(
+        "annotations", help="ground truth annotation parsing, checks parity"
+    )
+    annotations.add_argument("--images", type=int, default=4000)
+    annotations.add_argument("--objs", type=int, default=6)
+    annotations.add_argument("--number", type=int, default=1)
+
+    losses = subparsers.add_parser(
+        "losses", help="heatmap losses forward and backward, checks gradients"
+    )
+    losses.add_argument("--batch_size", type=int, default=32)
+    losses.add_argument("--joints", type=int, nargs="+", default=[17, 53])
+    losses.add_argument("--heatmap_size", type=int, nargs=2, default=[48, 64])
+    losses.add_argument("--number", type=int, default=10)
+
+    sparse = subparsers.add_parser(
+        "sparse_loss", help="loss against gaussian patches vs dense targets"
+    )
+    sparse.add_argument("--batch_size", type=int, default=32)
+    sparse.add_argument("--joints", type=int, nargs="+", default=[17, 53])
+    sparse.add_argument("--heatmap_size", type=int, nargs=2, default=[48, 64])
+    sparse.add_argument("--sigma", type=float, default=2)
+    sparse.add_argument("--number", type=int, default=10)
+
+    amp = subparsers.add_parser("amp", help="float32 vs bfloat16 training on CPU")
+    amp.add_argument(
+        "--cfg",
+        type=str,
+        nargs="+",
+        default=[
+            "experiments/coco/hrnet/w32_256x192_adam_lr1e-3.yaml",
+            "experiments/coco/hrnet/w48_256x192_adam_lr1e-3.yaml",
+        ],
+    )
+    amp.add_argument("--batch_size", type=int, default=4)
+    amp.add_argument("--threads", type=int, default=0)
+    amp.add_argument("--number", type=int, default=2)
+
+    ddp = subparsers.add_parser(
+        "ddp", help="DistributedDataParallel on CPU with gloo, checks parity"
+    )
+    ddp.add_argument("--world_size", type=int, default=3)
+    ddp.add_argument("--batch_size", type=int, default=4)
+    ddp.add_argument("--steps", type=int, default=5)
+
+    ddp_val = subparsers.add_parser(
+        "ddp_validate", help="sharded validate() on CPU with gloo, checks parity"
+    )
+    ddp_val.add_argument("--world_size", type=int, default=3)
+    ddp_val.add_argument("--samples", type=int, default=50)
+    ddp_val.add_argument("--batch_size", type=int, default=4)
+
+    execution = subparsers.add_parser(
+        "execution", help="channels_last / torch.compile inference latency on CPU"
+    )
+    execution.add_argument(
+        "--cfg",
+        type=str,
+        nargs="+",
+        default=sorted(glob.glob("experiments/*/*/*.yaml")),
+    )
+    execution.add_argument("--batch_size", type=int, default=1)
+    execution.add_argument("--threads", type=int, default=0)
+    execution.add_argument("--number", type=int, default=3)
+
+    ckpt = subparsers.add_parser(
+        "checkpointing", help="HRNet activation checkpointing, memory vs time"
+    )
+    ckpt.add_argument(
+        "--cfg",
+        type=str,
+        nargs="+",
+        default=[
+            "experiments/infinity_coco/hrnet/w48_384x288_adam_lr1e-3.yaml",
+            "experiments/infinity_coco/hrnet/w64_384x288_adam_lr1e-3.yaml",
+        ],
+    )
+    ckpt.add_argument("--batch_size", type=int, default=2)
+    ckpt.add_argument("--threads", type=int, default=0)
+    ckpt.add_argument("--number", type=int, default=1)
+
+    oks = subparsers.add_parser(
+        "oks_nms", help="oks_nms on crowded synthetic images, checks parity"
+    )
+    oks.add_argument("--num_dets", type=int, nargs="+", default=[100, 200, 500])
+    oks.add_argument("--num_joints", type=int, default=17)
+    oks.add_argument("--images", type=int, default=3)
+    oks.add_argument("--thresh", type=float, default=0.9)
+    oks.add_argument("--in_vis_thre", type=float, default=0.2)
+    oks.add_argument("--number", type=int, default=1)
+
+    soft = subparsers.add_parser(
+        "soft_nms", help="per image vs batched soft oks nms, checks parity"
+    )
+    soft.add_argument("--images", type=int, default=5000)
+    soft.add_argument("--dets_per_image", type=int, default=21)
+    soft.add_argument("--num_joints", type=int, nargs="+", default=[17, 36, 53])
+    soft.add_argument("--thresh", type=float, default=0.9)
+
+    eval_nms = subparsers.add_parser(
+        "evaluate_nms", help="rescoring and oks nms of evaluate(), checks parity"
+    )
+    eval_nms.add_argument("--images", type=int, default=5000)
+    eval_nms.add_argument("--dets_per_image", type=int, default=21)
+    eval_nms.add_argument("--in_vis_thre", type=float, default=0.2)
+    eval_nms.add_argument("--oks_thre", type=float, default=0.9)
+
+    results_json = subparsers.add_parser(
+        "results_json",
+        help="keypoint results json vs in memory loadRes, checks parity",
+    )
+    results_json.add_argument("--images", type=int, default=2000)
+    results_json.add_argument("--dets_per_image", type=int, default=21)
+    results_json.add_argument("--in_vis_thre", type=float, default=0.2)
+    results_json.add_argument("--oks_thre", type=float, default=0.9)
+
+    coco_eval = subparsers.add_parser(
+        "coco_eval", help="COCOeval vs ParallelCOCOeval, checks parity"
+    )
+    coco_eval.add_argument("--images", type=int, default=2000)
+    coco_eval.add_argument("--dets_per_image", type=int, default=21)
+    coco_eval.add_argument("--in_vis_thre", type=float, default=0.2)
+    coco_eval.add_argument("--workers", type=int, nargs="+", default=[2, 4])
+
+    return parser.parse_args()
+
+
+def _timeit(fn, number):
+    """best of 3 runs, in milliseconds per call"""
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e3
+
+
+def _print_table(header, rows):
+    print("| " + " | ".join(header) + " |")
+    print("|---" * len(header) + "|")
+    for row in rows:
+        print("| " + " | ".join(str(r) for r in row) + " |")
+
+
+def _random_joints(num_joints, image_size, rng):
+    """joints spread slightly beyond the crop, about 20% invisible"""
+    joints = np.zeros((num_joints, 3), dtype=np.float32)
+    joints[:, 0] = rng.uniform(-0.1, 1.1, num_joints) * image_size[0]
+    joints[:, 1] = rng.uniform(-0.1, 1.1, num_joints) * image_size[1]
+    joints_vis = np.zeros((num_joints, 3), dtype=np.float32)
+    joints_vis[:, 0:2] = (rng.uniform(size=num_joints) > 0.2)[:, None]
+    return joints, joints_vis
+
+
+def _generate_target_loop(joints, joints_vis, image_size, heatmap_size, sigma):
+    """per-joint reference, as JointsDataset.generate_target used to do it"""
+    num_joints = joints.shape[0]
+    target_weight = np.ones((num_joints, 1), dtype=np.float32)
+    target_weight[:, 0] = joints_vis[:, 0]
+    target = np.zeros((num_joints, heatmap_size[1], heatmap_size[0]), dtype=np.float32)
+
+    tmp_size = sigma * 3
+    for joint_id in range(num_joints):
+        feat_stride = image_size / heatmap_size
+        mu_x = int(joints[joint_id][0] / feat_stride[0] + 0.5)
+        mu_y = int(joints[joint_id][1] / feat_stride[1] + 0.5)
+        ul = [int(mu_x - tmp_size), int(mu_y - tmp_size)]
+        br = [int(mu_x + tmp_size + 1), int(mu_y + tmp_size + 1)]
+        if (
+            ul[0] >= heatmap_size[0]
+            or ul[1] >= heatmap_size[1]
+            or br[0] < 0
+            or br[1] < 0
+        ):
+            target_weight[joint_id] = 0
+            continue
+
+        size = 2 * tmp_size + 1
+        x = np.arange(0, size, 1, np.float32)
+        y = x[:, np.newaxis]
+        x0 = y0 = size // 2
+        g = np.exp(-((x - x0) ** 2 + (y - y0) ** 2) / (2 * sigma**2))
+
+        g_x = max(0, -ul[0]), min(br[0], heatmap_size[0]) - ul[0]
+        g_y = max(0, -ul[1]), min(br[1], heatmap_size[1]) - ul[1]
+        img_x = max(0, ul[0]), min(br[0], heatmap_size[0])
+        img_y = max(0, ul[1]), min(br[1], heatmap_size[1])
+
+        if target_weight[joint_id] > 0.5:
+            target[joint_id][img_y[0] : img_y[1], img_x[0] : img_x[1]] = g[
+                g_y[0] : g_y[1], g_x[0] : g_x[1]
+            ]
+
+    return target, target_weight
+
+
+def _edge_joints(num_joints, image_size, heatmap_size, sigma):
+    """
+    joints whose gaussians lie partly, just not or entirely off the heatmap,
+    as columns (x, y), along with one invisible joint in the middle
+    """
+    feat_stride = image_size / heatmap_size
+    tmp_size = sigma * 3
+    # heatmap locations of mu, the gaussian spans [mu - tmp_size, mu + tmp_size]
+    mus = [
+        (-tmp_size, heatmap_size[1] // 2),  # partly on the heatmap
+        (-tmp_size - 1, heatmap_size[1] // 2),  # br == 0, kept with weight 1
+        (-tmp_size - 2, heatmap_size[1] // 2),  # off the heatmap
+        (heatmap_size[0] // 2, heatmap_size[1] + tmp_size - 1),  # partly on
+        (heatmap_size[0] // 2, heatmap_size[1] + tmp_size),  # ul == height, off
+        (heatmap_size[0] + 5 * tmp_size, -5 * tmp_size),  # far off
+        (heatmap_size[0] // 2, heatmap_size[1] // 2),  # invisible
+    ]
+    joints = np.zeros((num_joints, 3), dtype=np.float32)
+    joints_vis = np.ones((num_joints, 3), dtype=np.float32)
+    for joint_id, mu in enumerate(mus[:num_joints]):
+        # mu is int(x / feat_stride + 0.5), truncated toward zero
+        mu = np.array(mu, dtype=np.float32)
+        joints[joint_id, 0:2] = np.where(mu < 0, mu - 1, mu) * feat_stride
+    joints_vis[min(len(mus), num_joints) - 1] = 0
+    return joints, joints_vis
+
+
+def _device_targets(c, dataset, joints, joints_vis, subpixel):
+    """the batch targets as core.function renders them with TARGET_ON_DEVICE"""
+    target, target_weight = render_gaussian_targets(
+        torch.from_numpy(joints),
+        torch.from_numpy(joints_vis),
+        c.MODEL.IMAGE_SIZE,
+        c.MODEL.HEATMAP_SIZE,
+        c.MODEL.SIGMA,
+        subpixel=subpixel,
+    )
+    patches, patch_weight = gaussian_patches(
+        torch.from_numpy(joints),
+        torch.from_numpy(joints_vis),
+        c.MODEL.IMAGE_SIZE,
+        c.MODEL.HEATMAP_SIZE,
+        c.MODEL.SIGMA,
+        subpixel=subpixel,
+    )
+    assert torch.equal(target_weight, patch_weight)
+    if c.LOSS.USE_DIFFERENT_JOINTS_WEIGHT:
+        joints_weight = torch.as_tensor(dataset.joints_weight, dtype=torch.float32)
+        target_weight = target_weight * joints_weight
+    return target, render_patches(patches, c.MODEL.HEATMAP_SIZE), target_weight
+
+
+def _check_device_targets(args, num_joints, rng):
+    """
+    render_gaussian_targets and gaussian_patches of a batch against
+    JointsDataset.generate_target of its samples, with and without the joints
+    weight and sub-pixel targets
+    """
+    image_size = np.array(args.image_size)
+    heatmap_size = np.array(args.heatmap_size)
+    samples = [_random_joints(num_joints, image_size, rng) for _ in range(8)]
+    samples[0] = _edge_joints(num_joints, image_size, heatmap_size, args.sigma)
+    joints = np.stack([j for j, _ in samples])
+    joints_vis = np.stack([v for _, v in samples])
+
+    for use_joints_weight in (False, True):
+        for subpixel in (False, True):
+            c = cfg.clone()
+            c.defrost()
+            c.MODEL.IMAGE_SIZE = list(args.image_size)
+            c.MODEL.HEATMAP_SIZE = list(args.heatmap_size)
+            c.MODEL.SIGMA = args.sigma
+            c.MODEL.SUBPIXEL_TARGET = subpixel
+            c.MODEL.TARGET_ON_DEVICE = True
+            c.LOSS.USE_DIFFERENT_JOINTS_WEIGHT = use_joints_weight
+            dataset = JointsDataset(c, "", "train", True)
+            dataset.num_joints = num_joints
+            dataset.joints_weight = rng.uniform(0.5, 1.5, (num_joints, 1))
+
+            refs = [dataset.generate_target(j, v) for j, v in samples]
+            ref = np.stack([t for t, _ in refs])
+            ref_weight = np.stack([w for _, w in refs])
+            target, dense, target_weight = _device_targets(
+                c, dataset, joints, joints_vis, subpixel
+            )
+            # exp of float64 distances on the device, of float32 in the table
+            assert np.allclose(target.numpy(), ref, atol=1e-6)
+            assert np.allclose(dense.numpy(), ref, atol=1e-6)
+            assert np.allclose(target_weight.numpy(), ref_weight, rtol=1e-6)
+            assert np.array_equal(target_weight.numpy() > 0, ref_weight > 0)
+
+
+def bench_targets(args):
+    rng = np.random.RandomState(0)
+    image_size = np.array(args.image_size)
+    heatmap_size = np.array(args.heatmap_size)
+
+    rows = []
+    for num_joints in args.joints:
+        _check_device_targets(args, num_joints, rng)
+        joints, joints_vis = _random_joints(num_joints, image_size, rng)
+
+        ref = _generate_target_loop(
+            joints, joints_vis, image_size, heatmap_size, args.sigma
+        )
+        out = generate_gaussian_targets(
+            joints, joints_vis, image_size, heatmap_size, args.sigma
+        )
+        assert np.array_equal(ref[0], out[0]) and np.array_equal(ref[1], out[1])
+
+        t_loop = _timeit(
+            lambda: _generate_target_loop(
+                joints, joints_vis, image_size, heatmap_size, args.sigma
+            ),
+            args.number,
+        )
+        t_vec = _timeit(
+            lambda: generate_gaussian_targets(
+                joints, joints_vis, image_size, heatmap_size, args.sigma
+            ),
+            args.number,
+        )
+        t_sub = _timeit(
+            lambda: generate_gaussian_targets(
+                joints, joints_vis, image_size, heatmap_size, args.sigma, subpixel=True
+            ),
+            args.number,
+        )
+        rows.append(
+            (
+                num_joints,
+                "{:.3f}".format(t_loop),
+                "{:.3f}".format(t_vec),
+                "{:.3f}".format(t_sub),
+                "{:.1f}x".format(t_loop / t_vec),
+            )
+        )
+
+    _print_table(
+        ("Joints", "Loop (ms)", "Vectorized (ms)", "Sub-pixel (ms)", "Speedup"), rows
+    )
+
+    # forked workers inherit the parent's cache and keep their own counters
+    print("main process: {}".format(gaussian_table_cache_info()))
+    ctx = multiprocessing.get_context("fork")
+    with ctx.Pool(args.workers) as pool:
+        infos = pool.map(
+            _render_in_worker,
+            [(n, image_size, heatmap_size, args.sigma) for n in args.joints],
+        )
+    for num_joints, info in zip(args.joints, infos):
+        print("worker, {} joints: {}".format(num_joints, info))
+
+
+def _render_in_worker(params):
+    num_joints, image_size, heatmap_size, sigma = params
+    rng = np.random.RandomState(num_joints)
+    for _ in range(100):
+        joints, joints_vis = _random_joints(num_joints, image_size, rng)
+        generate_gaussian_targets(joints, joints_vis, image_size, heatmap_size, sigma)
+    return gaussian_table_cache_info()
+
+
+def _random_records(num_samples, num_joints, rng):
+    """coco-like ground truth records, ~20 instances per image"""
+    joints_3d = rng.uniform(0, 640, (num_samples, num_joints, 3)).astype(np.float32)
+    joints_3d[:, :, 2] = 0
+    joints_3d_vis = np.zeros((num_samples, num_joints, 3), dtype=np.float32)
+    joints_3d_vis[:, :, 0:2] = (rng.uniform(size=(num_samples, num_joints)) > 0.4)[
+        :, :, None
+    ]
+    center = rng.uniform(100, 500, (num_samples, 2)).astype(np.float32)
+    scale = rng.uniform(0.2, 2.0, (num_samples, 2)).astype(np.float32)
+    return [
+        {
+            "image": "data/coco/images/train2017/%012d.jpg" % (i // 20),
+            "center": center[i],
+            "scale": scale[i],
+            "joints_3d": joints_3d[i],
+            "joints_3d_vis": joints_3d_vis[i],
+            "filename": "",
+            "imgnum": 0,
+        }
+        for i in range(num_samples)
+    ]
+
+
+def bench_db(args):
+    rng = np.random.RandomState(0)
+    records = _random_records(args.samples, args.joints, rng)
+    db = JointsDB.from_records(records)
+    indices = rng.randint(0, args.samples, args.number)
+
+    def deepcopy_records():
+        for idx in indices:
+            copy.deepcopy(records[idx])
+
+    def sample_db():
+        for idx in indices:
+            db.sample(idx)
+
+    t_deepcopy = _timeit(deepcopy_records, 1) / args.number * 1e3
+    t_sample = _timeit(sample_db, 1) / args.number * 1e3
+    _print_table(
+        ("Samples", "Joints", "deepcopy (us)", "JointsDB.sample (us)", "Speedup"),
+        [
+            (
+                args.samples,
+                args.joints,
+                "{:.2f}".format(t_deepcopy),
+                "{:.2f}".format(t_sample),
+                "{:.1f}x".format(t_deepcopy / t_sample),
+            )
+        ],
+    )
+
+
+def _select_data_loop(db, pixel_std):
+    """per record reference, as JointsDataset.select_data used to do it"""
+    db_selected = []
+    for rec in db:
+        num_vis = 0
+        joints_x = 0.0
+        joints_y = 0.0
+        for joint, joint_vis in zip(rec["joints_3d"], rec["joints_3d_vis"]):
+            if joint_vis[0] <= 0:
+                continue
+            num_vis += 1
+
+            joints_x += joint[0]
+            joints_y += joint[1]
+        if num_vis == 0:
+            continue
+
+        joints_x, joints_y = joints_x / num_vis, joints_y / num_vis
+
+        area = rec["scale"][0] * rec["scale"][1] * (pixel_std**2)
+        joints_center = np.array([joints_x, joints_y])
+        bbox_center = np.array(rec["center"])
+        diff_norm2 = np.linalg.norm((joints_center - bbox_center), 2)
+        ks = np.exp(-1.0 * (diff_norm2**2) / ((0.2) ** 2 * 2.0 * area))
+
+        metric = (0.2 / 16) * num_vis + 0.45 - 0.2 / 16
+        if ks > metric:
+            db_selected.append(rec)
+    return db_selected
+
+
+def bench_select_data(args):
+    rng = np.random.RandomState(0)
+    db = JointsDB.from_records(_random_records(args.samples, args.joints, rng))
+    # joints scattered around the box center, so that about half is selected
+    spread = db.scale[:, None, :] * 200 * rng.uniform(0, 3, (len(db), 1, 1))
+    db.joints_3d[:, :, 0:2] = db.center[:, None, :] + spread * rng.uniform(
+        -1, 1, (len(db), args.joints, 2)
+    )
+    records = list(db)
+
+    dataset = JointsDataset.__new__(JointsDataset)
+    dataset.pixel_std = 200
+
+    ref = JointsDB.from_records(_select_data_loop(records, dataset.pixel_std))
+    out = dataset.select_data(db)
+    for column in ("joints_3d", "joints_3d_vis", "center", "scale", "image"):
+        assert np.array_equal(getattr(ref, column), getattr(out, column)), column
+
+    t_loop = _timeit(lambda: _select_data_loop(records, dataset.pixel_std), args.number)
+    t_vec = _timeit(lambda: dataset.select_data(db), args.number)
+    _print_table(
+        ("Samples", "Joints", "Selected", "Loop (ms)", "Vectorized (ms)", "Speedup"),
+        [
+            (
+                args.samples,
+                args.joints,
+                len(out),
+                "{:.1f}".format(t_loop),
+                "{:.1f}".format(t_vec),
+                "{:.1f}x".format(t_loop / t_vec),
+            )
+        ],
+    )
+
+
+def _memory_kb():
+    """private dirty and proportional set size of this process, in kB"""
+    fields = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return fields["Private_Dirty"], fields["Pss"]
+
+
+def _iterate_db(db, queue):
+    """one epoch of JointsDataset.__getitem__ db accesses in a forked worker"""
+    if isinstance(db, list):
+        for idx in range(len(db)):
+            copy.deepcopy(db[idx])
+    else:
+        for idx in range(len(db)):
+            db.sample(idx)
+    queue.put(_memory_kb())
+
+
+def _measure_db(kind, db_dir, args, num_workers, result):
+    """
+    runs in a fresh (spawned) process: build one kind of db, fork the
+    workers and report their memory together with our own
+    """
+    if kind == "mmap":
+        db = JointsDB.load(db_dir, mmap_mode="r")
+    else:
+        db = _random_records(args.samples, args.joints, np.random.RandomState(0))
+        if kind == "array":
+            db = JointsDB.from_records(db)
+
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+    workers = [
+        ctx.Process(target=_iterate_db, args=(db, queue)) for _ in range(num_workers)
+    ]
+    for w in workers:
+        w.start()
+    usage = [queue.get() for _ in workers]
+    for w in workers:
+        w.join()
+    result.put((usage, _memory_kb()[1]))
+
+
+def bench_db_memory(args):
+    db = JointsDB.from_records(
+        _random_records(args.samples, args.joints, np.random.RandomState(0))
+    )
+    db_dir = tempfile.mkdtemp(prefix="db_")
+    ctx = multiprocessing.get_context("spawn")
+    rows = []
+    try:
+        db.save(db_dir)
+        del db
+        for kind, name in (
+            ("list", "list of dicts"),
+            ("array", "JointsDB"),
+            ("mmap", "JointsDB mmap"),
+        ):
+            for num_workers in args.workers:
+                result = ctx.Queue()
+                p = ctx.Process(
+                    target=_measure_db, args=(kind, db_dir, args, num_workers, result)
+                )
+                p.start()
+                usage, main_pss = result.get()
+                p.join()
+                dirty = sum(d for d, _ in usage) / num_workers / 1024
+                pss = (main_pss + sum(p for _, p in usage)) / 1024
+                rows.append(
+                    (name, num_workers, "{:.1f}".format(dirty), "{:.1f}".format(pss))
+                )
+    finally:
+        shutil.rmtree(db_dir)
+
+    _print_table(("DB", "Workers", "Private dirty MB / worker", "Total PSS MB"), rows)
+
+
+def _random_ann(rng, ann_id, image_id, category_id):
+    """coco-like annotation, including boxes the kernels clip or drop"""
+    x, y = rng.uniform(-50, 600, 2).round(2)
+    w, h = rng.choice([0.5, 30.0, 200.0, 900.0]) * rng.uniform(0.5, 1.5, 2)
+    kpts = np.zeros((17, 3), dtype=np.int64)
+    if rng.uniform() > 0.1:
+        kpts[:, 0:2] = rng.randint(0, 640, (17, 2))
+        kpts[:, 2] = rng.randint(0, 3, 17)
+    return {
+        "id": ann_id,
+        "image_id": image_id,
+        "category_id": category_id,
+        "bbox": [float(x), float(y), float(w), float(h)],
+        "area": float(w * h) if rng.uniform() > 0.05 else 0.0,
+        "iscrowd": int(rng.uniform() < 0.05),
+        "num_keypoints": int((kpts[:, 2] > 0).sum()),
+        "keypoints": kpts.ravel().tolist(),
+    }
+
+
+def _flip_test_two_pass(model, input, flip_pairs):
+    """two forward passes and a numpy flip_back, as validate() used to do it"""
+    output = model(input)
+    output_flipped = model(input.flip(3))
+    output_flipped = flip_back(output_flipped.cpu().numpy(), flip_pairs)
+    output_flipped = torch.from_numpy(output_flipped.copy())
+    output_flipped[:, :, :, 1:] = output_flipped.clone()[:, :, :, 0:-1]
+    return (output + output_flipped) * 0.5
+
+
+def bench_flip_test(args):
+    c = cfg.clone()
+    c.defrost()
+    c.merge_from_file(args.cfg)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    model = eval("models." + c.MODEL.NAME + ".get_pose_net")(c, is_train=False)
+    model.eval()
+    # coco left/right joints
+    flip_pairs = [[i, i + 1] for i in range(1, c.MODEL.NUM_JOINTS - 1, 2)]
+    flip_perm = torch.as_tensor(flip_permutation(c.MODEL.NUM_JOINTS, flip_pairs))
+
+    rows = []
+    with torch.no_grad():
+        for batch_size in args.batch_size:
+            input = torch.randn(
+                batch_size, 3, c.MODEL.IMAGE_SIZE[1], c.MODEL.IMAGE_SIZE[0]
+            )
+            ref = _flip_test_two_pass(model, input, flip_pairs)
+            out = flip_test(model, input, flip_perm, shift_heatmap=True)
+            assert torch.allclose(ref, out, atol=1e-5)
+
+            t_two = _timeit(
+                lambda: _flip_test_two_pass(model, input, flip_pairs), args.number
+            )
+            t_one = _timeit(
+                lambda: flip_test(model, input, flip_perm, True), args.number
+            )
+            rows.append(
+                (
+                    batch_size,
+                    "{:.1f}".format(t_two),
+                    "{:.1f}".format(t_one),
+                    "{:.1f}".format(t_two - t_one),
+                )
+            )
+
+    _print_table(
+        ("Batch", "Two passes + numpy (ms)", "One 2B pass (ms)", "Saved (ms)"), rows
+    )
+
+
+def _calc_dists_loop(preds, target, normalize):
+    """per joint reference, as core.evaluate.calc_dists used to do it"""
+    preds = preds.astype(np.float32)
+    target = target.astype(np.float32)
+    dists = np.zeros((preds.shape[1], preds.shape[0]))
+    for n in range(preds.shape[0]):
+        for c in range(preds.shape[1]):
+            if target[n, c, 0] > 1 and target[n, c, 1] > 1:
+                normed_preds = preds[n, c, :] / normalize[n]
+                normed_targets = target[n, c, :] / normalize[n]
+                dists[c, n] = np.linalg.norm(normed_preds - normed_targets)
+            else:
+                dists[c, n] = -1
+    return dists
+
+
+def _get_acc_loop(dists):
+    """per joint reference, as core.evaluate.get_acc used to do it"""
+    acc = np.zeros((len(dists) + 1))
+    avg_acc = 0
+    cnt = 0
+    for i in range(len(dists)):
+        dist_cal = np.not_equal(dists[i], -1)
+        num_dist_cal = dist_cal.sum()
+        if num_dist_cal > 0:
+            acc[i + 1] = np.less(dists[i][dist_cal], 0.5).sum() * 1.0 / num_dist_cal
+        else:
+            acc[i + 1] = -1
+        if acc[i + 1] >= 0:
+            avg_acc = avg_acc + acc[i + 1]
+            cnt += 1
+    avg_acc = avg_acc / cnt if cnt != 0 else 0
+    if cnt != 0:
+        acc[0] = avg_acc
+    return acc, avg_acc, cnt
+
+
+def _accuracy_groups_loop(pred, target, norm, infinity_idxs):
+    """infinity, anatomical and coco splits, as accuracy_infinity_coco did it"""
+    return (
+        _get_acc_loop(
+            _calc_dists_loop(
+                pred.copy()[infinity_idxs],
+                target.copy()[infinity_idxs],
+                norm.copy()[infinity_idxs],
+            )
+        ),
+        _get_acc_loop(
+            _calc_dists_loop(
+                pred.copy()[infinity_idxs][:, 17:],
+                target.copy()[infinity_idxs][:, 17:],
+                norm.copy()[infinity_idxs],
+            )
+        ),
+        _get_acc_loop(
+            _calc_dists_loop(
+                pred.copy()[~infinity_idxs][:, :17],
+                target.copy()[~infinity_idxs][:, :17],
+                norm.copy()[~infinity_idxs],
+            )
+        ),
+    )
+
+
+def _accuracy_groups(pred, target, norm, infinity_idxs):
+    dists = pck.calc_dists(pred, target, norm)
+    return (
+        pck.get_acc(dists, mask=infinity_idxs),
+        pck.get_acc(dists[17:], mask=infinity_idxs),
+        pck.get_acc(dists[:17], mask=~infinity_idxs),
+    )
+
+
+def _pck_curve_loop(scaled_err, visible, thresholds):
+    """per threshold reference, as MPIIDataset.evaluate used to do it"""
+    jnt_count = np.sum(visible, axis=1)
+    pck_all = np.zeros((len(thresholds), len(scaled_err)))
+    for r in range(len(thresholds)):
+        less_than_threshold = np.multiply(scaled_err <= thresholds[r], visible)
+        pck_all[r, :] = np.divide(
+            100.0 * np.sum(less_than_threshold, axis=1), jnt_count
+        )
+    return pck_all
+
+
+def bench_pck(args):
+    rng = np.random.RandomState(0)
+    width, height = args.heatmap_size
+    norm = np.ones((args.batch_size, 2)) * np.array([height, width]) / 10
+
+    def random_joints(num_joints):
+        joints = rng.uniform(0, width, (args.batch_size, num_joints, 2))
+        joints[rng.uniform(size=joints.shape) < 0.1] = 0
+        return joints.round().astype(np.float32)
+
+    rows = []
+    for name, num_joints in (("accuracy", 17), ("accuracy_infinity_coco", 53)):
+        target = random_joints(num_joints)
+        pred = target + rng.normal(0, 2, target.shape).round().astype(np.float32)
+        if num_joints == 53:
+            infinity_idxs = rng.uniform(size=args.batch_size) < 0.5
+            target[~infinity_idxs, 17:] = 0
+
+            def loop():
+                return _accuracy_groups_loop(pred, target, norm, infinity_idxs)
+
+            def vec():
+                return _accuracy_groups(pred, target, norm, infinity_idxs)
+
+        else:
+
+            def loop():
+                return (_get_acc_loop(_calc_dists_loop(pred, target, norm)),)
+
+            def vec():
+                return (pck.get_acc(pck.calc_dists(pred, target, norm)),)
+
+        for ref, out in zip(loop(), vec()):
+            assert np.array_equal(ref[0], out[0]) and ref[1:] == out[1:]
+
+        t_loop = _timeit(loop, args.number)
+        t_vec = _timeit(vec, args.number)
+        rows.append(
+            (
+                name,
+                args.batch_size,
+                num_joints,
+                "{:.2f}".format(t_loop),
+                "{:.2f}".format(t_vec),
+                "{:.1f}x".format(t_loop / t_vec),
+            )
+        )
+
+    # MPII PCKh threshold sweep over the 2958 validation people
+    visible = (rng.uniform(size=(16, 2958)) > 0.1).astype(np.float64)
+    scaled_err = rng.exponential(0.2, (16, 2958)) * visible
+    thresholds = np.arange(0, 0.5 + 0.01, 0.01)
+    ref = _pck_curve_loop(scaled_err, visible, thresholds)
+    assert np.array_equal(ref, pck.pck_curve(scaled_err, visible, thresholds))
+    t_loop = _timeit(lambda: _pck_curve_loop(scaled_err, visible, thresholds), 20)
+    t_vec = _timeit(lambda: pck.pck_curve(scaled_err, visible, thresholds), 20)
+    rows.append(
+        (
+            "mpii pckAll",
+            2958,
+            16,
+            "{:.2f}".format(t_loop),
+            "{:.2f}".format(t_vec),
+            "{:.1f}x".format(t_loop / t_vec),
+        )
+    )
+
+    _print_table(
+        ("Metric", "Samples", "Joints", "Loop (ms)", "Vectorized (ms)", "Speedup"),
+        rows,
+    )
+
+
+def bench_target_joints(args):
+    root = tempfile.mkdtemp(prefix="target_joints_")
+    rows = []
+    try:
+        root_coco, root_infinity = _write_annotations(
+            root, args.images, args.objs, np.random.RandomState(0)
+        )
+        c = cfg.clone()
+        c.defrost()
+        c.OUTPUT_DIR = root
+        c.DATASET.ROOT_COCO = root_coco
+        c.DATASET.TRAIN_SET_COCO = "train2017"
+        c.MODEL.IMAGE_SIZE = [192, 256]
+        c.MODEL.HEATMAP_SIZE = [48, 64]
+
+        np.random.seed(0)
+        for name, make_dataset in (
+            ("coco", lambda: COCODataset(c, root_coco, "train2017", True)),
+            (
+                "infinity_coco",
+                lambda: InfinityCocoDataset(c, root_infinity, "train", True),
+            ),
+        ):
+            dataset = make_dataset()
+            # blank images, the targets only depend on the annotations
+            for image_file in set(dataset.db[i]["image"] for i in range(len(dataset))):
+                os.makedirs(os.path.dirname(image_file), exist_ok=True)
+                cv2.imwrite(image_file, np.zeros((480, 640, 3), dtype=np.uint8))
+            # with augmentation: scale, rotation, flip, half body
+            loader = torch.utils.data.DataLoader(
+                dataset, batch_size=args.batch_size, shuffle=True
+            )
+            num_labels = 0
+            for _, target, target_weight, meta in loader:
+                ref, _ = get_max_preds(target.numpy())
+                out = get_target_joints(
+                    meta["joints"],
+                    target_weight,
+                    c.MODEL.IMAGE_SIZE,
+                    c.MODEL.HEATMAP_SIZE,
+                )
+                # generate_target keeps the weight of a joint whose gaussian
+                # misses the heatmap: no argmax, a label on the border.
+                # Both are unlabeled for the pck, which needs x > 1 and y > 1
+                labeled = np.all(ref > 1, axis=2)
+                assert np.array_equal(labeled, np.all(out > 1, axis=2))
+                assert np.array_equal(ref[labeled], out[labeled])
+                output = target + 0.1 * torch.rand(target.shape)
+                ref_acc = accuracy(output, target)
+                out_acc = accuracy(output, target, target_joints=out)
+                assert np.array_equal(ref_acc[0], out_acc[0])
+                assert ref_acc[1:3] == out_acc[1:3]
+                num_labels += int(labeled.sum())
+
+            target = target.numpy()
+            t_argmax = _timeit(lambda: get_max_preds(target), 20)
+            t_joints = _timeit(
+                lambda: get_target_joints(
+                    meta["joints"],
+                    target_weight,
+                    c.MODEL.IMAGE_SIZE,
+                    c.MODEL.HEATMAP_SIZE,
+                ),
+                20,
+            )
+            rows.append(
+                (
+                    name,
+                    len(dataset),
+                    num_labels,
+                    "{:.2f}".format(t_argmax),
+                    "{:.2f}".format(t_joints),
+                    "{:.1f}x".format(t_argmax / t_joints),
+                )
+            )
+    finally:
+        shutil.rmtree(root)
+
+    _print_table(
+        (
+            "Dataset",
+            "Samples",
+            "Labeled joints",
+            "Argmax of the last batch (ms)",
+            "get_target_joints (ms)",
+            "Speedup",
+        ),
+        rows,
+    )
+
+
+def _write_annotations(root, num_images, num_objs, rng):
+    """synthetic coco and infinity splits, returns the coco and infinity roots"""
+    names = ["augmented_{}".format(i) for i in range(36)]
+    images = [
+        {"id": i, "file_name": "{}.png".format(i), "width": 640, "height": 480}
+        for i in range(1, num_images + 1)
+    ]
+
+    coco = {
+        "images": images,
+        "annotations": [
+            _random_ann(rng, i, 1 + i // num_objs, 1)
+            for i in range(num_images * num_objs)
+        ],
+        "categories": [{"id": 1, "name": "person"}],
+    }
+    infinity = {
+        "images": images,
+        "annotations": [
+            _random_ann(rng, i, 1 + i // num_objs, 0)
+            for i in range(num_images * num_objs)
+        ],
+        "categories": [{"id": 0, "name": "person", "augmented_keypoints": names}],
+    }
+    for ann in infinity["annotations"]:
+        ann["coco_keypoints"] = ann["keypoints"]
+        xyv = rng.uniform(-10, 650, (len(names), 3)).round(3)
+        xyv[:, 2] = rng.randint(0, 3, len(names))
+        ann["keypoints"] = {
+            name: {"x": x, "y": y, "v": v} for name, (x, y, v) in zip(names, xyv)
+        }
+
+    os.makedirs(os.path.join(root, "coco", "annotations"))
+    with open(
+        os.path.join(root, "coco", "annotations", "person_keypoints_train2017.json"),
+        "w",
+    ) as f:
+        json.dump(coco, f)
+    os.makedirs(os.path.join(root, "infinity", "train"))
+    with open(os.path.join(root, "infinity", "train", "annotations.json"), "w") as f:
+        json.dump(infinity, f)
+    return os.path.join(root, "coco"), os.path.join(root, "infinity")
+
+
+def _load_annotations_loop(dataset):
+    """per image reference, as _load_coco_keypoint_annotations used to do it"""
+    gt_db = []
+    if isinstance(dataset, InfinityCocoDataset):
+        ratio = dataset.coco_infinity_ratio
+        for i, index in enumerate(dataset.image_set_index):
+            indices_coco = dataset.coco_dataset.image_set_index[
+                i * ratio : (i + 1) * ratio
+            ]
+            gt_db.extend(
+                dataset._load_coco_keypoint_annotation_kernal(index, indices_coco)
+            )
+    else:
+        for index in dataset.image_set_index:
+            gt_db.extend(dataset._load_coco_keypoint_annotation_kernal(index))
+    return gt_db
+
+
+def _assert_same_records(ref, out):
+    assert len(ref) == len(out), (len(ref), len(out))
+    for a, b in zip(ref, out):
+        assert sorted(a.keys()) == sorted(b.keys())
+        for key in a:
+            if isinstance(a[key], np.ndarray):
+                assert a[key].dtype == b[key].dtype, key
+                assert np.array_equal(a[key], b[key]), key
+            else:
+                assert a[key] == b[key], key
+
+
+def bench_annotations(args):
+    root = tempfile.mkdtemp(prefix="annotations_")
+    rows = []
+    try:
+        root_coco, root_infinity = _write_annotations(
+            root, args.images, args.objs, np.random.RandomState(0)
+        )
+        c = cfg.clone()
+        c.defrost()
+        c.OUTPUT_DIR = root
+        c.DATASET.ROOT_COCO = root_coco
+        c.DATASET.TRAIN_SET_COCO = "train2017"
+
+        for name, dataset in (
+            ("coco", COCODataset(c, root_coco, "train2017", True)),
+            ("infinity", InfinityDataset(c, root_infinity, "train", True)),
+            ("infinity_coco", InfinityCocoDataset(c, root_infinity, "train", True)),
+        ):
+            ref = _load_annotations_loop(dataset)
+            out = dataset._load_coco_keypoint_annotations()
+            _assert_same_records(ref, out)
+
+            t_loop = _timeit(lambda: _load_annotations_loop(dataset), args.number)
+            t_bulk = _timeit(
+                lambda: dataset._load_coco_keypoint_annotations(), args.number
+            )
+            rows.append(
+                (
+                    name,
+                    len(out),
+                    "{:.1f}".format(t_loop),
+                    "{:.1f}".format(t_bulk),
+                    "{:.1f}x".format(t_loop / t_bulk),
+                )
+            )
+    finally:
+        shutil.rmtree(root)
+
+    _print_table(("Dataset", "Records", "Loop (ms)", "Bulk (ms)", "Speedup"), rows)
+
+
+def _get_final_preds_loop(batch_heatmaps, center, scale):
+    """per joint reference, as get_final_preds used to do it (POST_PROCESS on)"""
+    coords, maxvals = get_max_preds(batch_heatmaps)
+    heatmap_height = batch_heatmaps.shape[2]
+    heatmap_width = batch_heatmaps.shape[3]
+
+    for n in range(coords.shape[0]):
+        for p in range(coords.shape[1]):
+            hm = batch_heatmaps[n][p]
+            px = int(math.floor(coords[n][p][0] + 0.5))
+            py = int(math.floor(coords[n][p][1] + 0.5))
+            if 1 < px < heatmap_width - 1 and 1 < py < heatmap_height - 1:
+                diff = np.array(
+                    [hm[py][px + 1] - hm[py][px - 1], hm[py + 1][px] - hm[py - 1][px]]
+                )
+                coords[n][p] += np.sign(diff) * 0.25
+
+    preds = coords.copy()
+    for i in range(coords.shape[0]):
+        preds[i] = transform_preds(
+            coords[i], center[i], scale[i], [heatmap_width, heatmap_height]
+        )
+    return preds, maxvals
+
+
+def bench_final_preds(args):
+    rng = np.random.RandomState(0)
+    c = cfg.clone()
+    c.defrost()
+    c.TEST.POST_PROCESS = True
+    width, height = args.heatmap_size
+
+    rows = []
+    for batch_size in args.batch_size:
+        heatmaps = rng.uniform(size=(batch_size, args.joints, height, width)) ** 8
+        heatmaps = heatmaps.astype(np.float32)
+        center = rng.uniform(100, 500, (batch_size, 2)).astype(np.float32)
+        scale = rng.uniform(0.5, 3.0, (batch_size, 2)).astype(np.float32)
+        tensors = [torch.from_numpy(a) for a in (heatmaps, center, scale)]
+
+        ref, ref_maxvals = _get_final_preds_loop(heatmaps.copy(), center, scale)
+        out, maxvals = get_final_preds(c, heatmaps, center, scale)
+        out_torch, maxvals_torch = get_final_preds(c, *tensors)
+        # matrices in closed form vs cv2 on float32 points
+        assert np.abs(ref - out).max() < 1e-3
+        assert np.abs(ref - out_torch.numpy()).max() < 1e-3
+        assert np.array_equal(ref_maxvals, maxvals)
+        assert np.array_equal(ref_maxvals, maxvals_torch.numpy())
+        # the validate() decoding of cpu tensors, with numpy center and scale
+        # as in meta, vs get_final_preds on numpy
+        for post_process in (False, True):
+            c.TEST.POST_PROCESS = post_process
+            ref_preds, ref_maxvals = get_final_preds(c, heatmaps, center, scale)
+            decoded = decode_heatmaps(c, tensors[0], center, scale)
+            assert decoded.shape == ref_preds.shape[:2] + (3,)
+            assert np.abs(decoded[:, :, 0:2] - ref_preds).max() < 1e-3
+            assert np.array_equal(decoded[:, :, 2:3], ref_maxvals)
+        c.TEST.POST_PROCESS = True
+
+        t_loop = _timeit(
+            lambda: _get_final_preds_loop(heatmaps.copy(), center, scale), args.number
+        )
+        t_numpy = _timeit(
+            lambda: get_final_preds(c, heatmaps, center, scale), args.number
+        )
+        t_torch = _timeit(lambda: get_final_preds(c, *tensors), args.number)
+        rows.append(
+            (
+                batch_size,
+                args.joints,
+                "{:.2f}".format(t_loop),
+                "{:.2f}".format(t_numpy),
+                "{:.2f}".format(t_torch),
+                "{:.1f}x".format(t_loop / t_numpy),
+            )
+        )
+
+    _print_table(
+        (
+            "Batch",
+            "Joints",
+            "Loop (ms)",
+            "Batched numpy (ms)",
+            "Batched torch CPU (ms)",
+            "Speedup",
+        ),
+        rows,
+    )
+
+
+def _mse_loss_loop(output, target, target_weight):
+    """JointsMSELoss with one criterion call per joint"""
+    criterion = torch.nn.MSELoss(reduction="mean")
+    batch_size, num_joints = output.shape[:2]
+    heatmaps_pred = output.reshape((batch_size, num_joints, -1)).split(1, 1)
+    heatmaps_gt = target.reshape((batch_size, num_joints, -1)).split(1, 1)
+    loss = 0
+    for idx in range(num_joints):
+        heatmap_pred = heatmaps_pred[idx].squeeze()
+        heatmap_gt = heatmaps_gt[idx].squeeze()
+        loss += 0.5 * criterion(
+            heatmap_pred.mul(target_weight[:, idx]),
+            heatmap_gt.mul(target_weight[:, idx]),
+        )
+    return loss / num_joints
+
+
+def _ohkm_loss_loop(output, target, target_weight, topk=8):
+    """JointsOHKMMSELoss with per joint losses and a per sample topk"""
+    criterion = torch.nn.MSELoss(reduction="none")
+    batch_size, num_joints = output.shape[:2]
+    heatmaps_pred = output.reshape((batch_size, num_joints, -1)).split(1, 1)
+    heatmaps_gt = target.reshape((batch_size, num_joints, -1)).split(1, 1)
+    loss = []
+    for idx in range(num_joints):
+        heatmap_pred = heatmaps_pred[idx].squeeze()
+        heatmap_gt = heatmaps_gt[idx].squeeze()
+        loss.append(
+            0.5
+            * criterion(
+                heatmap_pred.mul(target_weight[:, idx]),
+                heatmap_gt.mul(target_weight[:, idx]),
+            )
+        )
+    loss = torch.cat([l.mean(dim=1).unsqueeze(dim=1) for l in loss], dim=1)
+
+    ohkm_loss = 0.0
+    for i in range(batch_size):
+        topk_val, _ = torch.topk(loss[i], k=topk, dim=0, sorted=False)
+        ohkm_loss += torch.gather(loss[i], 0, _).sum() / topk
+    return ohkm_loss / batch_size
+
+
+def _loss_and_grad(loss_fn, output, target, target_weight):
+    output = output.detach().requires_grad_()
+    loss = loss_fn(output, target, target_weight)
+    loss.backward()
+    return loss.detach(), output.grad
+
+
+def bench_losses(args):
+    torch.manual_seed(0)
+    width, height = args.heatmap_size
+
+    rows = []
+    for num_joints in args.joints:
+        shape = (args.batch_size, num_joints, height, width)
+        output = torch.rand(shape)
+        target = torch.rand(shape)
+        target_weight = (torch.rand(args.batch_size, num_joints, 1) > 0.2).float()
+        losses = (
+            ("MSE", _mse_loss_loop, JointsMSELoss(use_target_weight=True)),
+            ("OHKM", _ohkm_loss_loop, JointsOHKMMSELoss(use_target_weight=True)),
+        )
+        for name, loop, fused in losses:
+            ref, ref_grad = _loss_and_grad(loop, output, target, target_weight)
+            out, grad = _loss_and_grad(fused, output, target, target_weight)
+            # summation order differs, the values agree to float32 rounding
+            assert torch.allclose(ref, out, rtol=1e-5, atol=1e-8)
+            assert torch.allclose(ref_grad, grad, rtol=1e-4, atol=1e-10)
+
+            t_loop = _timeit(
+                lambda: _loss_and_grad(loop, output, target, target_weight),
+                args.number,
+            )
+            t_fused = _timeit(
+                lambda: _loss_and_grad(fused, output, target, target_weight),
+                args.number,
+            )
+            rows.append(
+                (
+                    name,
+                    num_joints,
+                    "{:.2f}".format(t_loop),
+                    "{:.2f}".format(t_fused),
+                    "{:.1f}x".format(t_loop / t_fused),
+                )
+            )
+
+    _print_table(
+        ("Loss", "Joints", "Per joint loop (ms)", "Fused (ms)", "Speedup"), rows
+    )
+
+
+def _target_loss_and_grad(render, loss_fn, output, joints, joints_vis, args):
+    """target rendering, forward and backward as in one training step"""
+    width, height = args.heatmap_size
+    image_size = (width * 4, height * 4)
+    target, target_weight = render(
+        joints, joints_vis, image_size, args.heatmap_size, args.sigma
+    )
+    return _loss_and_grad(loss_fn, output, target, target_weight)
+
+
+def bench_sparse_loss(args):
+    torch.manual_seed(0)
+    rng = np.random.RandomState(0)
+    width, height = args.heatmap_size
+    image_size = (width * 4, height * 4)
+
+    rows = []
+    for num_joints in args.joints:
+        output = torch.rand(args.batch_size, num_joints, height, width) * 0.3
+        samples = [
+            _random_joints(num_joints, image_size, rng) for _ in range(args.batch_size)
+        ]
+        joints = torch.from_numpy(np.stack([j for j, _ in samples]))
+        joints_vis = torch.from_numpy(np.stack([v for _, v in samples]))
+
+        losses = (
+            ("MSE", JointsMSELoss(use_target_weight=True)),
+            ("OHKM", JointsOHKMMSELoss(use_target_weight=True)),
+        )
+        for name, loss_fn in losses:
+            dense = lambda: _target_loss_and_grad(
+                render_gaussian_targets, loss_fn, output, joints, joints_vis, args
+            )
+            sparse = lambda: _target_loss_and_grad(
+                gaussian_patches, loss_fn, output, joints, joints_vis, args
+            )
+            ref, ref_grad = dense()
+            out, grad = sparse()
+            # the expanded square rounds differently
+            assert torch.allclose(ref, out, rtol=1e-5, atol=1e-8)
+            assert torch.allclose(ref_grad, grad, rtol=1e-4, atol=1e-10)
+
+            t_dense = _timeit(dense, args.number)
+            t_sparse = _timeit(sparse, args.number)
+            rows.append(
+                (
+                    name,
+                    num_joints,
+                    "{:.2f}".format(t_dense),
+                    "{:.2f}".format(t_sparse),
+                    "{:.1f}x".format(t_dense / t_sparse),
+                )
+            )
+
+    _print_table(
+        ("Loss", "Joints", "Dense target (ms)", "Gaussian patches (ms)", "Speedup"),
+        rows,
+    )
+
+
+def _train_step(c, model, criterion, optimizer, input, target, target_weight):
+    """one step of core.function.train, without the data loading"""
+    with autocast(c, "cpu"):
+        output = model(input)
+    loss = criterion(output.float(), target, target_weight)
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+    return loss
+
+
+def bench_amp(args):
+    torch.manual_seed(0)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    rows = []
+    for cfg_file in args.cfg:
+        c = cfg.clone()
+        c.defrost()
+        c.merge_from_file(cfg_file)
+        width, height = c.MODEL.IMAGE_SIZE
+        heatmap_width, heatmap_height = c.MODEL.HEATMAP_SIZE
+
+        input = torch.randn(args.batch_size, 3, height, width)
+        target = torch.rand(
+            args.batch_size, c.MODEL.NUM_JOINTS, heatmap_height, heatmap_width
+        )
+        target_weight = torch.ones(args.batch_size, c.MODEL.NUM_JOINTS, 1)
+        criterion = JointsMSELoss(use_target_weight=True)
+
+        speeds = []
+        for enabled in (False, True):
+            c.AMP.ENABLED = enabled
+            model = eval("models." + c.MODEL.NAME + ".get_pose_net")(c, is_train=False)
+            model.train()
+            optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+            step = lambda: _train_step(
+                c, model, criterion, optimizer, input, target, target_weight
+            )
+            # warm up, the float32 weights are updated by both
+            loss = step()
+            assert loss.dtype == torch.float32
+            assert all(p.dtype == torch.float32 for p in model.parameters())
+            t = _timeit(step, args.number)
+            speeds.append(args.batch_size / t * 1e3)
+
+        rows.append(
+            (
+                os.path.basename(cfg_file),
+                args.batch_size,
+                "{:.2f}".format(speeds[0]),
+                "{:.2f}".format(speeds[1]),
+                "{:.2f}x".format(speeds[1] / speeds[0]),
+            )
+        )
+
+    _print_table(
+        ("Config", "Batch", "float32 (samples/s)", "bfloat16 (samples/s)", "Speedup"),
+        rows,
+    )
+
+
+def _ddp_data(args):
+    """a small conv net without batch norm and a dataset of args.steps
+    global batches, batch norm statistics would differ per rank"""
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(
+        torch.nn.Conv2d(3, 8, 3, padding=1),
+        torch.nn.ReLU(),
+        torch.nn.Conv2d(8, 4, 1),
+    )
+    num_samples = args.steps * args.batch_size * args.world_size
+    dataset = torch.utils.data.TensorDataset(
+        torch.randn(num_samples, 3, 16, 12), torch.rand(num_samples, 4, 16, 12)
+    )
+    return model, dataset
+
+
+def _ddp_train(model, loader):
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    for input, target in loader:
+        loss = torch.nn.functional.mse_loss(model(input), target)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+
+def _ddp_worker(rank, args, port, queue):
+    os.environ.update(
+        MASTER_ADDR="127.0.0.1",
+        MASTER_PORT=str(port),
+        RANK=str(rank),
+        WORLD_SIZE=str(args.world_size),
+        LOCAL_RANK=str(rank),
+    )
+    torch.set_num_threads(1)
+    c = cfg.clone()
+    c.defrost()
+    c.DIST.ENABLED = True
+    c.DIST.BACKEND = "gloo"
+    c.TRAIN.SHUFFLE = True
+
+    device = init_distributed(c)
+    model, dataset = _ddp_data(args)
+    model = wrap_model(model, device)
+    sampler = get_train_sampler(c, dataset)
+    sampler.set_epoch(0)
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=args.batch_size, sampler=sampler
+    )
+    _ddp_train(model, loader)
+    # numpy, shared tensors would not outlive the process
+    state = {k: v.numpy().copy() for k, v in model.module.state_dict().items()}
+    queue.put((rank, state))
+    torch.distributed.destroy_process_group()
+
+
+def bench_ddp(args):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    queue = torch.multiprocessing.get_context("spawn").SimpleQueue()
+    start = timeit.default_timer()
+    torch.multiprocessing.spawn(
+        _ddp_worker, args=(args, port, queue), nprocs=args.world_size
+    )
+    elapsed = timeit.default_timer() - start
+    states = dict(queue.get() for _ in range(args.world_size))
+
+    # one process stepping over the union of the per rank batches, the
+    # averaged gradient of equal sized batches is the full batch gradient
+    model, dataset = _ddp_data(args)
+    indices = []
+    for rank in range(args.world_size):
+        sampler = torch.utils.data.distributed.DistributedSampler(
+            dataset, num_replicas=args.world_size, rank=rank, shuffle=True
+        )
+        sampler.set_epoch(0)
+        indices.append(np.array(list(sampler)).reshape(args.steps, args.batch_size))
+    batches = np.concatenate(indices, axis=1)
+    # no sample is seen twice nor skipped
+    assert len(np.unique(batches)) == len(dataset)
+    loader = torch.utils.data.DataLoader(dataset, batch_sampler=batches.tolist())
+    _ddp_train(model, loader)
+
+    rows = []
+    for rank in range(args.world_size):
+        diff = max(
+            np.abs(states[rank][k] - v.numpy()).max()
+            for k, v in model.state_dict().items()
+        )
+        assert diff < 1e-5
+        rows.append((rank, "{:.2e}".format(diff)))
+    _print_table(("Rank", "Max weight diff to one process"), rows)
+    print(
+        "{} processes, {} steps of {} samples each: {:.1f}s".format(
+            args.world_size, args.steps, args.batch_size, elapsed
+        )
+    )
+
+
+class _ValDataset(torch.utils.data.Dataset):
+    """random crops with the interface validate() uses, evaluate() keeps
+    the predictions it is given"""
+
+    flip_pairs = [[i, i + 1] for i in range(1, 16, 2)]
+
+    def __init__(self, c, num_samples):
+        rng = np.random.RandomState(0)
+        width, height = c.MODEL.IMAGE_SIZE
+        heatmap_width, heatmap_height = c.MODEL.HEATMAP_SIZE
+        self.num_joints = c.MODEL.NUM_JOINTS
+        self.input = rng.randn(num_samples, 3, height, width).astype(np.float32)
+        self.target = np.zeros(
+            (self.num_joints, heatmap_height, heatmap_width), dtype=np.float32
+        )
+        self.center = rng.uniform(100, 500, (num_samples, 2)).astype(np.float32)
+        self.scale = rng.uniform(0.5, 3.0, (num_samples, 2)).astype(np.float32)
+        self.score = rng.uniform(size=num_samples)
+        self.evaluated = None
+
+    def __len__(self):
+        return len(self.input)
+
+    def __getitem__(self, idx):
+        meta = {
+            "image": "{:06d}.jpg".format(idx),
+            "image_id": idx,
+            "center": self.center[idx],
+            "scale": self.scale[idx],
+            "score": self.score[idx],
+        }
+        target_weight = np.ones((self.num_joints, 1), dtype=np.float32)
+        return self.input[idx], self.target, target_weight, meta
+
+    def evaluate(
+        self, cfg, preds, output_dir, all_boxes, img_path, *args, image_ids=None
+    ):
+        self.evaluated = (preds, all_boxes, img_path, image_ids)
+        return {"Null": 0.0}, float(preds[:, :, 2].mean())
+
+
+def _val_config(args, world_size):
+    c = cfg.clone()
+    c.defrost()
+    c.MODEL.NUM_JOINTS = 17
+    c.MODEL.IMAGE_SIZE = [48, 64]
+    c.MODEL.HEATMAP_SIZE = [12, 16]
+    c.TEST.FLIP_TEST = False
+    c.TEST.BATCH_SIZE_PER_GPU = args.batch_size
+    c.DIST.ENABLED = world_size > 1
+    c.DIST.BACKEND = "gloo"
+    return c
+
+
+def _run_validate(c, args):
+    """:return: perf, validated by the ranks, and the predictions on rank 0"""
+    # core.function imports wandb and, through utils.vis, torchvision; only
+    # the validate() benchmarks need them
+    from core.function import validate
+
+    torch.manual_seed(0)
+    model = torch.nn.Conv2d(3, c.MODEL.NUM_JOINTS, 4, stride=4)
+    dataset = _ValDataset(c, args.samples)
+    loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=c.TEST.BATCH_SIZE_PER_GPU,
+        sampler=get_val_sampler(c, dataset),
+    )
+    criterion = JointsMSELoss(use_target_weight=True)
+    perf = validate(c, loader, dataset, model, criterion, tempfile.gettempdir(), "")
+    return perf, len(loader.sampler), dataset.evaluated
+
+
+def _ddp_validate_worker(rank, args, port, queue):
+    os.environ.update(
+        MASTER_ADDR="127.0.0.1",
+        MASTER_PORT=str(port),
+        RANK=str(rank),
+        WORLD_SIZE=str(args.world_size),
+        LOCAL_RANK=str(rank),
+    )
+    torch.set_num_threads(1)
+    c = _val_config(args, args.world_size)
+    c.RANK = rank
+    init_distributed(c)
+    start = timeit.default_timer()
+    result = _run_validate(c, args)
+    queue.put((rank, timeit.default_timer() - start, result))
+    torch.distributed.destroy_process_group()
+
+
+def bench_ddp_validate(args):
+    torch.set_num_threads(1)
+    start = timeit.default_timer()
+    ref_perf, _, (ref_preds, ref_boxes, ref_paths, ref_ids) = _run_validate(
+        _val_config(args, 1), args
+    )
+    t_single = timeit.default_timer() - start
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    queue = torch.multiprocessing.get_context("spawn").SimpleQueue()
+    torch.multiprocessing.spawn(
+        _ddp_validate_worker, args=(args, port, queue), nprocs=args.world_size
+    )
+    results = sorted(queue.get() for _ in range(args.world_size))
+
+    rows = []
+    for rank, elapsed, (perf, num_samples, evaluated) in results:
+        # every rank returns the perf evaluated on rank 0
+        assert perf == ref_perf
+        if rank == 0:
+            preds, boxes, paths, image_ids = evaluated
+            assert paths == ref_paths
+            assert np.array_equal(image_ids, ref_ids)
+            assert np.allclose(preds, ref_preds, atol=1e-4)
+            assert np.array_equal(boxes, ref_boxes)
+        else:
+            assert evaluated is None
+        rows.append((rank, num_samples, "{:.2f}".format(elapsed)))
+    assert sum(row[1] for row in rows) == args.samples
+
+    _print_table(("Rank", "Samples validated", "validate() (s)"), rows)
+    print("one process: {} samples, {:.2f}s".format(args.samples, t_single))
+
+
+def bench_execution(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    modes = ((False, False), (True, False), (False, True), (True, True))
+
+    rows = []
+    for cfg_file in args.cfg:
+        c = cfg.clone()
+        c.defrost()
+        c.merge_from_file(cfg_file)
+        # a single process on the cpu
+        c.GPUS = (0,)
+        width, height = c.MODEL.IMAGE_SIZE
+        input = torch.randn(args.batch_size, 3, height, width)
+        torch.manual_seed(0)
+        model = eval("models." + c.MODEL.NAME + ".get_pose_net")(c, is_train=False)
+        model.eval()
+
+        times = []
+        compile_time = 0
+        with torch.no_grad():
+            ref = model(input)
+            for channels_last, compile in modes:
+                c.MODEL.CHANNELS_LAST = channels_last
+                c.MODEL.COMPILE = compile
+                # a fresh cache, every model would add to the recompile limit
+                torch.compiler.reset()
+                mode_model = setup_model(c, copy.deepcopy(model))
+                mode_input = prepare_input(c, input)
+                start = timeit.default_timer()
+                output = mode_model(mode_input)
+                if compile:
+                    compile_time = max(compile_time, timeit.default_timer() - start)
+                assert torch.allclose(output, ref, atol=1e-4)
+                times.append(_timeit(lambda: mode_model(mode_input), args.number))
+
+        rows.append(
+            [os.path.relpath(cfg_file, "experiments"), args.batch_size]
+            + ["{:.0f}".format(t) for t in times]
+            + ["{:.0f}".format(compile_time)]
+        )
+
+    _print_table(
+        (
+            "Config",
+            "Batch",
+            "Eager NCHW (ms)",
+            "channels_last (ms)",
+            "compile (ms)",
+            "compile + channels_last (ms)",
+            "Compilation (s)",
+        ),
+        rows,
+    )
+
+
+_CHECKPOINT_MODES = (
+    [],
+    ["layer1"],
+    ["stage2"],
+    ["stage3"],
+    ["stage4"],
+    ["layer1", "stage2", "stage3", "stage4"],
+)
+
+
+def _hrnet_train_setup(cfg_file, layers, batch_size):
+    c = cfg.clone()
+    c.defrost()
+    c.merge_from_file(cfg_file)
+    c.MODEL.EXTRA.CHECKPOINT_LAYERS = layers
+    width, height = c.MODEL.IMAGE_SIZE
+    heatmap_width, heatmap_height = c.MODEL.HEATMAP_SIZE
+
+    torch.manual_seed(0)
+    model = eval("models." + c.MODEL.NAME + ".get_pose_net")(c, is_train=False)
+    model.train()
+    input = torch.randn(batch_size, 3, height, width)
+    target = torch.rand(batch_size, c.MODEL.NUM_JOINTS, heatmap_height, heatmap_width)
+    target_weight = torch.ones(batch_size, c.MODEL.NUM_JOINTS, 1)
+    criterion = JointsMSELoss(use_target_weight=True)
+    return model, lambda: criterion(model(input), target, target_weight)
+
+
+def _saved_activations_mb(model, loss_fn):
+    """size of the tensors autograd keeps for the backward pass"""
+    params = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    saved = {}
+
+    def pack(t):
+        storage = t.untyped_storage()
+        if storage.data_ptr() not in params:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        loss_fn()
+    return sum(saved.values()) / 2**20
+
+
+def _checkpointing_worker(cfg_file, layers, args, queue):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model, loss_fn = _hrnet_train_setup(cfg_file, layers, args.batch_size)
+    # plain SGD, no optimizer state to allocate during the first step
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-6)
+    for p in model.parameters():
+        p.grad = torch.zeros_like(p)
+    saved_mb = _saved_activations_mb(model, loss_fn)
+
+    def step():
+        loss = loss_fn()
+        optimizer.zero_grad(set_to_none=False)
+        loss.backward()
+        optimizer.step()
+
+    # peak of the first step in this fresh process, over the memory before it
+    rss_kb = _memory_kb()[0]
+    step()
+    peak_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_kb) / 2**10
+    queue.put((saved_mb, peak_mb, _timeit(step, args.number)))
+
+
+def _checkpointing_step(cfg_file, layers, batch_size):
+    """:return: the gradients and the buffers after a training step"""
+    model, loss_fn = _hrnet_train_setup(cfg_file, layers, batch_size)
+    loss_fn().backward()
+    return [p.grad for p in model.parameters()], list(model.buffers())
+
+
+def bench_checkpointing(args):
+    # checkpointing recomputes the same values, the gradients do not change,
+    # and the batch norm running stats are updated once, not again on the
+    # recomputation
+    ref_grads, ref_buffers = _checkpointing_step(args.cfg[0], _CHECKPOINT_MODES[0], 2)
+    grads, buffers = _checkpointing_step(args.cfg[0], _CHECKPOINT_MODES[-1], 2)
+    assert all(
+        torch.allclose(r, o, rtol=1e-4, atol=1e-7) for r, o in zip(ref_grads, grads)
+    )
+    assert len(ref_buffers) == len(buffers)
+    assert all(torch.equal(r, o) for r, o in zip(ref_buffers, buffers))
+
+    ctx = multiprocessing.get_context("spawn")
+    rows = []
+    for cfg_file in args.cfg:
+        for layers in _CHECKPOINT_MODES:
+            queue = ctx.Queue()
+            process = ctx.Process(
+                target=_checkpointing_worker, args=(cfg_file, layers, args, queue)
+            )
+            process.start()
+            saved_mb, peak_mb, t = queue.get()
+            process.join()
+            rows.append(
+                (
+                    os.path.relpath(cfg_file, "experiments"),
+                    ", ".join(layers) or "-",
+                    "{:.0f}".format(saved_mb),
+                    "{:.0f}".format(peak_mb),
+                    "{:.2f}".format(t / 1e3),
+                )
+            )
+
+    _print_table(
+        (
+            "Config",
+            "CHECKPOINT_LAYERS",
+            "Saved activations (MB)",
+            "Step peak RSS (MB)",
+            "Step (s)",
+        ),
+        rows,
+    )
+    print("batch size {}".format(args.batch_size))
+
+
+def _crowded_kpts_db(num_dets, num_joints, rng):
+    """
+    candidates of one crowded image, jittered copies of a few people as a
+    detector and top-down pose model produce them
+    """
+    num_people = max(1, num_dets // 20)
+    sizes = rng.uniform(40, 200, num_people)
+    poses = (
+        rng.uniform(100, 540, (num_people, 1, 2))
+        + rng.normal(0, 0.3, (num_people, num_joints, 2)) * sizes[:, None, None]
+    )
+    kpts_db = []
+    for n in range(num_dets):
+        p = rng.integers(num_people)
+        joints = np.zeros((num_joints, 3), dtype=np.float32)
+        joints[:, :2] = (
+            poses[p]
+            + rng.normal(0, 0.01 * sizes[p], (num_joints, 2))
+            + rng.normal(0, 0.02 * sizes[p], 2)
+        )
+        joints[:, 2] = rng.uniform(0, 1, num_joints)
+        kpts_db.append(
+            {
+                "keypoints": joints,
+                "score": rng.uniform(0.2, 1.0),
+                "area": float(sizes[p] ** 2 * rng.uniform(0.8, 1.2)),
+                "image": 0,
+            }
+        )
+    return kpts_db
+
+
+def _oks_nms_loop(kpts_db, thresh, sigmas=None, in_vis_thre=None):
+    """oks_iou per kept detection, as nms.oks_nms used to do it"""
+    scores = np.array([kpts_db[i]["score"] for i in range(len(kpts_db))])
+    kpts = np.array(
+        [kpts_db[i]["keypoints"][:17].flatten() for i in range(len(kpts_db))]
+    )
+    areas = np.array([kpts_db[i]["area"] for i in range(len(kpts_db))])
+
+    order = scores.argsort()[::-1]
+
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+
+        oks_ovr = oks_iou(
+            kpts[i], kpts[order[1:]], areas[i], areas[order[1:]], sigmas, in_vis_thre
+        )
+
+        inds = np.where(oks_ovr <= thresh)[0]
+        order = order[inds + 1]
+
+    return keep
+
+
+def bench_oks_nms(args):
+    rng = np.random.default_rng(0)
+    rows = []
+    for num_dets in args.num_dets:
+        for in_vis_thre in (None, args.in_vis_thre):
+            images = [
+                _crowded_kpts_db(num_dets, args.num_joints, rng)
+                for _ in range(args.images)
+            ]
+            for kpts_db in images:
+                ref = _oks_nms_loop(kpts_db, args.thresh, in_vis_thre=in_vis_thre)
+                out = oks_nms(kpts_db, args.thresh, in_vis_thre=in_vis_thre)
+                assert out == ref, (num_dets, in_vis_thre)
+
+                kpts = np.array([d["keypoints"][:17].flatten() for d in kpts_db])
+                areas = np.array([d["area"] for d in kpts_db])
+                ovr = oks_matrix(kpts, areas, in_vis_thre=in_vis_thre)
+                for i in range(0, num_dets, max(1, num_dets // 10)):
+                    row = oks_iou(kpts[i], kpts, areas[i], areas, None, in_vis_thre)
+                    assert np.array_equal(ovr[i], row)
+
+            def run(fn):
+                return lambda: [
+                    fn(kpts_db, args.thresh, in_vis_thre=in_vis_thre)
+                    for kpts_db in images
+                ]
+
+            t_loop = _timeit(run(_oks_nms_loop), args.number) / args.images
+            t_vec = _timeit(run(oks_nms), args.number) / args.images
+            rows.append(
+                [
+                    num_dets,
+                    in_vis_thre,
+                    int(np.mean([len(oks_nms(d, args.thresh)) for d in images])),
+                    "{:.2f}".format(t_loop),
+                    "{:.2f}".format(t_vec),
+                    "{:.1f}x".format(t_loop / t_vec),
+                ]
+            )
+    _print_table(
+        (
+            "Candidates",
+            "in_vis_thre",
+            "Kept",
+            "Loop (ms/image)",
+            "OKS matrix (ms/image)",
+            "Speedup",
+        ),
+        rows,
+    )
+
+
+def bench_soft_nms(args):
+    # as the coco, infinity and infinity_coco datasets set their oks_sigmas
+    infinity_sigmas = np.full(36, COCO_SIGMAS.mean())
+    dataset_sigmas = {
+        17: COCO_SIGMAS,
+        36: infinity_sigmas,
+        53: np.concatenate([COCO_SIGMAS, infinity_sigmas]),
+    }
+    rng = np.random.default_rng(0)
+    counts = 1 + rng.poisson(args.dets_per_image - 1, args.images)
+
+    rows = []
+    for num_joints in args.num_joints:
+        sigmas = dataset_sigmas[num_joints]
+        kpts_dbs = [_crowded_kpts_db(count, num_joints, rng) for count in counts]
+
+        ref = [soft_oks_nms(kpts_db, args.thresh, sigmas) for kpts_db in kpts_dbs]
+        out = soft_oks_nms_images(kpts_dbs, args.thresh, sigmas)
+        assert all(np.array_equal(r, o) for r, o in zip(ref, out))
+
+        t_loop = _timeit(
+            lambda: [
+                soft_oks_nms(kpts_db, args.thresh, sigmas) for kpts_db in kpts_dbs
+            ],
+            1,
+        )
+        t_batched = _timeit(
+            lambda: soft_oks_nms_images(kpts_dbs, args.thresh, sigmas), 1
+        )
+        rows.append(
+            [
+                args.images,
+                counts.sum(),
+                num_joints,
+                "{:.2f}".format(t_loop / 1e3),
+                "{:.2f}".format(t_batched / 1e3),
+                "{:.1f}x".format(t_loop / t_batched),
+            ]
+        )
+    _print_table(
+        (
+            "Images",
+            "Detections",
+            "Joints",
+            "Per image (s)",
+            "Batched (s)",
+            "Speedup",
+        ),
+        rows,
+    )
+
+    # the soft nms of evaluate(), on the 17 joints validate() keeps of the
+    # datasets with more, with the full oks_sigmas of the dataset
+    kpts_dbs = [_crowded_kpts_db(count, 17, rng) for count in counts]
+    preds = np.stack([kpt["keypoints"] for kpts_db in kpts_dbs for kpt in kpts_db])
+    all_boxes = np.zeros((len(preds), 6))
+    all_boxes[:, 4] = [kpt["area"] for kpts_db in kpts_dbs for kpt in kpts_db]
+    all_boxes[:, 5] = [kpt["score"] for kpts_db in kpts_dbs for kpt in kpts_db]
+    image_ids = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.cumsum(counts) - counts
+    for num_joints, sigmas in sorted(dataset_sigmas.items()):
+        keep, scores = keypoint_nms(
+            preds[:, :num_joints],
+            all_boxes,
+            image_ids,
+            0.0,
+            args.thresh,
+            soft_nms=True,
+            sigmas=sigmas,
+        )
+        ref = []
+        for kpts_db, offset in zip(kpts_dbs, offsets.tolist()):
+            for n, kpt in enumerate(kpts_db):
+                kpt["score"] = scores[offset + n]
+            ref.append(offset + soft_oks_nms(kpts_db, args.thresh, sigmas[:17]))
+        assert np.array_equal(np.concatenate(ref), keep), num_joints
+    print("evaluate() soft nms of 17 joint preds: same picks with the sigmas of")
+    print("the {} joint datasets".format(sorted(dataset_sigmas)))
+
+
+def _keypoint_nms_loop(preds, all_boxes, image_ids, in_vis_thre, oks_thre, soft_nms):
+    """per person dicts, as the evaluate() of the coco datasets used to do it"""
+    num_joints = preds.shape[1]
+    _kpts = []
+    for idx, kpt in enumerate(preds):
+        _kpts.append(
+            {
+                "keypoints": kpt,
+                "center": all_boxes[idx][0:2],
+                "scale": all_boxes[idx][2:4],
+                "area": all_boxes[idx][4],
+                "score": all_boxes[idx][5],
+                "image": int(image_ids[idx]),
+            }
+        )
+    kpts = collections.defaultdict(list)
+    for kpt in _kpts:
+        kpts[kpt["image"]].append(kpt)
+
+    oks_nmsed_kpts = []
+    for img in kpts.keys():
+        img_kpts = kpts[img]
+        for n_p in img_kpts:
+            box_score = n_p["score"]
+            kpt_score = 0
+            valid_num = 0
+            for n_jt in range(0, num_joints):
+                # in float64, as numpy 1 compares and adds float32 scalars
+                t_s = float(n_p["keypoints"][n_jt][2])
+                if t_s > in_vis_thre:
+                    kpt_score = kpt_score + t_s
+                    valid_num = valid_num + 1
+            if valid_num != 0:
+                kpt_score = kpt_score / valid_num
+            n_p["score"] = kpt_score * box_score
+
+        if soft_nms:
+            keep = soft_oks_nms(img_kpts, oks_thre)
+        else:
+            keep = oks_nms(img_kpts, oks_thre)
+        oks_nmsed_kpts.append([img_kpts[_keep] for _keep in keep])
+    return oks_nmsed_kpts
+
+
+def _evaluate_inputs(args, rng):
+    """crowded detections of args.images images, as validate() gathers them"""
+    counts = 1 + rng.poisson(args.dets_per_image - 1, args.images)
+    # detections grouped by image, the images in no particular id order
+    ids = rng.permutation(np.arange(1, 10 * args.images, 10))
+    kpts_db = [kpt for count in counts for kpt in _crowded_kpts_db(count, 17, rng)]
+    preds = np.stack([kpt["keypoints"] for kpt in kpts_db])
+    all_boxes = np.zeros((len(preds), 6))
+    all_boxes[:, 0:2] = rng.uniform(0, 640, (len(preds), 2))
+    all_boxes[:, 2:4] = rng.uniform(0.2, 3, (len(preds), 2))
+    all_boxes[:, 4] = [kpt["area"] for kpt in kpts_db]
+    all_boxes[:, 5] = rng.uniform(0.1, 1, len(preds))
+    image_ids = np.repeat(ids, counts)
+    return preds, all_boxes, image_ids
+
+
+def bench_evaluate_nms(args):
+    rng = np.random.default_rng(0)
+    preds, all_boxes, image_ids = _evaluate_inputs(args, rng)
+
+    rows = []
+    for soft_nms in (False, True):
+        ref = _keypoint_nms_loop(
+            preds, all_boxes, image_ids, args.in_vis_thre, args.oks_thre, soft_nms
+        )
+
+        def columnar():
+            keep, scores = keypoint_nms(
+                preds,
+                all_boxes,
+                image_ids,
+                args.in_vis_thre,
+                args.oks_thre,
+                soft_nms,
+                COCO_SIGMAS,
+            )
+            return select_results(preds, all_boxes, image_ids, scores, keep)
+
+        out = columnar()
+        # the loop lists the images in order of appearance, by id here
+        ref = sorted(ref, key=lambda img_kpts: img_kpts[0]["image"])
+        ref = [kpt for img_kpts in ref for kpt in img_kpts]
+        assert len(out.scores) == len(ref)
+        for r, image_id, score, kpts in zip(
+            ref, out.image_ids, out.scores, out.keypoints
+        ):
+            assert r["image"] == image_id and r["score"] == score
+            assert np.array_equal(r["keypoints"].ravel(), kpts)
+
+        t_loop = _timeit(
+            lambda: _keypoint_nms_loop(
+                preds, all_boxes, image_ids, args.in_vis_thre, args.oks_thre, soft_nms
+            ),
+            1,
+        )
+        t_columnar = _timeit(columnar, 1)
+        rows.append(
+            [
+                "soft" if soft_nms else "oks",
+                len(preds),
+                len(out.scores),
+                "{:.2f}".format(t_loop / 1e3),
+                "{:.2f}".format(t_columnar / 1e3),
+                "{:.1f}x".format(t_loop / t_columnar),
+            ]
+        )
+    _print_table(
+        ("NMS", "Detections", "Kept", "Loop (s)", "Columnar (s)", "Speedup"), rows
+    )
+
+
+def _write_results_loop(oks_nmsed_kpts, cat_id, num_joints, res_file):
+    """
+    per person lists, dumped indented and read back, as
+    _write_coco_keypoint_results used to do it
+    """
+    cat_results = []
+    for img_kpts in oks_nmsed_kpts:
+        if len(img_kpts) == 0:
+            continue
+        _key_points = np.array([img_kpts[k]["keypoints"] for k in range(len(img_kpts))])
+        key_points = np.zeros((_key_points.shape[0], num_joints * 3), dtype=np.float64)
+        for ipt in range(num_joints):
+            key_points[:, ipt * 3 + 0] = _key_points[:, ipt, 0]
+            key_points[:, ipt * 3 + 1] = _key_points[:, ipt, 1]
+            key_points[:, ipt * 3 + 2] = _key_points[:, ipt, 2]
+        cat_results.extend(
+            {
+                "image_id": img_kpts[k]["image"],
+                "category_id": cat_id,
+                "keypoints": list(key_points[k]),
+                "score": img_kpts[k]["score"],
+                "center": list(img_kpts[k]["center"]),
+                "scale": list(img_kpts[k]["scale"]),
+            }
+            for k in range(len(img_kpts))
+        )
+    with open(res_file, "w") as f:
+        json_tricks.dump(cat_results, f, sort_keys=True, indent=4)
+    json_tricks.load(open(res_file))
+
+
+def _gt_coco(preds, all_boxes, image_ids):
+    """one ground truth person per image, its first detection, as a COCO api"""
+    first = np.unique(image_ids, return_index=True)[1]
+    anns = []
+    for ann_id, idx in enumerate(first.tolist(), 1):
+        kpts = preds[idx].astype(np.float64).round(1)
+        kpts[:, 2] = 2
+        x0, y0 = kpts[:, :2].min(axis=0)
+        x1, y1 = kpts[:, :2].max(axis=0)
+        anns.append(
+            {
+                "id": ann_id,
+                "image_id": int(image_ids[idx]),
+                "category_id": 1,
+                "bbox": [x0, y0, x1 - x0, y1 - y0],
+                "area": float(all_boxes[idx, 4]),
+                "iscrowd": 0,
+                "num_keypoints": len(kpts),
+                "keypoints": kpts.ravel().tolist(),
+            }
+        )
+    coco = COCO()
+    coco.dataset = {
+        "images": [{"id": int(i)} for i in image_ids[first]],
+        "annotations": anns,
+        "categories": [{"id": 1, "name": "person"}],
+    }
+    coco.createIndex()
+    return coco
+
+
+def _keypoint_stats(coco, coco_results):
+    coco_dt = coco.loadRes(coco_results)
+    coco_eval = COCOeval(coco, coco_dt, "keypoints")
+    coco_eval.params.useSegm = None
+    coco_eval.evaluate()
+    coco_eval.accumulate()
+    coco_eval.summarize()
+    return coco_eval.stats
+
+
+def bench_results_json(args):
+    rng = np.random.default_rng(0)
+    preds, all_boxes, image_ids = _evaluate_inputs(args, rng)
+    preds = preds.astype(np.float32)
+    coco = _gt_coco(preds, all_boxes, image_ids)
+    keep, scores = keypoint_nms(
+        preds, all_boxes, image_ids, args.in_vis_thre, args.oks_thre
+    )
+    results = select_results(preds, all_boxes, image_ids, scores, keep)
+    # the per image lists the writer used to take
+    bounds = np.flatnonzero(np.diff(results.image_ids)) + 1
+    oks_nmsed_kpts = [
+        [
+            {
+                "keypoints": preds[idx],
+                "center": all_boxes[idx][0:2],
+                "scale": all_boxes[idx][2:4],
+                "score": scores[idx],
+                "image": int(image_ids[idx]),
+            }
+            for idx in image_keep.tolist()
+        ]
+        for image_keep in np.split(keep, bounds)
+    ]
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        ref_file = os.path.join(tmp_dir, "ref.json")
+        res_file = os.path.join(tmp_dir, "results.json")
+        t_loop = _timeit(
+            lambda: _write_results_loop(oks_nmsed_kpts, 1, preds.shape[1], ref_file),
+            1,
+        )
+        t_write = _timeit(lambda: write_keypoint_results(results, 1, res_file), 1)
+        with open(ref_file) as f:
+            ref = json.load(f)
+        with open(res_file) as f:
+            assert json.load(f) == ref
+        assert keypoint_annotations(results, 1) == ref
+
+        t_load_file = _timeit(lambda: coco.loadRes(res_file), 1)
+        t_load_memory = _timeit(
+            lambda: coco.loadRes(keypoint_annotations(results, 1)), 1
+        )
+        stats = _keypoint_stats(coco, ref_file)
+        assert np.array_equal(_keypoint_stats(coco, res_file), stats)
+        assert np.array_equal(
+            _keypoint_stats(coco, keypoint_annotations(results, 1)), stats
+        )
+        sizes = [os.path.getsize(ref_file), os.path.getsize(res_file)]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    _print_table(
+        ("Path", "Detections", "File MB", "Write (s)", "loadRes (s)"),
+        [
+            [
+                "json_tricks indent=4 + re-read",
+                len(keep),
+                "{:.1f}".format(sizes[0] / 2**20),
+                "{:.2f}".format(t_loop / 1e3),
+                "-",
+            ],
+            [
+                "streaming compact json",
+                len(keep),
+                "{:.1f}".format(sizes[1] / 2**20),
+                "{:.2f}".format(t_write / 1e3),
+                "{:.2f}".format(t_load_file / 1e3),
+            ],
+            [
+                "in memory",
+                len(keep),
+                "-",
+                "-",
+                "{:.2f}".format(t_load_memory / 1e3),
+            ],
+        ],
+    )
+    print("AP / AR identical on the three paths: {}".format(stats.round(4).tolist()))
+
+
+def _assert_same_eval_imgs(ref, out):
+    assert len(ref) == len(out)
+    for r, o in zip(ref, out):
+        assert (r is None) == (o is None)
+        if r is None:
+            continue
+        assert r.keys() == o.keys()
+        for key in r:
+            assert np.array_equal(np.asarray(r[key]), np.asarray(o[key]))
+
+
+def bench_coco_eval(args):
+    rng = np.random.default_rng(0)
+    preds, all_boxes, image_ids = _evaluate_inputs(args, rng)
+    coco = _gt_coco(preds, all_boxes, image_ids)
+    # every detection, rescored as evaluate() does it
+    scores = rescore_keypoints(preds, all_boxes[:, 5], args.in_vis_thre)
+    results = select_results(preds, all_boxes, image_ids, scores, np.arange(len(preds)))
+    coco_dt = coco.loadRes(keypoint_annotations(results, 1))
+
+    evals = {}
+
+    def evaluate(num_workers):
+        coco_eval = ParallelCOCOeval(coco, coco_dt, "keypoints", num_workers)
+        coco_eval.params.useSegm = None
+        coco_eval.evaluate()
+        evals[num_workers] = coco_eval
+
+    rows = []
+    t_serial = _timeit(lambda: evaluate(0), 1)
+    ref = evals[0]
+    ref.accumulate()
+    ref.summarize()
+    rows.append(["COCOeval", len(preds), "{:.2f}".format(t_serial / 1e3), "1.0x"])
+    for num_workers in args.workers:
+        t = _timeit(lambda: evaluate(num_workers), 1)
+        out = evals[num_workers]
+        _assert_same_eval_imgs(ref.evalImgs, out.evalImgs)
+        out.accumulate()
+        out.summarize()
+        for key in ("precision", "recall", "scores"):
+            assert np.array_equal(ref.eval[key], out.eval[key])
+        assert np.array_equal(ref.stats, out.stats)
+        rows.append(
+            [
+                "{} workers".format(num_workers),
+                len(preds),
+                "{:.2f}".format(t / 1e3),
+                "{:.1f}x".format(t_serial / t),
+            ]
+        )
+    _print_table(("evaluate()", "Detections", "Time (s)", "Speedup"), rows)
+    print(
+        "{} cpus, AP / AR identical: {}".format(
+            multiprocessing.cpu_count(), ref.stats.round(4).tolist()
+        )
+    )
+
+
+def main():
+    args = parse_args()
+    globals()["bench_" + args.name](args)
+
+
+if __name__ == "__main__":
+    main()
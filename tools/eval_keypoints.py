@@ -0,0 +1,52 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) Microsoft
+# Licensed under the MIT License.
+# ------------------------------------------------------------------------------
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import multiprocessing
+
+import _init_paths
+from dataset.coco_eval import ParallelCOCOeval
+from pycocotools.coco import COCO
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="COCO keypoint evaluation of a results json"
+    )
+    parser.add_argument(
+        "--gt", help="ground truth annotations json", required=True, type=str
+    )
+    parser.add_argument(
+        "--res",
+        help="keypoint results json, as written by evaluate()",
+        required=True,
+        type=str,
+    )
+    parser.add_argument(
+        "--workers",
+        help="processes of the evaluation, split by image",
+        type=int,
+        default=multiprocessing.cpu_count(),
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    coco = COCO(args.gt)
+    coco_dt = coco.loadRes(args.res)
+    coco_eval = ParallelCOCOeval(coco, coco_dt, "keypoints", args.workers)
+    coco_eval.params.useSegm = None
+    coco_eval.evaluate()
+    coco_eval.accumulate()
+    coco_eval.summarize()
+
+
+if __name__ == "__main__":
+    main()
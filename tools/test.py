@@ -21,8 +21,10 @@ import torch.utils.data
 import torch.utils.data.distributed
 import torchvision.transforms as transforms
 from config import cfg, update_config
+from core.execution import setup_model
 from core.function import validate
 from core.loss import JointsMSELoss
+from utils.distributed import get_val_sampler, init_distributed
 from utils.utils import create_logger
 
 import models
@@ -56,6 +58,8 @@ def parse_args():
 def main():
     args = parse_args()
     update_config(cfg, args)
+    if cfg.DIST.ENABLED:
+        device = init_distributed(cfg)
 
     logger, final_output_dir, tb_log_dir = create_logger(cfg, args.cfg, "valid")
 
@@ -77,9 +81,19 @@ def main():
         logger.info("=> loading model from {}".format(model_state_file))
         model.load_state_dict(torch.load(model_state_file))
 
-    model = torch.nn.DataParallel(model, device_ids=cfg.GPUS).cuda()
+    model = setup_model(cfg, model)
+
     # define loss function (criterion) and optimizer
-    criterion = JointsMSELoss(use_target_weight=cfg.LOSS.USE_TARGET_WEIGHT).cuda()
+    criterion = JointsMSELoss(use_target_weight=cfg.LOSS.USE_TARGET_WEIGHT)
+    if cfg.DIST.ENABLED:
+        # one process per device, each on a shard of the val set
+        model = model.to(device)
+        criterion = criterion.to(device)
+        gpus_per_process = 1
+    else:
+        model = torch.nn.DataParallel(model, device_ids=cfg.GPUS).cuda()
+        criterion = criterion.cuda()
+        gpus_per_process = len(cfg.GPUS)
 
     # Data loading code
     normalize = transforms.Normalize(
@@ -99,8 +113,9 @@ def main():
     )
     valid_loader = torch.utils.data.DataLoader(
         valid_dataset,
-        batch_size=cfg.TEST.BATCH_SIZE_PER_GPU * len(cfg.GPUS),
+        batch_size=cfg.TEST.BATCH_SIZE_PER_GPU * gpus_per_process,
         shuffle=False,
+        sampler=get_val_sampler(cfg, valid_dataset),
         num_workers=cfg.WORKERS,
         pin_memory=True,
     )
@@ -109,6 +124,8 @@ def main():
     validate(
         cfg, valid_loader, valid_dataset, model, criterion, final_output_dir, tb_log_dir
     )
+    if cfg.DIST.ENABLED:
+        torch.distributed.destroy_process_group()
 
 
 if __name__ == "__main__":
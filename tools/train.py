@@ -22,10 +22,25 @@ import torch.utils.data.distributed
 import torchvision.transforms as transforms
 import wandb
 from config import cfg, update_config
+from core.amp import get_device_type, get_grad_scaler
+from core.execution import setup_model
 from core.function import train, validate
 from core.loss import JointsMSELoss
 from torch.utils.tensorboard import SummaryWriter
-from utils.utils import create_logger, get_model_summary, get_optimizer, save_checkpoint
+from utils.distributed import (
+    get_train_sampler,
+    get_val_sampler,
+    init_distributed,
+    wrap_model,
+)
+from utils.heatmap import log_gaussian_table_cache_at_exit
+from utils.utils import (
+    create_logger,
+    freeze_layers,
+    get_model_summary,
+    get_optimizer,
+    save_checkpoint,
+)
 
 import models
 
@@ -60,6 +75,9 @@ def parse_args():
 def main():
     args = parse_args()
     update_config(cfg, args)
+    if cfg.DIST.ENABLED:
+        device = init_distributed(cfg)
+    is_main = cfg.RANK == 0
 
     logger, final_output_dir, tb_log_dir = create_logger(cfg, args.cfg, "train")
 
@@ -67,7 +85,7 @@ def main():
 
     logger.info(pprint.pformat(args))
     logger.info(cfg)
-    if cfg.LOG_WANDB:
+    if cfg.LOG_WANDB and is_main:
         wandb.init(project="synthetic_finetuning", entity="yonigoz", config=cfg)
 
     # cudnn related setting
@@ -77,29 +95,45 @@ def main():
 
     model = eval("models." + cfg.MODEL.NAME + ".get_pose_net")(cfg, is_train=True)
 
-    # copy model file
-    this_dir = os.path.dirname(__file__)
-    shutil.copy2(
-        os.path.join(this_dir, "../lib/models", cfg.MODEL.NAME + ".py"),
-        final_output_dir,
-    )
-    # logger.info(pprint.pformat(model))
+    # logs, tensorboard and checkpoints are written by rank 0 only
+    writer_dict = None
+    if is_main:
+        # copy model file
+        this_dir = os.path.dirname(__file__)
+        shutil.copy2(
+            os.path.join(this_dir, "../lib/models", cfg.MODEL.NAME + ".py"),
+            final_output_dir,
+        )
+        # logger.info(pprint.pformat(model))
 
-    writer_dict = {
-        "writer": SummaryWriter(log_dir=tb_log_dir),
-        "train_global_steps": 0,
-        "valid_global_steps": 0,
-    }
+        writer_dict = {
+            "writer": SummaryWriter(log_dir=tb_log_dir),
+            "train_global_steps": 0,
+            "valid_global_steps": 0,
+        }
 
-    dump_input = torch.rand((1, 3, cfg.MODEL.IMAGE_SIZE[1], cfg.MODEL.IMAGE_SIZE[0]))
-    writer_dict["writer"].add_graph(model, (dump_input,))
+        dump_input = torch.rand(
+            (1, 3, cfg.MODEL.IMAGE_SIZE[1], cfg.MODEL.IMAGE_SIZE[0])
+        )
+        writer_dict["writer"].add_graph(model, (dump_input,))
 
-    logger.info(get_model_summary(model, dump_input))
+        logger.info(get_model_summary(model, dump_input))
 
-    model = torch.nn.DataParallel(model, device_ids=cfg.GPUS).cuda()
+    # before the model is wrapped, see freeze_layers
+    model = freeze_layers(cfg, model)
+    model = setup_model(cfg, model)
 
     # define loss function (criterion) and optimizer
-    criterion = JointsMSELoss(use_target_weight=cfg.LOSS.USE_TARGET_WEIGHT).cuda()
+    criterion = JointsMSELoss(use_target_weight=cfg.LOSS.USE_TARGET_WEIGHT)
+    if cfg.DIST.ENABLED:
+        # one process per device
+        model = wrap_model(model, device)
+        criterion = criterion.to(device)
+        gpus_per_process = 1
+    else:
+        model = torch.nn.DataParallel(model, device_ids=cfg.GPUS).cuda()
+        criterion = criterion.cuda()
+        gpus_per_process = len(cfg.GPUS)
 
     # Data loading code
     normalize = transforms.Normalize(
@@ -130,17 +164,21 @@ def main():
         ),
     )
 
+    train_sampler = get_train_sampler(cfg, train_dataset)
     train_loader = torch.utils.data.DataLoader(
         train_dataset,
-        batch_size=cfg.TRAIN.BATCH_SIZE_PER_GPU * len(cfg.GPUS),
-        shuffle=cfg.TRAIN.SHUFFLE,
+        batch_size=cfg.TRAIN.BATCH_SIZE_PER_GPU * gpus_per_process,
+        shuffle=cfg.TRAIN.SHUFFLE and train_sampler is None,
+        sampler=train_sampler,
         num_workers=cfg.WORKERS,
         pin_memory=cfg.PIN_MEMORY,
+        worker_init_fn=log_gaussian_table_cache_at_exit,
     )
     valid_loader = torch.utils.data.DataLoader(
         valid_dataset,
-        batch_size=cfg.TEST.BATCH_SIZE_PER_GPU * len(cfg.GPUS),
+        batch_size=cfg.TEST.BATCH_SIZE_PER_GPU * gpus_per_process,
         shuffle=False,
+        sampler=get_val_sampler(cfg, valid_dataset),
         num_workers=cfg.WORKERS,
         pin_memory=cfg.PIN_MEMORY,
     )
@@ -149,18 +187,24 @@ def main():
     best_model = False
     last_epoch = -1
     optimizer = get_optimizer(cfg, model)
+    scaler = get_grad_scaler(cfg, get_device_type(model))
     begin_epoch = cfg.TRAIN.BEGIN_EPOCH
     checkpoint_file = os.path.join(final_output_dir, "checkpoint.pth")
 
     if cfg.AUTO_RESUME and os.path.exists(checkpoint_file):
         logger.info("=> loading checkpoint '{}'".format(checkpoint_file))
-        checkpoint = torch.load(checkpoint_file)
+        checkpoint = torch.load(
+            checkpoint_file, map_location=device if cfg.DIST.ENABLED else None
+        )
         begin_epoch = checkpoint["epoch"]
         best_perf = checkpoint["perf"]
         last_epoch = checkpoint["epoch"]
         model.load_state_dict(checkpoint["state_dict"])
 
         optimizer.load_state_dict(checkpoint["optimizer"])
+        # absent in checkpoints of float32 runs, the scaler starts over
+        if checkpoint.get("scaler"):
+            scaler.load_state_dict(checkpoint["scaler"])
         logger.info(
             "=> loaded checkpoint '{}' (epoch {})".format(
                 checkpoint_file, checkpoint["epoch"]
@@ -173,6 +217,9 @@ def main():
 
     for epoch in range(begin_epoch, cfg.TRAIN.END_EPOCH):
         lr_scheduler.step()
+        if train_sampler is not None:
+            # a different shuffle every epoch, the same on all ranks
+            train_sampler.set_epoch(epoch)
 
         # train for one epoch
         train(
@@ -185,20 +232,27 @@ def main():
             final_output_dir,
             tb_log_dir,
             writer_dict,
+            scaler,
         )
 
-        # evaluate on validation set
+        # evaluate on validation set, every rank on its shard with the
+        # unwrapped model, the predictions are evaluated on rank 0
         perf_indicator = validate(
             cfg,
             valid_loader,
             valid_dataset,
-            model,
+            model.module if cfg.DIST.ENABLED else model,
             criterion,
             final_output_dir,
             tb_log_dir,
             writer_dict,
         )
 
+        if not is_main:
+            # wait for the checkpoint of rank 0
+            torch.distributed.barrier()
+            continue
+
         if perf_indicator >= best_perf:
             best_perf = perf_indicator
             best_model = True
@@ -214,10 +268,18 @@ def main():
                 "best_state_dict": model.module.state_dict(),
                 "perf": perf_indicator,
                 "optimizer": optimizer.state_dict(),
+                "scaler": scaler.state_dict(),
             },
             best_model,
             final_output_dir,
         )
+        if cfg.DIST.ENABLED:
+            torch.distributed.barrier()
+
+    if cfg.DIST.ENABLED:
+        torch.distributed.destroy_process_group()
+    if not is_main:
+        return
 
     final_model_state_file = os.path.join(final_output_dir, "final_state.pth")
     logger.info("=> saving final model state to {}".format(final_model_state_file))